@@ -0,0 +1,125 @@
+"""
+Aggregate counters for case and preceptor statistics.
+
+Statistics such as how often a case was served, its incorrect rate or a designation's
+activity are kept as counters that are updated together with the writes they count.
+Reading them then costs a few documents per counter instead of a scan of the
+completed exams or the used-case collections. There is one counter per case
+(`case:<record_id>`) and one per designation (`designation:<designation>`), each
+with these fields:
+
+- served: reserved for a student, in the same transaction as the reservation;
+- completed, correct, incorrect: added with the first write of a completed exam,
+  so a retried job does not count it twice.
+
+rebuild() recomputes the counters from the completed exams, e.g. after a deploy that
+missed some updates. Used-case records expire after their window, so served counts
+cannot be recomputed; they are kept, and raised to at least the completed count.
+Increments made while a rebuild runs may be lost, so run it when the app is quiet:
+
+    python aggregates.py                 # per-case and per-designation statistics
+    python aggregates.py --reconcile     # rebuild from history first
+"""
+import argparse
+
+from storage import BATCH_SIZE
+
+CASE = "case:"
+DESIGNATION = "designation:"
+FIELDS = ["served", "completed", "correct", "incorrect"]
+
+
+def designation_of(passcode):
+    """The preceptor designation of a passcode, e.g. "aaa" for "password1_aaa"."""
+    return passcode.split("_")[-1] if "_" in passcode else ""
+
+
+def is_correct(case, selected_diagnoses):
+    return [str(d).strip() for d in selected_diagnoses][:3] == list(case.correct_order)
+
+
+def served(designation, record_id):
+    """Counter deltas for serving record_id to a student of designation."""
+    return {CASE + str(record_id): {"served": 1}, DESIGNATION + designation: {"served": 1}}
+
+
+def completed(designation, record_id, correct=None):
+    """Counter deltas for a completed exam; correct is None when the case is not in the bank."""
+    fields = {"completed": 1}
+    if correct is not None:
+        fields["correct" if correct else "incorrect"] = 1
+    return {CASE + str(record_id): dict(fields), DESIGNATION + designation: dict(fields)}
+
+
+def add(totals, deltas):
+    for name, fields in deltas.items():
+        counter = totals.setdefault(name, {})
+        for field, n in fields.items():
+            counter[field] = counter.get(field, 0) + n
+    return totals
+
+
+def rebuild(storage, case_bank, page_size=BATCH_SIZE, log=print):
+    """Recomputes every counter from the completed exams and stores it. Returns the totals."""
+    totals = {}
+    cursor = None
+    exams = 0
+    while True:
+        page = storage.list_completed_exams(after=cursor, limit=page_size)
+        for _, data in page:
+            record_id = data.get("record_id", "")
+            case = case_bank.get(record_id)
+            correct = is_correct(case, data.get("selected_diagnoses", [])) if case is not None else None
+            add(totals, completed(designation_of(data.get("passcode", "")), record_id, correct))
+        exams += len(page)
+        if len(page) < page_size:
+            break
+        cursor = (page[-1][1]["timestamp"], page[-1][0])
+    current = storage.get_counters()
+    for name, counter in current.items():
+        if "served" in counter:
+            totals.setdefault(name, {})["served"] = counter["served"]
+    for counter in totals.values():
+        counter["served"] = max(counter.get("served", 0), counter.get("completed", 0))
+    storage.replace_counters(totals)
+    log(f"rebuilt {len(totals)} counters from {exams} completed exams")
+    return totals
+
+
+def statistics(counters, prefix):
+    """One row per counter with the given prefix, with every field and the incorrect rate."""
+    import pandas as pd
+
+    rows = []
+    for name, fields in sorted(counters.items()):
+        if name.startswith(prefix):
+            row = {"key": name[len(prefix):], **{f: fields.get(f, 0) for f in FIELDS}}
+            graded = row["correct"] + row["incorrect"]
+            row["incorrect_rate"] = row["incorrect"] / graded if graded else None
+            rows.append(row)
+    return pd.DataFrame(rows, columns=["key"] + FIELDS + ["incorrect_rate"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--reconcile", action="store_true", help="rebuild the counters from history first")
+    parser.add_argument("--secrets", default=".streamlit/secrets.toml", help="app secrets with [storage]")
+    parser.add_argument("--cases-dir", default=".")
+    parser.add_argument("--page-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    from storage import open_storage_from_secrets
+
+    storage = open_storage_from_secrets(args.secrets)
+    if args.reconcile:
+        from case_bank import CaseBank
+
+        rebuild(storage, CaseBank(args.cases_dir), args.page_size)
+    counters = storage.get_counters()
+    for title, prefix in (("Cases", CASE), ("Designations", DESIGNATION)):
+        print(title)
+        print(statistics(counters, prefix).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
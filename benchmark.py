@@ -0,0 +1,284 @@
+"""
+Benchmark of one student's exam flow, run headless against local fakes.
+
+Each iteration drives login -> search (keystrokes, a substring match and an AI
+suggestion) -> add three diagnoses -> reorder -> submit through Streamlit's AppTest,
+with storage in memory and OpenAI/SMTP replaced by the fakes in fakes.py. The report
+has per-step latency, external calls per flow and memory, and can be saved as a
+baseline or compared against one:
+
+    python benchmark.py --iterations 10 --save-baseline benchmark_baseline.json
+    python benchmark.py --iterations 10 --baseline benchmark_baseline.json
+
+Comparing exits with status 1 if a step got slower than the tolerance allows, a flow
+makes more external calls, or peak memory grew.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(HERE, "clin_reason.py")
+
+# Step latencies closer than this to the baseline are never reported as regressions.
+NOISE_FLOOR_SECONDS = 0.002
+# Depends on how often the AI suggestion was polled, so it is reported but not compared.
+UNCOMPARED_CALLS = {"reruns"}
+
+
+class Recorder:
+    """
+    Times each step. With trace=True it records the peak memory allocated during each
+    step instead; tracemalloc slows Python down too much to time the same run.
+    """
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.latencies = {}
+        self.peaks = {}
+
+    def step(self, name, fn):
+        if self.trace:
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        self.latencies.setdefault(name, []).append(elapsed)
+        if self.trace:
+            _, peak = tracemalloc.get_traced_memory()
+            self.peaks[name] = max(self.peaks.get(name, 0), peak - current)
+        return result
+
+    def summary(self, peaks=None):
+        peaks = self.peaks if peaks is None else peaks
+        steps = {}
+        for name, values in self.latencies.items():
+            ordered = sorted(values)
+            steps[name] = {
+                "count": len(ordered),
+                "mean": round(statistics.fmean(ordered), 6),
+                "p50": round(ordered[len(ordered) // 2], 6),
+                "p95": round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 6),
+                "max": round(ordered[-1], 6),
+                "peak_kib": round(peaks.get(name, 0) / 1024, 1),
+            }
+        return steps
+
+
+def pending_jobs(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running')").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        conn.close()
+
+
+def wait_until(predicate, timeout, interval=0.01):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError("benchmark step did not finish in time")
+        time.sleep(interval)
+
+
+def markdown_values(at):
+    return [m.value for m in at.markdown]
+
+
+def run_flow(recorder, secrets, passcode, correct, timeout):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP, default_timeout=timeout)
+    for section, values in secrets.items():
+        at.secrets[section] = values
+
+    recorder.step("login_page", at.run)
+    at.text_input[0].input(passcode)
+    at.text_input[1].input("Benchmark Student")
+    recorder.step("login_submit", at.button[0].click().run)
+    if at.exception or at.error:
+        raise RuntimeError(f"login failed: {[e.value for e in at.error] or at.exception}")
+
+    case = at.session_state["question_row"]
+    answers = [case["answer"], case["sec_dx"], case["thir_dx"]]
+    search = at.text_input(key="diag_search_input")
+
+    # Keystrokes of a partial query, each one a rerun.
+    for length in range(2, 6):
+        recorder.step("keystroke", search.input(answers[1][:length]).run)
+
+    # A query the local matcher cannot resolve goes to the (fake) LLM in the background.
+    query = f"unlisted finding {passcode}"
+    recorder.step("ai_search", search.input(query).run)
+
+    def suggestion_ready():
+        at.run()
+        return not any("Looking for a matching diagnosis" in v for v in markdown_values(at))
+
+    recorder.step("ai_suggestion_ready", lambda: wait_until(suggestion_ready, timeout, interval=0.02))
+
+    # Added out of order, then fixed (or not) with one reorder click.
+    for dx in (answers[1], answers[0], answers[2]):
+        recorder.step("search", search.input(dx).run)
+        button = next(b for b in at.button if b.label == "➕ " + dx)
+        recorder.step("add_diagnosis", button.click().run)
+    if correct:
+        recorder.step("reorder", at.button(key="up_1").click().run)
+    else:
+        recorder.step("reorder", at.button(key="down_1").click().run)
+
+    submit = next(b for b in at.button if b.label == "Submit Answer")
+    recorder.step("submit", submit.click().run)
+    if at.exception:
+        raise RuntimeError(f"submit failed: {at.exception}")
+    recorder.step(
+        "jobs_drained",
+        lambda: wait_until(lambda: pending_jobs(secrets["submission_jobs"]["path"]) == 0, timeout),
+    )
+
+
+def run(iterations, llm_latency, smtp_latency, seed, timeout):
+    import fakes
+
+    os.chdir(HERE)
+    random.seed(seed)
+    workdir = tempfile.mkdtemp(prefix="clin_reason_bench_")
+    # One designation per student, so every flow draws from the full case bank.
+    passcodes = [f"student{i}_bench{i}" for i in range(iterations + 2)]
+    secrets = fakes.app_secrets(
+        {p: f"{p}@example.com" for p in passcodes},
+        os.path.join(workdir, "jobs.sqlite3"),
+        ai_suggestions={"debounce_seconds": 0.05, "timeout_seconds": 10},
+    )
+    chat = fakes.install(llm_latency=llm_latency, smtp_latency=smtp_latency)
+
+    import metrics
+
+    # The first flow pays for imports, case parsing and client setup; it is reported apart.
+    cold = Recorder()
+    started = time.perf_counter()
+    run_flow(cold, secrets, passcodes[0], True, timeout)
+    cold_seconds = time.perf_counter() - started
+
+    metrics.reset()
+    llm_before, smtp_before = chat.calls, len(fakes.FakeSMTP.sent)
+    logins_before = fakes.FakeSMTP.logins
+    warm = Recorder()
+    started = time.perf_counter()
+    for i, passcode in enumerate(passcodes[1:-1]):
+        run_flow(warm, secrets, passcode, correct=i % 2 == 0, timeout=timeout)
+    warm_seconds = time.perf_counter() - started
+    counters = metrics.snapshot()["counters"]
+    calls = {
+        "storage_reads": counters.get("storage_reads", 0),
+        "storage_writes": counters.get("storage_writes", 0),
+        "llm_requests": chat.calls - llm_before,
+        "smtp_messages": len(fakes.FakeSMTP.sent) - smtp_before,
+        "smtp_logins": fakes.FakeSMTP.logins - logins_before,
+        "reruns": counters.get("reruns", 0),
+    }
+
+    # One more flow, traced, for memory. An incorrect answer also builds the review email.
+    tracemalloc.start()
+    traced = Recorder(trace=True)
+    run_flow(traced, secrets, passcodes[-1], correct=False, timeout=timeout)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "config": {
+            "iterations": iterations,
+            "llm_latency": llm_latency,
+            "smtp_latency": smtp_latency,
+            "seed": seed,
+            "python": sys.version.split()[0],
+        },
+        "cold_flow_seconds": round(cold_seconds, 4),
+        "warm_flow_seconds": round(warm_seconds / iterations, 4),
+        "steps": warm.summary(traced.peaks),
+        "calls_per_flow": {k: round(v / iterations, 2) for k, v in calls.items()},
+        # Allocated during the traced flow: peak, and still held at its end.
+        "memory": {"retained_kib": round(current / 1024, 1), "peak_kib": round(peak / 1024, 1)},
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Returns a list of human-readable regressions of report against baseline."""
+    regressions = []
+    for name, step in report["steps"].items():
+        base = baseline.get("steps", {}).get(name)
+        if not base:
+            continue
+        limit = base["p50"] * (1 + tolerance)
+        if step["p50"] > limit and step["p50"] - base["p50"] > NOISE_FLOOR_SECONDS:
+            regressions.append(f"{name}: p50 {step['p50'] * 1000:.1f} ms vs baseline {base['p50'] * 1000:.1f} ms")
+    for name, value in report["calls_per_flow"].items():
+        base = baseline.get("calls_per_flow", {}).get(name)
+        if name not in UNCOMPARED_CALLS and base is not None and value > base:
+            regressions.append(f"{name}: {value} per flow vs baseline {base}")
+    base_peak = baseline.get("memory", {}).get("peak_kib")
+    if base_peak and report["memory"]["peak_kib"] > base_peak * (1 + tolerance):
+        regressions.append(f"peak memory: {report['memory']['peak_kib']} KiB vs baseline {base_peak} KiB")
+    return regressions
+
+
+def print_report(report, baseline=None):
+    print(f"cold flow {report['cold_flow_seconds'] * 1000:.0f} ms, "
+          f"warm flow {report['warm_flow_seconds'] * 1000:.0f} ms "
+          f"({report['config']['iterations']} iterations)")
+    print(f"{'step':<22}{'n':>5}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'peak KiB':>10}{'base p50':>10}")
+    for name, step in report["steps"].items():
+        base = (baseline or {}).get("steps", {}).get(name)
+        print(f"{name:<22}{step['count']:>5}{step['p50'] * 1000:>10.1f}{step['p95'] * 1000:>10.1f}"
+              f"{step['max'] * 1000:>10.1f}{step['peak_kib']:>10.1f}"
+              f"{(base['p50'] * 1000 if base else float('nan')):>10.1f}")
+    print("calls per flow: " + ", ".join(f"{k}={v}" for k, v in report["calls_per_flow"].items()))
+    print(f"memory per flow: peak {report['memory']['peak_kib']} KiB, "
+          f"retained {report['memory']['retained_kib']} KiB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds per fake OpenAI call")
+    parser.add_argument("--smtp-latency", type=float, default=0.02, help="seconds per fake SMTP command")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--baseline", help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", help="write this run's report to this path")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before failing")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = run(args.iterations, args.llm_latency, args.smtp_latency, args.seed, args.timeout)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print_report(report, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+    if baseline is not None:
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
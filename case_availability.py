@@ -0,0 +1,119 @@
+"""
+Per-designation pools of cases that can still be served.
+
+Each designation keeps an indexed free list of the record_ids it has not used within
+the window, so drawing a random case and removing it are O(1) instead of filtering the
+whole case bank per student. A drawn case is reserved in storage before it is handed
+out; if another app process reserved it first, it is dropped and another is drawn.
+Pools are rebuilt from storage every `resync_interval` seconds, and whenever the case
+bank changes.
+
+With `reserve_batch` > 1, a draw reserves that many cases in one transaction and hands
+the extras to the next students of the same designation, which saves round trips when
+a cohort logs in together. Extras not handed out before the process exits stay marked
+used until the window expires.
+"""
+import collections
+import random
+import threading
+import time
+
+
+class FreeList:
+    """Set of items with O(1) add, discard and uniformly random draw."""
+
+    def __init__(self, items=()):
+        self._items = list(dict.fromkeys(items))
+        self._index = {item: i for i, item in enumerate(self._items)}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._index
+
+    def add(self, item):
+        if item not in self._index:
+            self._index[item] = len(self._items)
+            self._items.append(item)
+
+    def discard(self, item):
+        i = self._index.pop(item, None)
+        if i is None:
+            return
+        last = self._items.pop()
+        if i < len(self._items):
+            self._items[i] = last
+            self._index[last] = i
+
+    def draw(self, rng=random):
+        """Removes and returns a random item."""
+        item = self._items[rng.randrange(len(self._items))]
+        self.discard(item)
+        return item
+
+
+class CaseAvailability:
+    def __init__(self, case_bank, tracker, resync_interval=30, reserve_batch=1, rng=None):
+        self.case_bank = case_bank
+        self.tracker = tracker
+        self.resync_interval = resync_interval
+        self.reserve_batch = max(1, reserve_batch)
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+        # designation -> lock serializing its draws
+        self._designation_locks = {}
+        # designation -> (FreeList, synced at, case bank record_ids it was built from)
+        self._pools = {}
+        # designation -> reserved record_ids not handed out yet
+        self._reserved = {}
+
+    def _designation_lock(self, designation):
+        with self._lock:
+            return self._designation_locks.setdefault(designation, threading.Lock())
+
+    def _pool(self, designation):
+        record_ids = self.case_bank.record_ids()
+        entry = self._pools.get(designation)
+        if entry and entry[2] is record_ids and time.monotonic() - entry[1] < self.resync_interval:
+            return entry[0]
+        used = self.tracker.get_used(designation)
+        pool = FreeList(rid for rid in record_ids if rid not in used)
+        self._pools[designation] = (pool, time.monotonic(), record_ids)
+        return pool
+
+    def available(self, designation):
+        with self._designation_lock(designation):
+            return len(self._pool(designation)) + len(self._reserved.get(designation, ()))
+
+    def draw(self, designation):
+        """Reserves and returns a random unused record_id for designation, or None if none is left."""
+        drawn = self.draw_many(designation, 1)
+        return drawn[0] if drawn else None
+
+    def draw_many(self, designation, count):
+        """
+        Reserves up to count distinct unused record_ids for designation, e.g. to assign
+        cases to a whole cohort up front, using as few storage transactions as possible.
+        """
+        drawn = []
+        with self._designation_lock(designation):
+            reserved = self._reserved.setdefault(designation, collections.deque())
+            while reserved and len(drawn) < count:
+                record_id = reserved.popleft()
+                if record_id in self.case_bank:
+                    drawn.append(record_id)
+            pool = self._pool(designation)
+            limit = self.tracker.reserve_limit()
+            while pool and len(drawn) < count:
+                size = min(len(pool), max(count - len(drawn), self.reserve_batch))
+                # Capped before drawing, so no candidate leaves the pool without being offered.
+                size = min(size, limit) if limit else size
+                candidates = [pool.draw(self.rng) for _ in range(size)]
+                # Candidates not reserved were taken by another process and stay out of the pool.
+                for record_id in self.tracker.reserve(designation, candidates):
+                    if len(drawn) < count:
+                        drawn.append(record_id)
+                    else:
+                        reserved.append(record_id)
+        return drawn
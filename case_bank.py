@@ -0,0 +1,273 @@
+"""
+Process-wide bank of clinical cases.
+
+The case CSV files are parsed once and indexed by record_id. Later refreshes only
+re-read a file when its mtime/size changed *and* its content hash differs, so all
+sessions share one parsed copy and case lookups are plain dictionary reads.
+
+Each row is compiled once into an immutable Case holding everything the render,
+matching and grading paths need (split choices, parsed physical exam, prompt context,
+correct order), so none of it is recomputed per rerun.
+
+CompiledCaseBank serves the same cases from the validated SQLite file built by
+ingest_cases.py, opened read-only; open_case_bank() prefers it over the CSV files.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_FIELDS = ["cc", "hpi", "pmhx", "meds", "allergies", "immunizations", "shx", "fhx", "vs", "pe"]
+
+# Layout of the file written by ingest_cases.py.
+COMPILED_FORMAT = 1
+
+_PE_LABEL = re.compile(r'([A-Z][a-zA-Z ]+):')
+
+
+def parse_physical_exam(pe_text):
+    """Splits physical exam text into (label, description) pairs."""
+    if not isinstance(pe_text, str):
+        return []
+    parts = _PE_LABEL.split(pe_text)
+    return [(parts[i].strip(), parts[i + 1].strip()) for i in range(1, len(parts), 2)]
+
+
+def safe_text(val):
+    return str(val) if pd.notna(val) else ""
+
+
+def get_clinical_context(row):
+    context_parts = []
+    for field in CONTEXT_FIELDS:
+        value = row.get(field, "")
+        # Convert the value to a string first so that None becomes "None"
+        # Alternatively, check explicitly for None.
+        if value is not None:
+            value_str = str(value).strip()
+        else:
+            value_str = ""
+        if value_str:
+            context_parts.append(f"{field.upper()}: {value_str}")
+    return " | ".join(context_parts)
+
+
+def row_fingerprint(row):
+    """Hash of the row's content, so derived artifacts can tell when a case was edited."""
+    payload = json.dumps({k: safe_text(v) for k, v in row.items()}, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass(frozen=True, slots=True)
+class Case:
+    record_id: str
+    # Read-only view of the raw CSV row.
+    row: MappingProxyType
+    choices: tuple
+    # Lowercased choices, aligned with choices, for substring matching.
+    choice_keys: tuple
+    # (label, description) pairs of the physical exam.
+    pe_lines: tuple
+    clinical_context: str
+    # (answer, sec_dx, thir_dx), stripped.
+    correct_order: tuple
+    fingerprint: str
+
+    @classmethod
+    def from_row(cls, row):
+        row = dict(row)
+        row["record_id"] = str(row["record_id"])
+        choices = tuple(c.strip() for c in str(row.get("choices", "")).split(","))
+        return cls(
+            record_id=row["record_id"],
+            row=MappingProxyType(row),
+            choices=choices,
+            choice_keys=tuple(c.lower() for c in choices),
+            pe_lines=tuple(parse_physical_exam(row.get("pe", ""))),
+            clinical_context=get_clinical_context(row),
+            correct_order=tuple(safe_text(row.get(f, "")).strip() for f in ("answer", "sec_dx", "thir_dx")),
+            fingerprint=row_fingerprint(row),
+        )
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CaseBank:
+    def __init__(self, directory=".", pattern="*.csv", refresh_interval=30):
+        self.directory = directory
+        self.pattern = pattern
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        # path -> {"mtime_ns", "size", "sha1", "rows": {record_id: Case}}
+        self._files = {}
+        self._rows = {}
+        self._record_ids = ()
+        self._last_refresh = 0.0
+        self.refresh(force=True)
+
+    def _read_file(self, path):
+        df = pd.read_csv(path)
+        rows = {}
+        for row in df.to_dict("records"):
+            case = Case.from_row(row)
+            rows[case.record_id] = case
+        return rows
+
+    def refresh(self, force=False):
+        """
+        Picks up added, changed and removed case files.
+        Returns True if the index was rebuilt.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_refresh < self.refresh_interval:
+            return False
+        with self._lock:
+            self._last_refresh = now
+            paths = sorted(glob.glob(os.path.join(self.directory, self.pattern)))
+            changed = False
+            for path in set(self._files) - set(paths):
+                del self._files[path]
+                changed = True
+            for path in paths:
+                stat = os.stat(path)
+                entry = self._files.get(path)
+                if entry and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                    continue
+                sha1 = file_sha1(path)
+                if entry and entry["sha1"] == sha1:
+                    # Touched but not modified; remember the new mtime and skip parsing.
+                    entry["mtime_ns"] = stat.st_mtime_ns
+                    entry["size"] = stat.st_size
+                    continue
+                self._files[path] = {
+                    "mtime_ns": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "sha1": sha1,
+                    "rows": self._read_file(path),
+                }
+                changed = True
+            if changed:
+                rows = {}
+                for path in sorted(self._files):
+                    rows.update(self._files[path]["rows"])
+                # Swap in the new index in one assignment so readers never see a partial build.
+                self._rows = rows
+                self._record_ids = tuple(rows)
+            return changed
+
+    def record_ids(self):
+        return self._record_ids
+
+    def get(self, record_id):
+        """Returns the Case for record_id, or None if it is not in the bank."""
+        return self._rows.get(str(record_id))
+
+    def __contains__(self, record_id):
+        return str(record_id) in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class CompiledCaseBank:
+    """
+    The cases compiled by ingest_cases.py, with the same interface as CaseBank.
+    refresh() reloads them when the file's build generation changes.
+    """
+
+    def __init__(self, path="case_bank.sqlite3", refresh_interval=30):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._generation = None
+        self._rows = {}
+        self._record_ids = ()
+        self._last_refresh = 0.0
+        self.refresh(force=True)
+
+    def _connect(self):
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+
+    def _load(self):
+        """Returns (generation, {record_id: Case}), with None for the cases if the generation is unchanged."""
+        conn = self._connect()
+        try:
+            meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+            if int(meta.get("format", 0)) != COMPILED_FORMAT:
+                raise ValueError(f"{self.path} has format {meta.get('format')}, expected {COMPILED_FORMAT}")
+            if meta["generation"] == self._generation:
+                return self._generation, None
+            rows = {}
+            for record_id, data in conn.execute("SELECT record_id, data FROM cases ORDER BY source, position"):
+                rows[record_id] = Case.from_row(json.loads(data))
+            # Never built, or built from no cases: serving it would leave every student without one.
+            if meta["generation"] == "0" or not rows:
+                raise ValueError(f"{self.path} has no cases")
+            return meta["generation"], rows
+        finally:
+            conn.close()
+
+    def refresh(self, force=False):
+        """Picks up a rebuilt file. Returns True if the index was reloaded."""
+        now = time.monotonic()
+        if not force and now - self._last_refresh < self.refresh_interval:
+            return False
+        with self._lock:
+            self._last_refresh = now
+            try:
+                generation, rows = self._load()
+            except (sqlite3.Error, ValueError, KeyError) as e:
+                if self._generation is None:
+                    raise
+                # Keep serving the cases already loaded rather than failing an exam.
+                logger.warning("Keeping the loaded cases: cannot read %s: %s", self.path, e)
+                return False
+            if rows is None:
+                return False
+            self._rows = rows
+            self._record_ids = tuple(rows)
+            self._generation = generation
+            return True
+
+    def record_ids(self):
+        return self._record_ids
+
+    def get(self, record_id):
+        """Returns the Case for record_id, or None if it is not in the bank."""
+        return self._rows.get(str(record_id))
+
+    def __contains__(self, record_id):
+        return str(record_id) in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+
+def open_case_bank(directory=".", compiled_path="case_bank.sqlite3"):
+    """
+    The compiled case bank if compiled_path exists, is readable and has cases, else the
+    CSVs in directory.
+    """
+    if compiled_path and os.path.exists(compiled_path):
+        try:
+            return CompiledCaseBank(compiled_path)
+        except (sqlite3.Error, ValueError, KeyError) as e:
+            logger.warning("Falling back to the case CSV files: cannot read %s: %s", compiled_path, e)
+    return CaseBank(directory)
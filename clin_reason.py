@@ -1,37 +1,196 @@
+import startup_timing
+import metrics
+
 import streamlit as st
-import pandas as pd
-import os
-import glob
-import random
+import functools
 import datetime
-import re
-import openai 
+import time
+import uuid
 
-from docx import Document
-from docx.shared import Inches
+# Only lightweight modules are imported here. Heavy dependencies (firebase_admin, openai,
+# pandas, python-docx, smtplib) are imported where first used, and clients are created
+# once per process inside st.cache_resource factories, so the login screen draws fast.
+from diagnosis_matcher import get_matcher
+from suggestion_service import CircuitBreaker, CircuitOpenError, SuggestionService
 
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+# Set wide layout
+st.set_page_config(layout="wide")
+startup_timing.mark("script_start")
 
-import firebase_admin
-from firebase_admin import credentials, firestore
+@st.cache_resource
+def get_db():
+    """Firestore client, initialized once per process."""
+    with startup_timing.timed("firestore_client"):
+        from storage import firestore_client
 
-import streamlit.components.v1 as components
+        # Initialize Firebase
+        return firestore_client(st.secrets["firebase_service_account"].to_dict())
 
-# Set wide layout
-st.set_page_config(layout="wide")
+@st.cache_resource
+def get_storage():
+    """
+    Backend for used cases, passcode locks, exam sessions and completed exams;
+    [storage] backend = "firestore" (default) | "sqlite" | "memory", path for sqlite.
+    """
+    from storage import open_storage
+
+    # Every call is timed and its reads/writes counted; see configure_metrics().
+    return open_storage(st.secrets.get("storage", {}), get_db)
+
+@st.cache_resource
+def configure_metrics():
+    """
+    [metrics] log_reruns = true logs one JSON line per rerun; prometheus_path is rewritten
+    every export_interval seconds with per-span p50/p95/p99 and call counts.
+    """
+    config = st.secrets.get("metrics", {})
+    metrics.configure(
+        log_reruns=config.get("log_reruns", False),
+        prometheus_path=config.get("prometheus_path"),
+        export_interval=float(config.get("export_interval", 15)),
+    )
+
+@st.cache_resource
+def get_openai():
+    """The configured openai module, imported once per process."""
+    with startup_timing.timed("openai_client"):
+        import openai
+        openai.api_key = st.secrets["openai"]["api_key"]
+        return openai
+
+@st.cache_resource
+def load_diagnosis_aliases():
+    """
+    Adds the alias table written by precompute_aliases.py ([matching] aliases_path) to
+    the local matcher's synonyms. Returns its version, or None if there is none.
+    """
+    from diagnosis_matcher import use_aliases
+
+    with startup_timing.timed("diagnosis_aliases"):
+        return use_aliases(st.secrets.get("matching", {}).get("aliases_path", "diagnosis_aliases.json"))
+
+@st.cache_resource
+def get_case_bank():
+    """
+    One parsed, record_id-indexed copy of the cases shared by every session: the file
+    built by ingest_cases.py ([cases] compiled_path) if there is one, else the CSVs.
+    """
+    with startup_timing.timed("case_bank"):
+        from case_bank import open_case_bank
+        return open_case_bank(".", st.secrets.get("cases", {}).get("compiled_path", "case_bank.sqlite3"))
+
+@st.cache_resource
+def get_suggestion_cache():
+    """AI suggestions shared across sessions; [suggestion_cache] tier = "memory" | "disk" | "firestore"."""
+    from suggestion_cache import FirestoreSuggestionStore, SqliteSuggestionStore, SuggestionCache
+
+    config = st.secrets.get("suggestion_cache", {})
+    tier = config.get("tier", "memory")
+    store = None
+    if tier == "disk":
+        store = SqliteSuggestionStore(config.get("path", "suggestion_cache.sqlite3"))
+    elif tier == "firestore":
+        store = FirestoreSuggestionStore(get_db())
+    return SuggestionCache(int(config.get("max_entries", 2048)), store)
+
+def ai_suggestion_config():
+    return st.secrets.get("ai_suggestions", {})
+
+@st.cache_resource
+def get_suggestion_service():
+    """Bounded worker pool and circuit breaker shared by every session's AI lookups."""
+    config = ai_suggestion_config()
+    breaker = CircuitBreaker(
+        failure_threshold=int(config.get("breaker_failures", 5)),
+        reset_after=float(config.get("breaker_reset_seconds", 30)),
+    )
+    return SuggestionService(
+        max_workers=int(config.get("workers", 4)),
+        debounce=float(config.get("debounce_seconds", 0.3)),
+        breaker=breaker,
+    )
+
+@st.cache_resource
+def get_session_writer():
+    """Coalesces exam-session saves into merge writes; see [sessions] write_window_seconds."""
+    from session_writer import SessionWriteBehind
+
+    window = float(st.secrets.get("sessions", {}).get("write_window_seconds", 2))
+    return SessionWriteBehind(get_storage(), window=window)
+
+@st.cache_resource
+def get_passcode_locks():
+    from passcode_locks import PasscodeLockService
+
+    return PasscodeLockService(get_storage(), window_hours=6)
+
+@st.cache_resource
+def get_review_templates():
+    """Per-case review templates; [review_templates] path is where --prerender wrote them."""
+    from review_docs import ReviewTemplateCache
+
+    return ReviewTemplateCache(st.secrets.get("review_templates", {}).get("path"))
+
+@st.cache_resource
+def get_submission_worker():
+    """
+    Background worker for submission side effects (review email, completed exam record,
+    session cleanup). Jobs are kept in [submission_jobs] path and retried with backoff;
+    the completed exam record is retried until it is written.
+    With [review_digest] window_minutes > 0, reviews are mailed as one digest per
+    recipient instead of one email each.
+    """
+    from mailer import SMTPPool
+    from submission_jobs import JobQueue, JobWorker
+
+    smtp_pool = SMTPPool(st.secrets["general"]["email"], st.secrets["general"]["email_password"])
+    queue = JobQueue(st.secrets.get("submission_jobs", {}).get("path", "submission_jobs.sqlite3"))
+    digest = get_review_digest()
+    handlers = {
+        "review_email": functools.partial(
+            send_review_email, case_bank=get_case_bank(), templates=get_review_templates(), smtp_pool=smtp_pool,
+            digest=digest, queue=queue,
+        ),
+        "review_digest": functools.partial(send_review_digests, digest=digest, smtp_pool=smtp_pool),
+        "save_completed": functools.partial(write_completed_exam, storage=get_storage(), case_bank=get_case_bank()),
+        # Sessions are deleted by save_completed now; kept for jobs queued before that.
+        "delete_session": functools.partial(delete_exam_session, storage=get_storage()),
+    }
+    return JobWorker(queue, handlers, attempts_by_kind={"save_completed": None})
+
+@st.cache_resource
+def get_review_digest():
+    """Pending review digests, or None when [review_digest] window_minutes is 0 (the default)."""
+    config = st.secrets.get("review_digest", {})
+    window_minutes = float(config.get("window_minutes", 0))
+    if window_minutes <= 0:
+        return None
+    from review_digest import ReviewDigest
+
+    return ReviewDigest(
+        config.get("path", "review_digest.sqlite3"), window=window_minutes * 60, fmt=config.get("format", "zip")
+    )
+
+@st.cache_resource
+def get_used_case_tracker():
+    from aggregates import designation_of
+    from used_cases import UsedCaseTracker
 
-openai.api_key = st.secrets["openai"]["api_key"]
+    tracker = UsedCaseTracker(get_storage())
+    recipients = st.secrets.get("recipients", {})
+    tracker.start_sweeper({designation_of(p) for p in recipients})
+    return tracker
 
-# Initialize Firebase
-firebase_creds = st.secrets["firebase_service_account"].to_dict()
-if not firebase_admin._apps:
-    cred = credentials.Certificate(firebase_creds)
-    firebase_admin.initialize_app(cred)
-db = firestore.client()
+@st.cache_resource
+def get_case_availability():
+    """
+    Per-designation pools of unused cases; [cases] reserve_batch > 1 reserves that many
+    per transaction and hands the extras to the next students of the designation.
+    """
+    from case_availability import CaseAvailability
+
+    reserve_batch = int(st.secrets.get("cases", {}).get("reserve_batch", 1))
+    return CaseAvailability(get_case_bank(), get_used_case_tracker(), reserve_batch=reserve_batch)
 
 # Session state initialization
 def initialize_state():
@@ -45,8 +204,6 @@ def initialize_state():
                 st.session_state[key] = ""
     if "search_input_key" not in st.session_state:
         st.session_state.search_input_key = 0
-    if "clear_search" not in st.session_state:
-        st.session_state.clear_search = False
 
 def lock_passcode_if_needed():
     passcode_str = str(st.session_state.assigned_passcode).strip()
@@ -56,23 +213,9 @@ def lock_passcode_if_needed():
     if passcode_str.lower() == "password":
         return False  # Allow default password
 
-    doc_ref = db.collection("shelf_records_prioritized").document(passcode_str)
-    now = datetime.datetime.now(datetime.timezone.utc)
-    doc = doc_ref.get()
-    if doc.exists:
-        data = doc.to_dict()
-        ts = data.get("timestamp")
-        if ts is not None:
-            try:
-                ts_dt = ts.to_datetime()
-            except AttributeError:
-                ts_dt = ts.replace(tzinfo=datetime.timezone.utc)
-            if (now - ts_dt).total_seconds() < 6 * 3600:
-                st.session_state.lock_timestamp = ts_dt
-                return True
-    doc_ref.set({"processed": True, "timestamp": firestore.SERVER_TIMESTAMP})
-    st.session_state.lock_timestamp = now
-    return False
+    already_claimed, ts_dt = get_passcode_locks().claim(passcode_str)
+    st.session_state.lock_timestamp = ts_dt
+    return already_claimed
 
     
 def check_and_add_passcode(passcode):
@@ -82,62 +225,11 @@ def check_and_add_passcode(passcode):
     if passcode_str.lower() == "password":
         return False  # Allow default password
     
-    doc_ref = db.collection("shelf_records_prioritized").document(passcode_str)
-    doc = doc_ref.get()
-    now = datetime.datetime.now(datetime.timezone.utc)
-    if doc.exists:
-        data = doc.to_dict()
-        ts = data.get("timestamp")
-        if ts is not None:
-            try:
-                ts_dt = ts.to_datetime()
-            except AttributeError:
-                ts_dt = ts.replace(tzinfo=datetime.timezone.utc)
-            if (now - ts_dt).total_seconds() < 6 * 3600:
-                return True
-    doc_ref.set({"processed": True, "timestamp": firestore.SERVER_TIMESTAMP})
-    return False
-
+    already_claimed, _ = get_passcode_locks().claim(passcode_str)
+    return already_claimed
 
-def send_email_with_attachment(to_emails, subject, body, attachment_path):
-    from_email = st.secrets["general"]["email"]
-    password = st.secrets["general"]["email_password"]
-    msg = MIMEMultipart()
-    msg['From'] = from_email
-    msg['To'] = ', '.join(to_emails)
-    msg['Subject'] = subject
-    msg.attach(MIMEText(body, 'html'))
-    with open(attachment_path, 'rb') as attachment:
-        part = MIMEBase('application', 'octet-stream')
-        part.set_payload(attachment.read())
-        encoders.encode_base64(part)
-        part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(attachment_path))
-        msg.attach(part)
-    try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(from_email, password)
-            server.send_message(msg, from_addr=from_email, to_addrs=to_emails)
-        st.success("Email sent successfully!")
-    except Exception as e:
-        st.error(f"Error sending email: {e}")
-
-def format_physical_exam(pe_text):
-    if not isinstance(pe_text, str):
-        return []
-    pattern = r'([A-Z][a-zA-Z ]+):'
-    parts = re.split(pattern, pe_text)
-    formatted_lines = []
-    for i in range(1, len(parts), 2):
-        label = parts[i].strip()
-        description = parts[i + 1].strip()
-        formatted_lines.append(f"{label}: {description}")
-    return formatted_lines
-
-def safe_text(val):
-    return str(val) if pd.notna(val) else ""
 
-def display_pretty_table(user_order, correct_order):
-    html_table = """
+RESULTS_TABLE_HEAD = """
     <style>
     table.custom-table {
       width: 70%;
@@ -167,105 +259,46 @@ def display_pretty_table(user_order, correct_order):
       </thead>
       <tbody>
     """
-    for i, (ua, ca) in enumerate(zip(user_order, correct_order), start=1):
-        html_table += f"""
+
+@functools.lru_cache(maxsize=1024)
+def results_table_html(user_order, correct_order):
+    rows = "".join(
+        f"""
           <tr>
             <td>{i}</td>
             <td>{ua}</td>
             <td>{ca}</td>
           </tr>
         """
-    html_table += """
+        for i, (ua, ca) in enumerate(zip(user_order, correct_order), start=1)
+    )
+    return RESULTS_TABLE_HEAD + rows + """
       </tbody>
     </table>
     """
-    components.html(html_table, height=250)
-
-def get_used_cases_for_preceptor(designation):
-    """Fetches record_ids used in the last 7 days for a given preceptor designation."""
-    used_cases = []
-    collection_name = "global_used_cases_" + designation if designation else "global_used_cases"
-    used_ref = db.collection(collection_name)
-    docs = used_ref.stream()
-    now = datetime.datetime.utcnow()
-    for doc in docs:
-        data = doc.to_dict()
-        ts = data.get("timestamp")
-        if ts is not None:
-            ts_naive = ts.replace(tzinfo=None)
-            if (now - ts_naive).days < 7:
-                used_cases.append(doc.id)
-            else:
-                doc.reference.delete()
-    return used_cases
-
-def mark_case_as_used_for_preceptor(designation, record_id):
-    """Marks a given record_id as used for the specified preceptor designation."""
-    collection_name = "global_used_cases_" + designation if designation else "global_used_cases"
-    used_ref = db.collection(collection_name)
-    used_ref.document(str(record_id)).set({
-         "used": True,
-         "timestamp": firestore.SERVER_TIMESTAMP
-    })
-
-def generate_review_doc_prioritized(row, user_order, output_filename="review.docx"):
-    doc = Document()
-    doc.add_heading("Review of Incorrect Prioritized Diagnosis", level=1)
-    doc.add_heading(f"Student: {st.session_state.user_name}", level=2)
-    doc.add_heading(f"Case ({row['record_id']}):", level=2)
-    doc.add_paragraph(safe_text(row["anchorx"]))
-    sections = {
-         "Chief Complaint": row.get("cc", ""),
-         "History of Present Illness": row.get("hpi", ""),
-         "Past Medical History": row.get("pmhx", ""),
-         "Medications": row.get("meds", ""),
-         "Allergies": row.get("allergies", ""),
-         "Immunizations": row.get("immunizations", ""),
-         "Social History": row.get("shx", ""),
-         "Family History": row.get("fhx", ""),
-         "Vital Signs": row.get("vs", ""),
-         "Physical Exam": row.get("pe", "")
-    }
-    for title, content in sections.items():
-         if pd.notna(content) and str(content).strip():
-              doc.add_heading(title, level=2)
-              if title == "Physical Exam":
-                  lines = format_physical_exam(content)
-                  for line in lines:
-                      if ":" in line:
-                          label, text = line.split(":", 1)
-                          p = doc.add_paragraph()
-                          run1 = p.add_run(f"{label.strip()}: ")
-                          run1.bold = True
-                          p.add_run(text.strip())
-                      else:
-                          doc.add_paragraph(line)
-              else:
-                  doc.add_paragraph(safe_text(content))
-    doc.add_heading("Student Prioritized Diagnosis:", level=2)
-    for i, diag in enumerate(user_order):
-         doc.add_paragraph(f"{i+1}. {diag}")
-    correct_order = [safe_text(row.get("answer", "")).strip(), 
-                     safe_text(row.get("sec_dx", "")).strip(), 
-                     safe_text(row.get("thir_dx", "")).strip()]
-    doc.add_heading("Correct Prioritized Diagnosis:", level=2)
-    for i, diag in enumerate(correct_order):
-         doc.add_paragraph(f"{i+1}. {diag}")
-    doc.add_heading("Explanation:", level=2)
-    doc.add_paragraph(safe_text(row.get("answer_explanationx", "")))
-    doc.save(output_filename)
-    return output_filename
-
-def get_best_matching_diagnosis(user_input, choices, case_anchor=""):
-    """
-    Uses OpenAI's ChatCompletion API to select the diagnosis from choices that is semantically
-    closest to the user input—even if the input is a partial word.
-    
-    The function uses the provided case context (case_anchor) to guide the decision.
-    If none of the diagnoses appears appropriate, it will return "No suitable match".
-    
-    Returns:
-        A string with the diagnosis exactly as it appears in the choices, or "No suitable match".
+
+def display_pretty_table(user_order, correct_order):
+    import streamlit.components.v1 as components
+
+    components.html(results_table_html(tuple(user_order), tuple(correct_order)), height=250)
+
+def draw_case_for_preceptor(designation):
+    """
+    Picks a random case not used in the last 7 days for the preceptor designation and
+    marks it as used in the same step, so two students cannot draw the same case.
+    Returns its record_id, or None if every case has been used.
+    """
+    with metrics.span("case_draw"):
+        return get_case_availability().draw(designation)
+
+def local_match_threshold():
+    return float(st.secrets.get("matching", {}).get("local_threshold", 0.75))
+
+def fetch_ai_suggestion(openai, user_input, choices, case_anchor, cache, cache_key, timeout):
+    """
+    Asks OpenAI's ChatCompletion API for the diagnosis in choices that best matches the
+    user input and stores the answer in the suggestion cache. Runs on the suggestion
+    service's worker threads, so it raises instead of reporting errors through st.
     """
     # Create a prompt with explicit instructions:
     prompt = (
@@ -278,71 +311,178 @@ def get_best_matching_diagnosis(user_input, choices, case_anchor=""):
         "reply with exactly 'No suitable match'."
     )
 
-    try:
+    started = time.perf_counter()
+    with metrics.span("openai_chat"):
         response = openai.ChatCompletion.create(
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.0,  # Lower temperature for a deterministic response.
+            request_timeout=timeout,
         )
-        answer = response["choices"][0]["message"]["content"].strip()
-        return answer
-    except Exception as e:
-        st.error(f"Error obtaining AI suggestion: {e}")
-        return None
+    answer = response["choices"][0]["message"]["content"].strip()
+    usage = response.get("usage", {})
+    tokens = usage.get("total_tokens", 0)
+    metrics.count("llm_calls")
+    metrics.count("llm_prompt_tokens", usage.get("prompt_tokens", 0))
+    metrics.count("llm_completion_tokens", usage.get("completion_tokens", 0))
+    cache.set(cache_key, answer, latency=time.perf_counter() - started, tokens=tokens)
+    return answer
+
+def get_best_matching_diagnosis(user_input, choices, case_anchor="", record_id=""):
+    """
+    Selects the diagnosis from choices that is semantically closest to the user input—even
+    if the input is a partial word, a typo or an abbreviation.
 
+    The local fuzzy matcher is tried first; OpenAI's ChatCompletion API is only called when
+    its confidence is below st.secrets["matching"]["local_threshold"] (default 0.75).
+    The LLM uses the provided case context (case_anchor) to guide the decision, and its
+    answers are shared through the suggestion cache keyed by record_id, choices and query.
+    If none of the diagnoses appears appropriate, it will return "No suitable match".
 
-def get_clinical_context(row):
-    context_parts = []
-    for field in ["cc", "hpi", "pmhx", "meds", "allergies", "immunizations", "shx", "fhx", "vs", "pe"]:
-        value = row.get(field, "")
-        # Convert the value to a string first so that None becomes "None"
-        # Alternatively, check explicitly for None.
-        if value is not None:
-            value_str = str(value).strip()
-        else:
-            value_str = ""
-        if value_str:
-            context_parts.append(f"{field.upper()}: {value_str}")
-    return " | ".join(context_parts)
+    The LLM call never blocks the rerun: it is scheduled on the suggestion service and
+    None is returned; collect_ai_suggestion() picks the answer up on a later rerun.
+    
+    Returns:
+        A string with the diagnosis exactly as it appears in the choices, "No suitable match",
+        or None while the LLM lookup is pending.
+    """
+    with metrics.span("local_match"):
+        local_match, confidence = get_matcher(tuple(choices)).best(user_input)
+    if local_match and confidence >= local_match_threshold():
+        return local_match
+
+    from suggestion_cache import suggestion_key
+
+    cache = get_suggestion_cache()
+    cache_key = suggestion_key(record_id, choices, user_input)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    timeout = float(ai_suggestion_config().get("timeout_seconds", 8))
+    future = get_suggestion_service().submit(
+        str(st.session_state.assigned_passcode),
+        fetch_ai_suggestion, get_openai(), user_input, list(choices), case_anchor, cache, cache_key, timeout,
+    )
+    st.session_state.ai_suggestion_future = future
+    # The UI gives up a little after the request timeout even if the worker is still busy.
+    st.session_state.ai_suggestion_deadline = time.monotonic() + timeout + get_suggestion_service().debounce + 2
+    return None
 
-def save_prioritized_exam_state():
-    # Save only the fields that are needed to resume the exam.
-    data = {
-        "question_row": st.session_state.question_row,
+def collect_ai_suggestion():
+    """
+    Moves a finished background lookup into st.session_state.ai_suggestion.
+    Returns True while the lookup is still pending.
+    """
+    future = st.session_state.get("ai_suggestion_future")
+    if future is None:
+        return False
+    if not future.done():
+        if time.monotonic() < st.session_state.ai_suggestion_deadline:
+            return True
+        st.warning("The AI suggestion took too long. Please try again.")
+        suggestion = None
+    else:
+        try:
+            suggestion = future.result()
+        except CircuitOpenError as e:
+            st.warning(str(e))
+            suggestion = None
+        except Exception as e:
+            st.error(f"Error obtaining AI suggestion: {e}")
+            suggestion = None
+    get_suggestion_service().discard(str(st.session_state.assigned_passcode), future)
+    del st.session_state.ai_suggestion_future
+    st.session_state.ai_suggestion = suggestion
+    return False
+
+@st.fragment(run_every=0.5)
+def wait_for_ai_suggestion():
+    # Polls without re-running the page; the full rerun happens once the answer is in.
+    future = st.session_state.get("ai_suggestion_future")
+    if future is None or future.done() or time.monotonic() >= st.session_state.ai_suggestion_deadline:
+        st.rerun()
+
+
+# Version 1 documents stored the whole case row under "question_row"; version 2 stores
+# only its record_id and rebuilds the row from the case bank.
+SESSION_SCHEMA_VERSION = 2
+
+def compact_exam_state():
+    return {
+        "schema_version": SESSION_SCHEMA_VERSION,
+        "record_id": str(st.session_state.question_row.get("record_id", "")) if st.session_state.question_row else "",
         "selected_diagnoses": st.session_state.selected_diagnoses,
         "answered": st.session_state.answered,
         "review_sent": st.session_state.review_sent,
         "last_search_query": st.session_state.get("last_search_query", ""),
         "ai_suggestion": st.session_state.get("ai_suggestion", ""),
         # Add additional keys as needed.
-        "timestamp": firestore.SERVER_TIMESTAMP,
     }
+
+def save_prioritized_exam_state():
+    # Save only the fields that are needed to resume the exam.
+    data = compact_exam_state()
+    # Only changed fields are written, batched with other edits from the next few seconds.
     user_key = str(st.session_state.assigned_passcode)
-    db.collection("exam_sessions_prioritized").document(user_key).set(data)
+    with metrics.span("session_save"):
+        get_session_writer().save(user_key, data)
+
+def flush_prioritized_exam_state():
+    get_session_writer().flush(str(st.session_state.assigned_passcode))
+
+def rehydrate_question_row(data):
+    """Returns the case row for a stored session, or "" if the case is no longer available."""
+    record_id = data.get("record_id")
+    if record_id is None and data.get("question_row"):
+        record_id = data["question_row"].get("record_id")
+    case_bank = get_case_bank()
+    case_bank.refresh()
+    case = case_bank.get(record_id) if record_id else None
+    if case is not None:
+        return dict(case.row)
+    # Version 1 documents carry their own copy of the row.
+    return data.get("question_row", "")
+
+def get_current_case():
+    """The compiled Case for st.session_state.question_row."""
+    from case_bank import Case
+
+    row = st.session_state.question_row
+    case = get_case_bank().get(row.get("record_id", ""))
+    # Sessions restored from an old document may reference a case no longer in the bank.
+    return case if case is not None else Case.from_row(row)
 
 def load_prioritized_exam_state():
     user_key = str(st.session_state.assigned_passcode)
-    doc_ref = db.collection("exam_sessions_prioritized").document(user_key)
-    doc = doc_ref.get()
-    if doc.exists:
-        data = doc.to_dict()
-        st.session_state.question_row = data.get("question_row", "")
+    writer = get_session_writer()
+    # Read our own pending writes, e.g. when logging back in from another tab.
+    writer.flush(user_key)
+    data = get_storage().get_session(user_key)
+    if data is not None:
+        st.session_state.question_row = rehydrate_question_row(data)
         st.session_state.selected_diagnoses = data.get("selected_diagnoses", [])
         st.session_state.answered = data.get("answered", False)
         st.session_state.review_sent = data.get("review_sent", False)
         st.session_state.last_search_query = data.get("last_search_query", "")
         st.session_state.ai_suggestion = data.get("ai_suggestion", "")
+        if not st.session_state.question_row:
+            st.session_state.selected_diagnoses = []
+        row = st.session_state.question_row
+        in_bank = bool(row) and row.get("record_id", "") in get_case_bank()
+        # Rewrite old documents once in the compact format, but keep the embedded row of
+        # a case no longer in the bank: it is the only copy left.
+        if data.get("schema_version", 1) < SESSION_SCHEMA_VERSION and in_bank:
+            compact = compact_exam_state()
+            get_storage().save_session(user_key, compact, delete_fields=("question_row",))
+            data = compact
+        writer.remember(user_key, data)
 
 def lock_passcode_on_submission(passcode):
     passcode_str = str(passcode).strip()
     if not passcode_str:
         return
-    doc_ref = db.collection("shelf_records_prioritized").document(passcode_str)
-    doc_ref.set({
-        "processed": True, 
-        "timestamp": firestore.SERVER_TIMESTAMP, 
-        "locked": True
-    })
+    get_passcode_locks().lock(passcode_str)
 
 def is_passcode_locked(passcode):
     """
@@ -353,37 +493,111 @@ def is_passcode_locked(passcode):
     passcode_str = str(passcode).strip()
     if not passcode_str:
         return False
-    doc_ref = db.collection("shelf_records_prioritized").document(passcode_str)
-    doc = doc_ref.get()
-    now = datetime.datetime.now(datetime.timezone.utc)
-    if doc.exists:
-        data = doc.to_dict()
-        if data.get("locked", False):
-            ts = data.get("timestamp")
-            if ts is not None:
-                try:
-                    ts_dt = ts.to_datetime()
-                except AttributeError:
-                    ts_dt = ts.replace(tzinfo=datetime.timezone.utc)
-                if (now - ts_dt).total_seconds() < 6 * 3600:
-                    return True
-    return False
+    return get_passcode_locks().is_locked(passcode_str)
+
+def embed_missing_case(payload, row):
+    """
+    Adds the case row to a job payload when the case is not in the bank, e.g. for a
+    session restored from an old document, so the worker does not need to look it up.
+    """
+    if row and str(row.get("record_id", "")) not in get_case_bank():
+        payload["question_row"] = dict(row)
+    return payload
+
+def case_for_job(payload, case_bank):
+    """The Case a job payload refers to, from the bank or the row embedded in the payload."""
+    from case_bank import Case
+
+    case = case_bank.get(payload["record_id"])
+    if case is None and payload.get("question_row"):
+        case = Case.from_row(payload["question_row"])
+    return case
+
+def send_review_email(payload, case_bank, templates, smtp_pool, digest=None, queue=None):
+    """
+    Job handler: renders the review document in memory and emails it, or with a digest
+    adds it to the recipient's next digest and schedules that digest to be sent.
+    """
+    case = case_for_job(payload, case_bank)
+    if case is None:
+        raise KeyError(f"Case {payload['record_id']} is not in the case bank")
+    from mailer import build_message
+    from review_docs import generate_review_doc_prioritized
+
+    with metrics.span("review_doc"):
+        review = generate_review_doc_prioritized(case, payload["user_order"], payload["student_name"], templates)
+    filename = f"review_{payload['student_name']}_{case.record_id}.docx"
+    if digest is not None:
+        # Jobs queued before digests were enabled have no review id.
+        review_id = payload.get("review_id") or uuid.uuid4().hex
+        digest.add(review_id, payload["to_emails"], payload["student_name"], case.record_id, filename, review)
+        queue.enqueue("review_digest", {}, delay=digest.window)
+        return
+    msg = build_message(
+        smtp_pool.username,
+        payload["to_emails"],
+        subject="Review of Incorrect Prioritized Diagnosis Answer",
+        body="Please find attached a review of your response.",
+        attachments=[(filename, review)],
+    )
+    with metrics.span("smtp_send"):
+        smtp_pool.send(msg, payload["to_emails"])
+
+def send_review_digests(payload, digest, smtp_pool):
+    """Job handler: mails every digest whose window has passed; a no-op if none has."""
+    everything = digest is None
+    if digest is None:
+        # Digests were turned off with reviews still pending: send what is left now.
+        from review_digest import ReviewDigest
+
+        config = st.secrets.get("review_digest", {})
+        digest = ReviewDigest(config.get("path", "review_digest.sqlite3"), fmt=config.get("format", "zip"))
+    with metrics.span("smtp_send"):
+        sent = digest.flush(smtp_pool, everything=everything)
+    metrics.count("review_digests_sent", sent)
+
+def write_completed_exam(payload, storage, case_bank):
+    """
+    Job handler: the submission id is the record id, so retries do not duplicate it
+    or count it twice in the case and designation counters. The in-progress session is
+    deleted only once the completed exam is stored, so a failed write never loses it.
+    """
+    import aggregates
+
+    completed_data = {
+        "passcode": payload["passcode"],
+        "student_name": payload["student_name"],
+        "record_id": payload["record_id"],
+        "selected_diagnoses": payload["selected_diagnoses"],
+        "submitted_at": datetime.datetime.fromisoformat(payload["submitted_at"]),
+    }
+    case = case_for_job(payload, case_bank)
+    correct = aggregates.is_correct(case, payload["selected_diagnoses"]) if case is not None else None
+    counters = aggregates.completed(aggregates.designation_of(payload["passcode"]), payload["record_id"], correct)
+    storage.add_completed_exam(payload["submission_id"], completed_data, counters)
+    storage.delete_session(payload["passcode"])
+
+def delete_exam_session(payload, storage):
+    """Job handler: removes the in-progress session record."""
+    storage.delete_session(payload["passcode"])
 
 def save_completed_exam():
     """
-    Saves the completed exam details permanently in Firestore.
+    Saves the completed exam details permanently in storage.
     Stores the passcode used, record_id of the question, student name, answers provided,
-    and a timestamp.
+    and a timestamp. The write is queued on the submission worker, which then deletes
+    the in-progress session.
     """
     user_key = str(st.session_state.assigned_passcode)
-    completed_data = {
+    row = st.session_state.question_row
+    get_submission_worker().enqueue("save_completed", embed_missing_case({
+        "submission_id": uuid.uuid4().hex,
         "passcode": user_key,
         "student_name": st.session_state.user_name,
-        "record_id": st.session_state.question_row.get("record_id", ""),
+        "record_id": str(row.get("record_id", "")),
         "selected_diagnoses": st.session_state.selected_diagnoses,
-        "timestamp": firestore.SERVER_TIMESTAMP,
-    }
-    db.collection("completed_exam_sessions").document().set(completed_data)
+        "submitted_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }, row))
     
 # Login Screen
 def login_screen():
@@ -405,7 +619,9 @@ def login_screen():
             st.error("Please enter your name.")
             return
 
-        if is_passcode_locked(passcode_input.strip()):
+        with metrics.span("passcode_check"):
+            locked = is_passcode_locked(passcode_input.strip())
+        if locked:
             st.error("This passcode has been used recently. Please try again after 6 hours.")
             st.stop() 
             
@@ -414,7 +630,8 @@ def login_screen():
         st.session_state.recipient_email = st.secrets["recipients"][passcode_input]
         st.session_state.authenticated = True
 
-        load_prioritized_exam_state()
+        with metrics.span("load_session"):
+            load_prioritized_exam_state()
         
         st.rerun()
 
@@ -435,78 +652,107 @@ def exam_screen_prioritized():
 
     # 1) LOAD A RANDOM CASE IF NOT ALREADY LOADED
     if not st.session_state.question_row:
-        csv_files = glob.glob("*.csv")
-        #csv_files = [file for file in csv_files if "prioritized" in file.lower()]
-        df_list = [pd.read_csv(file) for file in csv_files]
-        df = pd.concat(df_list, ignore_index=True)
+        case_bank = get_case_bank()
+        with metrics.span("case_bank_refresh"):
+            case_bank.refresh()
+
+        from aggregates import designation_of
 
         # Extract designation from password (e.g., password1_aaa yields "aaa")
-        password = st.session_state.assigned_passcode
-        designation = password.split("_")[-1] if "_" in password else ""
+        designation = designation_of(st.session_state.assigned_passcode)
 
-        used_cases = get_used_cases_for_preceptor(designation)
-        available_df = df[~df["record_id"].isin(used_cases)]
+        record_id = draw_case_for_preceptor(designation)
 
-        if available_df.empty:
+        if record_id is None:
             st.error("No further cases available for your preceptor at this time. Please try again later.")
             st.stop()
             
-        # Sample one case from the available cases
-        selected = available_df.sample(1).iloc[0].to_dict()
+        selected = dict(case_bank.get(record_id).row)
         st.session_state.question_row = selected
         st.session_state.selected_diagnoses = []
         st.session_state.search_input = ""
         st.session_state.answered = False
         st.session_state.review_sent = False
-
-        mark_case_as_used_for_preceptor(designation, selected["record_id"])
         
-    row = st.session_state.question_row
+    case = get_current_case()
 
     # 2) SIDEBAR: Display clinical information in collapsible sections
-    with st.sidebar:
+    with metrics.span("sidebar"), st.sidebar:
         st.header("Clinical Information")
-        label_map = {
-            "cc": "Chief Complaint",
-            "hpi": "History of Present Illness",
-            "pmhx": "Past Medical History",
-            "meds": "Medications",
-            "allergies": "Allergies",
-            "immunizations": "Immunizations",
-            "shx": "Social History",
-            "fhx": "Family History",
-            "vs": "Vital Signs",
-            "pe": "Physical Exam",
-        }
-        for key, display_label in label_map.items():
-            content = row.get(key, "")
-            if pd.notna(content) and str(content).strip():
-                with st.expander(display_label, expanded=False):
-                    if key == "pe":
-                        lines = format_physical_exam(content)
-                        for line in lines:
-                            st.markdown(f"- {line}")
-                    else:
-                        st.write(content)
+        for display_label, markdown in sidebar_sections(case.record_id, case.fingerprint, case):
+            with st.expander(display_label, expanded=False):
+                st.markdown(markdown)
 
     # 3) MAIN PROMPT
-    st.subheader(row.get("anchorx", "Please select and prioritize 3 diagnoses:"))
+    st.subheader(case.row.get("anchorx", "Please select and prioritize 3 diagnoses:"))
     st.write("Type to search for a diagnosis, then click to add it to your prioritized list. You can reorder or remove items as needed.")
-    
+
+    # 4-6) Search, prioritized list and submission rerun on their own.
+    diagnosis_panel(case)
+
+SIDEBAR_LABELS = {
+    "cc": "Chief Complaint",
+    "hpi": "History of Present Illness",
+    "pmhx": "Past Medical History",
+    "meds": "Medications",
+    "allergies": "Allergies",
+    "immunizations": "Immunizations",
+    "shx": "Social History",
+    "fhx": "Family History",
+    "vs": "Vital Signs",
+    "pe": "Physical Exam",
+}
+
+@st.cache_resource(max_entries=512)
+def sidebar_sections(record_id, fingerprint, _case):
+    """(label, markdown) per non-empty clinical section, built once per case."""
+    from case_bank import safe_text
+
+    sections = []
+    for key, display_label in SIDEBAR_LABELS.items():
+        content = _case.row.get(key, "")
+        if safe_text(content).strip():
+            if key == "pe":
+                markdown = "\n".join(f"- {label}: {description}" for label, description in _case.pe_lines)
+            else:
+                markdown = str(content)
+            sections.append((display_label, markdown))
+    return tuple(sections)
+
+def add_diagnosis(diagnosis):
+    if diagnosis not in st.session_state.selected_diagnoses:
+        st.session_state.selected_diagnoses.append(diagnosis)
+    st.session_state.diag_search_input = ""
+    save_prioritized_exam_state()
+
+def move_diagnosis(i, j):
+    selected = st.session_state.selected_diagnoses
+    selected[i], selected[j] = selected[j], selected[i]
+    save_prioritized_exam_state()
+
+def remove_diagnosis(i):
+    st.session_state.selected_diagnoses.pop(i)
+    save_prioritized_exam_state()
+
+@st.fragment
+def diagnosis_panel(case):
+    """
+    Search box, match buttons, prioritized list and submit button. Clicks here only rerun
+    this fragment, so the sidebar and case text are not rebuilt on every edit.
+    """
+    # Counted as its own rerun when the fragment runs alone.
+    with metrics.rerun("diagnosis_panel"):
+        render_diagnosis_panel(case)
+
+def render_diagnosis_panel(case):
     # 4) DIAGNOSIS SEARCH INPUT
-    if st.session_state.get("clear_search", False):
-        search_input = st.text_input("Type diagnosis:", value="", key="diag_search_input")
-        st.session_state.clear_search = False
-    else:
-        search_input = st.text_input("Type diagnosis:", key="diag_search_input")
-    
-    # Parse the list of possible diagnoses.
-    all_choices = [c.strip() for c in str(row.get("choices", "")).split(",")]
+    search_input = st.text_input("Type diagnosis:", key="diag_search_input")
     
     # Only proceed if the user has typed at least 2 characters.
     if len(search_input) >= 2:
         # Try simple substring matching first.
-        matches = [c for c in all_choices if search_input.lower() in c.lower()]
+        query = search_input.lower()
+        matches = [c for c, key in zip(case.choices, case.choice_keys) if query in key]
     else:
         matches = []
     
@@ -514,30 +760,25 @@ def exam_screen_prioritized():
         st.write("Matching diagnoses:")
         for match in matches:
             if match not in st.session_state.selected_diagnoses:
-                if st.button(f"➕ {match}", key=f"match_{match}"):
-                    st.session_state.selected_diagnoses.append(match)
-                    st.session_state.clear_search = True
-                    save_prioritized_exam_state() 
-                    st.rerun()
+                st.button(f"➕ {match}", key=f"match_{match}", on_click=add_diagnosis, args=(match,))
     # Only try AI suggestion if search_input is not empty and no matches were found.
     elif search_input:  
         last_query = st.session_state.get("last_search_query", "")
         if last_query != search_input:
-            case_context = get_clinical_context(row)  # Use your function to build context, if desired.
-            ai_suggestion = get_best_matching_diagnosis(search_input, all_choices, case_anchor=case_context)
-            st.session_state["ai_suggestion"] = ai_suggestion
+            st.session_state.pop("ai_suggestion_future", None)
+            st.session_state["ai_suggestion"] = get_best_matching_diagnosis(
+                search_input, case.choices, case_anchor=case.clinical_context, record_id=case.record_id
+            )
             st.session_state["last_search_query"] = search_input
-        else:
-            ai_suggestion = st.session_state.get("ai_suggestion", None)
+        pending = collect_ai_suggestion()
+        ai_suggestion = st.session_state.get("ai_suggestion", None)
         
-        if ai_suggestion and ai_suggestion != "No suitable match":
+        if pending:
+            st.write("Looking for a matching diagnosis…")
+            wait_for_ai_suggestion()
+        elif ai_suggestion and ai_suggestion != "No suitable match":
             st.write("Possible Diagnosis: " + ai_suggestion)
-            if st.button(f"➕ {ai_suggestion}", key="ai_suggestion_btn"):
-                if ai_suggestion not in st.session_state.selected_diagnoses:
-                    st.session_state.selected_diagnoses.append(ai_suggestion)
-                    st.session_state.clear_search = True
-                    save_prioritized_exam_state()
-                    st.rerun()
+            st.button(f"➕ {ai_suggestion}", key="ai_suggestion_btn", on_click=add_diagnosis, args=(ai_suggestion,))
         else:
             st.write("No suggestion available for the entered input.")
             
@@ -552,33 +793,21 @@ def exam_screen_prioritized():
             st.write(f"{i+1}. {diag}")
         with col2:
             if i > 0:
-                if st.button(arrow_up, key=f"up_{i}"):
-                    st.session_state.selected_diagnoses[i], st.session_state.selected_diagnoses[i-1] = \
-                        st.session_state.selected_diagnoses[i-1], st.session_state.selected_diagnoses[i]
-                    save_prioritized_exam_state()
-                    st.rerun()
+                st.button(arrow_up, key=f"up_{i}", on_click=move_diagnosis, args=(i, i - 1))
         with col3:
             if i < len(st.session_state.selected_diagnoses) - 1:
-                if st.button(arrow_down, key=f"down_{i}"):
-                    st.session_state.selected_diagnoses[i], st.session_state.selected_diagnoses[i+1] = \
-                        st.session_state.selected_diagnoses[i+1], st.session_state.selected_diagnoses[i]
-                    save_prioritized_exam_state()
-                    st.rerun()
+                st.button(arrow_down, key=f"down_{i}", on_click=move_diagnosis, args=(i, i + 1))
         with col4:
-            if st.button(trash_icon, key=f"remove_{i}"):
-                st.session_state.selected_diagnoses.pop(i)
-                save_prioritized_exam_state()
-                st.rerun()
+            st.button(trash_icon, key=f"remove_{i}", on_click=remove_diagnosis, args=(i,))
 
     # 6) SUBMISSION: Only if exactly 3 diagnoses are selected
     if len(st.session_state.selected_diagnoses) == 3 and not st.session_state.answered:
         if st.button("Submit Answer"):
             st.session_state.answered = True
-            correct_order = [
-                safe_text(row.get("answer", "")).strip(),
-                safe_text(row.get("sec_dx", "")).strip(),
-                safe_text(row.get("thir_dx", "")).strip(),
-            ]
+            # Persist the final answer before any other side effect of submitting.
+            save_prioritized_exam_state()
+            flush_prioritized_exam_state()
+            correct_order = list(case.correct_order)
             user_order = [diag.strip() for diag in st.session_state.selected_diagnoses]
             st.write("**Your Prioritized Diagnosis:**")
             display_pretty_table(user_order, correct_order)
@@ -589,34 +818,43 @@ def exam_screen_prioritized():
                 st.success("Correct!")
             else:
                 st.error("Incorrect.")
-                st.info(row.get("answer_explanationx", ""))
+                st.info(case.row.get("answer_explanationx", ""))
                 if not st.session_state.review_sent:
-                    filename = f"review_{st.session_state.user_name}_{row['record_id']}.docx"
-                    generate_review_doc_prioritized(row, user_order, filename)
-                    send_email_with_attachment(
-                        to_emails=[st.session_state.recipient_email],
-                        subject="Review of Incorrect Prioritized Diagnosis Answer",
-                        body="Please find attached a review of your response.",
-                        attachment_path=filename
-                    )
+                    # Built and mailed by the submission worker, so the mail server never delays this page.
+                    get_submission_worker().enqueue("review_email", embed_missing_case({
+                        "review_id": uuid.uuid4().hex,
+                        "record_id": case.record_id,
+                        "student_name": st.session_state.user_name,
+                        "user_order": user_order,
+                        "to_emails": [st.session_state.recipient_email],
+                    }, case.row))
                     st.session_state.review_sent = True
+                    st.info("A review of your response will be emailed to you shortly.")
             st.success("Case complete. Thank you for your response. You may now close the window.")
 
+            # Pending session saves are dropped first, so none lands after the session is deleted.
+            get_session_writer().discard(str(st.session_state.assigned_passcode))
             save_completed_exam()
             
-            user_key = str(st.session_state.assigned_passcode)
-            db.collection("exam_sessions_prioritized").document(user_key).delete()
-            
     elif len(st.session_state.selected_diagnoses) != 3 and not st.session_state.answered:
         st.info(f"Please select exactly 3 diagnoses. You have selected {len(st.session_state.selected_diagnoses)}.")
 
 # Main App Logic
 def main():
-    initialize_state()
-    if not st.session_state.authenticated:
-        login_screen()
-    else:
-        exam_screen_prioritized()
+    configure_metrics()
+    load_diagnosis_aliases()
+    with metrics.rerun("page"):
+        initialize_state()
+        if not st.session_state.authenticated:
+            with metrics.span("login_screen"):
+                login_screen()
+        else:
+            with metrics.span("exam_screen"):
+                exam_screen_prioritized()
+    startup_timing.mark("first_paint")
+    startup_timing.report()
+    # Started after the page is drawn; it also resumes jobs left by a previous process.
+    get_submission_worker()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,240 @@
+"""
+In-process fuzzy matching of a typed query against a case's diagnosis choices.
+
+Each choice is indexed together with its aliases (abbreviations in parentheses,
+initialisms and the SYNONYMS table below). A query is scored against every alias by
+token edit distance, prefix matching and character trigram overlap, giving a
+confidence in [0, 1] so the caller can decide whether an LLM lookup is still needed.
+The token score is scaled down by how little of the alias the query covers, so one
+word of a long alias ("lymph" for "mucocutaneous lymph node syndrome") is not taken
+as a confident match.
+
+use_aliases() adds the alias table precomputed by precompute_aliases.py to SYNONYMS
+for every matcher built afterwards.
+"""
+import functools
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Format of the alias artifact written by precompute_aliases.py.
+ALIAS_FORMAT = 1
+
+# Common abbreviations and lay terms, keyed by normalized alias.
+SYNONYMS = {
+    "uti": ["urinary tract infection"],
+    "aom": ["acute otitis media"],
+    "om": ["otitis media"],
+    "ear infection": ["otitis media", "acute otitis media"],
+    "swimmers ear": ["otitis externa"],
+    "uri": ["upper respiratory infection", "viral upper respiratory infection"],
+    "urti": ["upper respiratory infection", "viral upper respiratory infection"],
+    "common cold": ["viral upper respiratory infection"],
+    "kd": ["kawasaki disease"],
+    "mucocutaneous lymph node syndrome": ["kawasaki disease"],
+    "mono": ["infectious mononucleosis"],
+    "ebv": ["infectious mononucleosis"],
+    "strep throat": ["streptococcal pharyngitis"],
+    "gas pharyngitis": ["streptococcal pharyngitis"],
+    "pta": ["peritonsillar abscess"],
+    "rpa": ["retropharyngeal abscess"],
+    "tb": ["tuberculosis"],
+    "flu": ["influenza"],
+    "pna": ["pneumonia", "bacterial pneumonia"],
+    "rsv": ["bronchiolitis"],
+    "fb": ["foreign body"],
+    "hhv6": ["roseola"],
+    "sixth disease": ["roseola"],
+    "exanthem subitum": ["roseola"],
+    "rubeola": ["measles"],
+    "scarlatina": ["scarlet fever"],
+    "gastro": ["gastroenteritis"],
+    "age": ["gastroenteritis"],
+    "sinus infection": ["sinusitis"],
+    "iem": ["congenital metabolic disorder"],
+    "inborn error of metabolism": ["congenital metabolic disorder"],
+    "bacteremia": ["occult bacteremia"],
+    "septicemia": ["sepsis"],
+}
+
+# Words that do not tell diagnoses apart; a query need not cover them.
+GENERIC_TOKENS = frozenset({"disease", "syndrome", "disorder", "infection", "of", "in", "the", "and", "with"})
+
+# SYNONYMS plus any precomputed aliases; see use_aliases().
+_synonyms = SYNONYMS
+
+_NON_WORD = re.compile(r"[^a-z0-9 ]+")
+_PARENTHETICAL = re.compile(r"\(([^)]*)\)")
+
+
+def normalize(text):
+    text = str(text).lower().replace("'", "")
+    return " ".join(_NON_WORD.sub(" ", text).split())
+
+
+def diagnosis_name(choice):
+    """The normalized name of a choice without its parenthetical abbreviation."""
+    return normalize(_PARENTHETICAL.sub(" ", choice))
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _edit_distance(a, b, limit):
+    """Levenshtein distance, or limit + 1 as soon as it is known to exceed limit."""
+    if len(a) < len(b):
+        a, b = b, a
+    if len(a) - len(b) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        row_min = i
+        for j, cb in enumerate(b, start=1):
+            cost = previous[j - 1] if ca == cb else previous[j - 1] + 1
+            if previous[j] + 1 < cost:
+                cost = previous[j] + 1
+            if current[j - 1] + 1 < cost:
+                cost = current[j - 1] + 1
+            current.append(cost)
+            if cost < row_min:
+                row_min = cost
+        if row_min > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+@functools.lru_cache(maxsize=65536)
+def _token_similarity(query_token, token):
+    if query_token == token:
+        return 1.0
+    # Partial words ("kawa") are prefixes of the intended token.
+    if len(query_token) >= 3 and token.startswith(query_token):
+        return 0.85 + 0.15 * len(query_token) / len(token)
+    longest = max(len(query_token), len(token))
+    # Pairs more than half a word apart are scored 0 rather than computed exactly.
+    limit = longest // 2
+    distance = _edit_distance(query_token, token, limit)
+    return 0.0 if distance > limit else 1.0 - distance / longest
+
+
+class DiagnosisMatcher:
+    def __init__(self, choices, synonyms=None):
+        synonyms = _synonyms if synonyms is None else synonyms
+        self.choices = [c for c in choices if c]
+        # (choice, alias, alias tokens, tokens counted for coverage, alias trigrams)
+        self._entries = []
+        vocabulary = set()
+        for choice in self.choices:
+            for alias in self._aliases(choice, synonyms):
+                tokens = alias.split()
+                key_tokens = [t for t in tokens if t not in GENERIC_TOKENS] or tokens
+                vocabulary.update(tokens)
+                self._entries.append((choice, alias, tokens, key_tokens, _trigrams(alias)))
+        self._vocabulary = tuple(vocabulary)
+
+    @staticmethod
+    def _aliases(choice, synonyms):
+        name = diagnosis_name(choice)
+        aliases = {normalize(choice), name}
+        aliases.update(normalize(p) for p in _PARENTHETICAL.findall(choice))
+        words = name.split()
+        if len(words) > 1:
+            aliases.add("".join(w[0] for w in words))
+        for alias, targets in synonyms.items():
+            if any(normalize(t) == name for t in targets):
+                aliases.add(normalize(alias))
+        aliases.discard("")
+        return aliases
+
+    @staticmethod
+    def _score(query, query_tokens, query_trigrams, similarities, alias, tokens, key_tokens, trigrams):
+        if query == alias:
+            return 1.0
+        weight = sum(len(t) for t in query_tokens)
+        token_score = sum(
+            len(qt) * max(similarities[qt][t] for t in tokens) for qt in query_tokens
+        ) / weight
+        # Penalize queries that only cover part of a multi-word alias: the share of its
+        # distinctive characters in tokens that some query token matches at all.
+        covered = sum(len(t) for t in key_tokens if any(similarities[qt][t] for qt in query_tokens))
+        token_score *= 0.65 + 0.35 * covered / sum(len(t) for t in key_tokens)
+        dice = 2 * len(query_trigrams & trigrams) / (len(query_trigrams) + len(trigrams))
+        return max(token_score, dice)
+
+    def match(self, query, limit=5):
+        """Returns up to limit (choice, confidence) pairs, best first."""
+        query = normalize(query)
+        if not query:
+            return []
+        query_tokens = query.split()
+        query_trigrams = _trigrams(query)
+        # Each query token is compared with each distinct choice token only once.
+        similarities = {
+            qt: {t: _token_similarity(qt, t) for t in self._vocabulary} for qt in set(query_tokens)
+        }
+        best = {}
+        for choice, alias, tokens, key_tokens, trigrams in self._entries:
+            score = self._score(query, query_tokens, query_trigrams, similarities, alias, tokens, key_tokens, trigrams)
+            if score > best.get(choice, 0.0):
+                best[choice] = score
+        ranked = sorted(best.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:limit]
+
+    def best(self, query, margin=0.05):
+        """
+        Returns (choice, confidence) for the top match. Returns (None, confidence) when
+        nothing matched or the runner-up is within margin, so the match is ambiguous.
+        """
+        ranked = self.match(query, limit=2)
+        if not ranked:
+            return None, 0.0
+        choice, confidence = ranked[0]
+        if len(ranked) > 1 and confidence - ranked[1][1] < margin:
+            return None, confidence
+        return choice, confidence
+
+
+@functools.lru_cache(maxsize=256)
+def get_matcher(choices):
+    """Returns a shared matcher for a tuple of choices."""
+    return DiagnosisMatcher(choices)
+
+
+def read_alias_artifact(path):
+    """Returns the artifact at path, or None if it is missing or of another format."""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as fh:
+        artifact = json.load(fh)
+    if artifact.get("format") != ALIAS_FORMAT:
+        logger.warning("Ignoring alias table %s: format %s, expected %s", path, artifact.get("format"), ALIAS_FORMAT)
+        return None
+    return artifact
+
+
+def use_aliases(path):
+    """
+    Merges the alias table at path into the synonyms of matchers built from now on.
+    Returns the table's version, or None if there was no usable table.
+    """
+    global _synonyms
+    artifact = read_alias_artifact(path)
+    if artifact is None:
+        return None
+    synonyms = {alias: list(targets) for alias, targets in SYNONYMS.items()}
+    for diagnosis, aliases in artifact["aliases"].items():
+        for alias in aliases:
+            targets = synonyms.setdefault(alias, [])
+            if diagnosis not in targets:
+                targets.append(diagnosis)
+    _synonyms = synonyms
+    get_matcher.cache_clear()
+    logger.info("Loaded %d precomputed aliases (version %s)", len(synonyms) - len(SYNONYMS), artifact["version"])
+    return artifact["version"]
@@ -0,0 +1,147 @@
+"""
+Exports completed exams to date-partitioned CSV or Parquet files.
+
+Completed exams are read a page at a time in (timestamp, id) order, joined with the
+case bank for the correct order, and written as one file per page and submission
+date under `<out>/submitted_date=YYYY-MM-DD/`. Memory use is bounded by the page size.
+After each page a checkpoint records the cursor, so the next run only fetches exams
+submitted since:
+
+    python export_completed.py --out exports/completed --format parquet
+
+File names are derived from the first record of their page, so a page re-exported
+after a crash between writing it and saving the checkpoint replaces its own files
+instead of duplicating rows.
+"""
+import argparse
+import datetime
+import json
+import os
+
+from aggregates import designation_of
+from storage import BATCH_SIZE
+
+COLUMNS = [
+    "submission_id", "passcode", "designation", "student_name", "record_id",
+    "dx_1", "dx_2", "dx_3", "correct_1", "correct_2", "correct_3",
+    "case_found", "exact_match", "submitted_at", "stored_at",
+]
+
+
+def flatten(submission_id, data, case_bank):
+    case = case_bank.get(data.get("record_id", ""))
+    selected = [str(d).strip() for d in data.get("selected_diagnoses", [])][:3]
+    selected += [""] * (3 - len(selected))
+    correct = list(case.correct_order) if case is not None else ["", "", ""]
+    submitted_at = data.get("submitted_at") or data["timestamp"]
+    return {
+        "submission_id": submission_id,
+        "passcode": data.get("passcode", ""),
+        "designation": designation_of(data.get("passcode", "")),
+        "student_name": data.get("student_name", ""),
+        "record_id": data.get("record_id", ""),
+        "dx_1": selected[0], "dx_2": selected[1], "dx_3": selected[2],
+        "correct_1": correct[0], "correct_2": correct[1], "correct_3": correct[2],
+        "case_found": case is not None,
+        "exact_match": case is not None and selected == correct,
+        "submitted_at": submitted_at.isoformat(),
+        "stored_at": data["timestamp"].isoformat(),
+    }
+
+
+def load_checkpoint(path):
+    """Returns the (timestamp, id) cursor and export count saved at path, or (None, 0)."""
+    if not os.path.exists(path):
+        return None, 0
+    with open(path) as fh:
+        saved = json.load(fh)
+    return (datetime.datetime.fromisoformat(saved["timestamp"]), saved["id"]), saved.get("exported", 0)
+
+
+def save_checkpoint(path, cursor, exported):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fh:
+        json.dump({
+            "timestamp": cursor[0].isoformat(),
+            "id": cursor[1],
+            "exported": exported,
+            "updated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }, fh)
+    os.replace(tmp, path)
+
+
+def write_page(rows, first, out_dir, fmt):
+    """Writes rows, grouped by submission date, to one file per date. Returns the paths."""
+    import pandas as pd
+
+    ts, sid = first
+    name = f"part-{int(ts.timestamp() * 1_000_000)}-{sid[:16]}.{fmt}"
+    partitions = {}
+    for row in rows:
+        partitions.setdefault(row["submitted_at"][:10], []).append(row)
+    paths = []
+    for day, day_rows in sorted(partitions.items()):
+        directory = os.path.join(out_dir, f"submitted_date={day}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+        tmp = path + ".tmp"
+        df = pd.DataFrame(day_rows, columns=COLUMNS)
+        if fmt == "parquet":
+            df.to_parquet(tmp, index=False)
+        else:
+            df.to_csv(tmp, index=False)
+        os.replace(tmp, path)
+        paths.append(path)
+    return paths
+
+
+def export(storage, case_bank, out_dir, fmt="csv", checkpoint=None, page_size=BATCH_SIZE, log=print):
+    """Exports every completed exam after the checkpoint. Returns the number exported."""
+    checkpoint = checkpoint or os.path.join(out_dir, "_checkpoint.json")
+    os.makedirs(out_dir, exist_ok=True)
+    cursor, total = load_checkpoint(checkpoint)
+    exported = 0
+    while True:
+        page = storage.list_completed_exams(after=cursor, limit=page_size)
+        if not page:
+            break
+        rows = [flatten(sid, data, case_bank) for sid, data in page]
+        first = (page[0][1]["timestamp"], page[0][0])
+        paths = write_page(rows, first, out_dir, fmt)
+        cursor = (page[-1][1]["timestamp"], page[-1][0])
+        exported += len(rows)
+        save_checkpoint(checkpoint, cursor, total + exported)
+        log(f"exported {len(rows)} exams to {len(paths)} file(s), through {cursor[0].isoformat()}")
+        if len(page) < page_size:
+            break
+    return exported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <out>/_checkpoint.json)")
+    parser.add_argument("--page-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--secrets", default=".streamlit/secrets.toml", help="app secrets with [storage]")
+    parser.add_argument("--cases-dir", default=".")
+    args = parser.parse_args(argv)
+
+    if args.format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.error("--format parquet needs pyarrow installed")
+
+    from case_bank import CaseBank
+    from storage import open_storage_from_secrets
+
+    count = export(
+        open_storage_from_secrets(args.secrets), CaseBank(args.cases_dir), args.out,
+        args.format, args.checkpoint, args.page_size,
+    )
+    print(f"{count} new completed exams exported to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
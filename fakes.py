@@ -0,0 +1,160 @@
+"""
+In-process stand-ins for the app's external services, for benchmarks and load tests.
+
+- Storage: the "memory" backend from storage.py ([storage] backend = "memory").
+- OpenAI: FakeChatCompletion answers with the closest listed diagnosis (or, for
+  precompute_aliases.py, with made-up abbreviations) after an injected latency and
+  reports token usage like the real endpoint.
+- SMTP: FakeSMTP accepts logins and messages after an injected latency and keeps
+  what was sent.
+
+install() patches openai.ChatCompletion.create and smtplib.SMTP_SSL in this process;
+app_secrets() builds the st.secrets the app needs to run against the fakes.
+"""
+import difflib
+import json
+import random
+import re
+import smtplib
+import threading
+import time
+
+_CHOICES = re.compile(r"list of possible diagnoses: (.*?)\. The clinical scenario")
+_QUERY = re.compile(r'has typed in the query: "(.*?)"\.')
+_ALIAS_DIAGNOSES = re.compile(r"Diagnoses: (\[.*\])$", re.S)
+
+
+def _sleep(latency, jitter):
+    if latency or jitter:
+        time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+
+class FakeChatCompletion:
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.tokens = 0
+
+    @staticmethod
+    def _aliases(diagnoses):
+        """Initialisms and parenthesized abbreviations, as JSON like the alias prompt asks for."""
+        replies = {}
+        for diagnosis in diagnoses:
+            words = re.sub(r"\(.*?\)", " ", diagnosis).split()
+            aliases = re.findall(r"\((.*?)\)", diagnosis)
+            if len(words) > 1:
+                aliases.append("".join(w[0] for w in words).upper())
+            replies[diagnosis] = aliases
+        return json.dumps(replies)
+
+    def create(self, model=None, messages=(), **kwargs):
+        prompt = messages[-1]["content"] if messages else ""
+        alias_match = _ALIAS_DIAGNOSES.search(prompt)
+        if alias_match:
+            answer = self._aliases(json.loads(alias_match.group(1)))
+        else:
+            choices_match = _CHOICES.search(prompt)
+            query_match = _QUERY.search(prompt)
+            choices = choices_match.group(1).split(", ") if choices_match else []
+            query = query_match.group(1).lower() if query_match else ""
+            scored = [(difflib.SequenceMatcher(None, query, c.lower()).ratio(), c) for c in choices]
+            score, answer = max(scored, default=(0.0, ""))
+            if score < 0.3:
+                answer = "No suitable match"
+        _sleep(self.latency, self.jitter)
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = max(1, len(answer) // 4)
+        with self._lock:
+            self.calls += 1
+            self.tokens += prompt_tokens + completion_tokens
+        return {
+            "choices": [{"message": {"role": "assistant", "content": answer}}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+
+class FakeSMTP:
+    """Used in place of smtplib.SMTP_SSL; connections share the class-level counters."""
+
+    latency = 0.0
+    connections = 0
+    logins = 0
+    sent = []
+    _lock = threading.Lock()
+
+    def __init__(self, host=None, port=None, timeout=None, **kwargs):
+        _sleep(self.latency, 0.0)
+        with self._lock:
+            FakeSMTP.connections += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.quit()
+        return False
+
+    def login(self, username, password):
+        _sleep(self.latency, 0.0)
+        with self._lock:
+            FakeSMTP.logins += 1
+
+    def noop(self):
+        return (250, b"OK")
+
+    def send_message(self, msg, from_addr=None, to_addrs=None, **kwargs):
+        _sleep(self.latency, 0.0)
+        with self._lock:
+            FakeSMTP.sent.append((to_addrs, msg["Subject"], len(msg.as_bytes())))
+
+    def sendmail(self, from_addr, to_addrs, msg, **kwargs):
+        _sleep(self.latency, 0.0)
+        with self._lock:
+            FakeSMTP.sent.append((to_addrs, None, len(msg)))
+
+    def quit(self):
+        pass
+
+    close = quit
+
+    @classmethod
+    def reset(cls, latency=0.0):
+        with cls._lock:
+            cls.latency = latency
+            cls.connections = 0
+            cls.logins = 0
+            cls.sent = []
+
+
+def install(llm_latency=0.0, llm_jitter=0.0, smtp_latency=0.0):
+    """Routes the app's OpenAI and SMTP calls to fakes. Returns the FakeChatCompletion."""
+    import openai
+
+    chat = FakeChatCompletion(llm_latency, llm_jitter)
+    openai.ChatCompletion.create = staticmethod(chat.create)
+    FakeSMTP.reset(smtp_latency)
+    smtplib.SMTP_SSL = FakeSMTP
+    return chat
+
+
+def app_secrets(recipients, jobs_path, **overrides):
+    """
+    st.secrets for running the app against the fakes. recipients maps passcode to email;
+    overrides replace or add whole sections.
+    """
+    secrets = {
+        "openai": {"api_key": "fake"},
+        "general": {"email": "exams@example.com", "email_password": "fake"},
+        "recipients": dict(recipients),
+        "storage": {"backend": "memory"},
+        "suggestion_cache": {"tier": "memory"},
+        "submission_jobs": {"path": jobs_path},
+    }
+    secrets.update(overrides)
+    return secrets
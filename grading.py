@@ -0,0 +1,134 @@
+"""
+Batch grading of completed exams with partial-credit ranking metrics.
+
+grade() takes one row per submission with the student's ranking (dx_1..dx_3) and the
+case's correct order (correct_1..correct_3), as written by export_completed.py, and
+scores every row at once with NumPy:
+
+- exact_match: all three diagnoses in the correct order.
+- top1_hit: the student's first diagnosis is the case's answer.
+- overlap: share of the correct diagnoses the student listed, in any order.
+- position_credit: nDCG with relevance 3/2/1 for answer/sec_dx/thir_dx.
+- spearman: rank correlation of the correct diagnoses' positions in the student's
+  list; unlisted ones tie for last.
+
+aggregate() rolls the scores up per case, per designation, or any other columns:
+
+    python grading.py --export-dir exports/completed --by record_id --out case_scores.csv
+"""
+import argparse
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+DX_COLUMNS = ["dx_1", "dx_2", "dx_3"]
+CORRECT_COLUMNS = ["correct_1", "correct_2", "correct_3"]
+METRICS = ["exact_match", "top1_hit", "overlap", "position_credit", "spearman"]
+
+# Relevance of the answer, sec_dx and thir_dx, and the discount of each rank.
+RELEVANCE = np.array([3.0, 2.0, 1.0])
+DISCOUNT = 1 / np.log2(np.arange(2, 5))
+IDEAL_DCG = float((RELEVANCE * DISCOUNT).sum())
+
+
+def _normalized(df, columns):
+    return df[columns].fillna("").astype(str).apply(lambda col: col.str.strip().str.casefold()).to_numpy()
+
+
+def grade(df):
+    """Returns a copy of df with one column per metric."""
+    student = _normalized(df, DX_COLUMNS)
+    correct = _normalized(df, CORRECT_COLUMNS)
+    # matches[n, k, j]: the student's k-th diagnosis is the j-th correct one.
+    matches = (student[:, :, None] == correct[:, None, :]) & (correct[:, None, :] != "")
+    found = matches.any(axis=1)
+    # 1-based position of each correct diagnosis in the student's list; 4 if unlisted.
+    position = np.where(found, matches.argmax(axis=1) + 1, 4)
+
+    graded = df.copy()
+    graded["exact_match"] = (position == np.arange(1, 4)).all(axis=1)
+    graded["top1_hit"] = position[:, 0] == 1
+    graded["overlap"] = found.sum(axis=1) / 3
+
+    # Relevance of whatever the student put at each rank, discounted by rank.
+    relevance_at = (matches * RELEVANCE[None, None, :]).sum(axis=2)
+    graded["position_credit"] = (relevance_at * DISCOUNT).sum(axis=1) / IDEAL_DCG
+
+    # Rank the positions within each row, ties (unlisted diagnoses) sharing the average
+    # rank; Pearson correlation with the true ranks 1..3 is then Spearman's rho.
+    less = (position[:, None, :] < position[:, :, None]).sum(axis=2)
+    ties = (position[:, None, :] == position[:, :, None]).sum(axis=2) - 1
+    rank = 1 + less + 0.5 * ties
+    true_rank = np.arange(1, 4) - 2.0
+    student_rank = rank - rank.mean(axis=1, keepdims=True)
+    spread = np.sqrt((student_rank ** 2).sum(axis=1) * (true_rank ** 2).sum())
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rho = (student_rank * true_rank).sum(axis=1) / spread
+    # No spread means nothing or everything tied: no evidence of ordering either way.
+    graded["spearman"] = np.where(spread > 0, rho, 0.0)
+    return graded
+
+
+def aggregate(graded, by):
+    """Mean of every metric and the number of submissions per group of the `by` columns."""
+    by = [by] if isinstance(by, str) else list(by)
+    summary = graded.groupby(by)[METRICS].mean()
+    summary.insert(0, "submissions", graded.groupby(by).size())
+    return summary.reset_index()
+
+
+def read_export(directory):
+    """Reads every CSV and Parquet file written by export_completed.py under directory."""
+    frames = [pd.read_csv(p, dtype=str, keep_default_na=False)
+              for p in glob.glob(os.path.join(directory, "*", "*.csv"))]
+    frames += [pd.read_parquet(p) for p in glob.glob(os.path.join(directory, "*", "*.parquet"))]
+    if not frames:
+        return pd.DataFrame(columns=["submission_id", "record_id", "designation"] + DX_COLUMNS + CORRECT_COLUMNS)
+    # A page re-exported after a crash can leave the same submission in two runs' files.
+    return pd.concat(frames, ignore_index=True).drop_duplicates("submission_id", keep="last")
+
+
+def read_storage(storage, case_bank, page_size=500):
+    """Reads every completed exam from storage, joined with the case bank."""
+    from export_completed import COLUMNS, flatten
+
+    rows = []
+    cursor = None
+    while True:
+        page = storage.list_completed_exams(after=cursor, limit=page_size)
+        rows += [flatten(sid, data, case_bank) for sid, data in page]
+        if len(page) < page_size:
+            return pd.DataFrame(rows, columns=COLUMNS)
+        cursor = (page[-1][1]["timestamp"], page[-1][0])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--export-dir", help="grade files written by export_completed.py (default: read storage)")
+    parser.add_argument("--secrets", default=".streamlit/secrets.toml", help="app secrets with [storage]")
+    parser.add_argument("--cases-dir", default=".")
+    parser.add_argument("--by", default="record_id",
+                        help="comma-separated columns to aggregate by, or 'none' for per-submission scores")
+    parser.add_argument("--out", help="CSV to write (default: print)")
+    args = parser.parse_args(argv)
+
+    if args.export_dir:
+        df = read_export(args.export_dir)
+    else:
+        from case_bank import CaseBank
+        from storage import open_storage_from_secrets
+
+        df = read_storage(open_storage_from_secrets(args.secrets), CaseBank(args.cases_dir))
+    result = grade(df)
+    if args.by != "none":
+        result = aggregate(result, args.by.split(","))
+    if args.out:
+        result.to_csv(args.out, index=False)
+    else:
+        print(result.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
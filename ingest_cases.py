@@ -0,0 +1,225 @@
+"""
+Validates the case CSV files and compiles them into one indexed SQLite case bank.
+
+Every row is checked before anything is written:
+
+- required columns are present;
+- record_id, anchorx, choices and the three correct diagnoses are filled in;
+- answer, sec_dx and thir_dx are distinct and each appears in the row's choices;
+- choices has no blank or repeated entries;
+- no record_id appears twice, within a file or across files.
+
+Valid cases are stored with their source file, so a rebuild only re-reads files
+whose size or mtime changed and whose content hash differs, and drops the cases of
+deleted files. Any error aborts the build and leaves the compiled bank as it was.
+The app opens the result read-only at startup ([cases] compiled_path) and falls back
+to reading the CSV files when there is none:
+
+    python ingest_cases.py --cases-dir . --out case_bank.sqlite3
+    python ingest_cases.py --check      # validate only
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import sqlite3
+import sys
+
+import pandas as pd
+
+from case_bank import COMPILED_FORMAT, Case, file_sha1, safe_text
+
+REQUIRED_COLUMNS = ["record_id", "anchorx", "choices", "answer", "sec_dx", "thir_dx"]
+CORRECT_COLUMNS = ["answer", "sec_dx", "thir_dx"]
+
+
+def _json_value(value):
+    # NumPy scalars that pandas leaves in a row.
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+def read_source(path):
+    """Returns (rows, errors) for one CSV file; errors are 'path:line: message' strings."""
+    name = os.path.basename(path)
+    try:
+        df = pd.read_csv(path)
+    except Exception as e:
+        return [], [f"{name}: cannot be read as CSV: {e}"]
+    missing = [c for c in REQUIRED_COLUMNS if c not in df.columns]
+    if missing:
+        return [], [f"{name}: missing column(s) {', '.join(missing)}"]
+    rows, errors = [], []
+    for i, row in enumerate(df.to_dict("records")):
+        # Line numbers as an editor shows them, counting the header.
+        where = f"{name}:{i + 2}"
+        problems = validate_row(row)
+        errors += [f"{where}: {p}" for p in problems]
+        if not problems:
+            rows.append(row)
+    return rows, errors
+
+
+def validate_row(row):
+    """Returns the problems with one case row, as a list of messages."""
+    problems = []
+    for column in REQUIRED_COLUMNS:
+        if not safe_text(row.get(column)).strip():
+            problems.append(f"{column} is empty")
+    if problems:
+        return problems
+    case = Case.from_row(row)
+    if any(not c for c in case.choices):
+        problems.append("choices has an empty entry")
+    repeated = sorted({c for c in case.choices if c and case.choices.count(c) > 1})
+    if repeated:
+        problems.append(f"choices lists {', '.join(repeated)} more than once")
+    if len(set(case.correct_order)) < 3:
+        problems.append("answer, sec_dx and thir_dx are not distinct")
+    for column, diagnosis in zip(CORRECT_COLUMNS, case.correct_order):
+        if diagnosis not in case.choices:
+            problems.append(f"{column} {diagnosis!r} is not one of the choices")
+    return problems
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS sources (
+                   path TEXT PRIMARY KEY,
+                   sha1 TEXT NOT NULL,
+                   mtime_ns INTEGER NOT NULL,
+                   size INTEGER NOT NULL,
+                   cases INTEGER NOT NULL,
+                   ingested_at TEXT NOT NULL
+               )"""
+        )
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS cases (
+                   record_id TEXT PRIMARY KEY,
+                   source TEXT NOT NULL,
+                   position INTEGER NOT NULL,
+                   fingerprint TEXT NOT NULL,
+                   data TEXT NOT NULL
+               )"""
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cases_source ON cases (source, position)")
+        conn.execute("INSERT OR IGNORE INTO meta VALUES ('format', ?)", (str(COMPILED_FORMAT),))
+        conn.execute("INSERT OR IGNORE INTO meta VALUES ('generation', '0')")
+    fmt = int(conn.execute("SELECT value FROM meta WHERE key = 'format'").fetchone()[0])
+    if fmt != COMPILED_FORMAT:
+        raise SystemExit(f"{path} has format {fmt}, expected {COMPILED_FORMAT}; delete it to rebuild")
+    return conn
+
+
+def ingest(cases_dir, out, pattern="*.csv", check=False, force=False, log=print):
+    """
+    Validates the case files and, unless check is set, updates the compiled bank at out.
+    Returns the list of errors; the bank is only written when there are none.
+    """
+    # A first build goes to a temporary file, so a failed one leaves no empty bank behind.
+    target = out if check or os.path.exists(out) else out + ".tmp"
+    if target != out and os.path.exists(target):
+        os.remove(target)
+    conn = connect(":memory:" if check else target)
+    known = {row[0]: row[1:] for row in conn.execute("SELECT path, sha1, mtime_ns, size FROM sources")}
+    paths = sorted(glob.glob(os.path.join(cases_dir, pattern)))
+    sources = {os.path.basename(p): p for p in paths}
+
+    changed, errors = {}, []
+    for name, path in sources.items():
+        stat = os.stat(path)
+        entry = known.get(name)
+        if not force and entry and (entry[1], entry[2]) == (stat.st_mtime_ns, stat.st_size):
+            continue
+        sha1 = file_sha1(path)
+        if not force and entry and entry[0] == sha1:
+            # Touched but not modified.
+            changed[name] = (sha1, stat, None)
+            continue
+        rows, file_errors = read_source(path)
+        changed[name] = (sha1, stat, rows)
+        errors += file_errors
+    removed = [name for name in known if name not in sources]
+
+    # Record ids must be unique across the changed files and the unchanged ones.
+    owners = {}
+    rebuilt = {name for name, (_, _, rows) in changed.items() if rows is not None} | set(removed)
+    for record_id, source in conn.execute("SELECT record_id, source FROM cases"):
+        if source not in rebuilt:
+            owners[record_id] = source
+    for name, (_, _, rows) in sorted(changed.items()):
+        for row in rows or ():
+            record_id = str(row["record_id"])
+            if record_id in owners:
+                errors.append(f"{name}: record_id {record_id} is also in {owners[record_id]}")
+            owners[record_id] = name
+
+    for error in errors:
+        log(error)
+    if errors or check:
+        conn.close()
+        if target != out and not check:
+            os.remove(target)
+        return errors
+
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with conn:
+        # Cleared first, so a case moved between two rebuilt files is not a duplicate key.
+        conn.executemany("DELETE FROM cases WHERE source = ?", [(name,) for name in rebuilt])
+        for name in removed:
+            conn.execute("DELETE FROM sources WHERE path = ?", (name,))
+            log(f"{name}: removed")
+        for name, (sha1, stat, rows) in sorted(changed.items()):
+            if rows is not None:
+                conn.executemany(
+                    "INSERT INTO cases (record_id, source, position, fingerprint, data) VALUES (?, ?, ?, ?, ?)",
+                    [(str(row["record_id"]), name, i, Case.from_row(row).fingerprint,
+                      json.dumps(row, default=_json_value)) for i, row in enumerate(rows)],
+                )
+                log(f"{name}: {len(rows)} case(s) compiled")
+                conn.execute(
+                    "INSERT OR REPLACE INTO sources (path, sha1, mtime_ns, size, cases, ingested_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (name, sha1, stat.st_mtime_ns, stat.st_size, len(rows), now),
+                )
+            else:
+                conn.execute(
+                    "UPDATE sources SET mtime_ns = ?, size = ? WHERE path = ?", (stat.st_mtime_ns, stat.st_size, name)
+                )
+        if rebuilt:
+            # Tells running apps to reload on their next refresh.
+            conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'generation'")
+    conn.close()
+    if target != out:
+        os.replace(target, out)
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--cases-dir", default=".")
+    parser.add_argument("--pattern", default="*.csv")
+    parser.add_argument("--out", default="case_bank.sqlite3")
+    parser.add_argument("--check", action="store_true", help="validate the files without writing --out")
+    parser.add_argument("--force", action="store_true", help="re-read every file, even unchanged ones")
+    args = parser.parse_args(argv)
+
+    errors = ingest(args.cases_dir, args.out, args.pattern, args.check, args.force)
+    if errors:
+        print(f"{len(errors)} problem(s) found" + ("" if args.check else f"; {args.out} was not updated"))
+        return 1
+    if args.check:
+        print("All case files are valid")
+    else:
+        conn = sqlite3.connect(f"file:{args.out}?mode=ro", uri=True)
+        total = conn.execute("SELECT COUNT(*) FROM cases").fetchone()[0]
+        conn.close()
+        print(f"{args.out}: {total} case(s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,481 @@
+"""
+Concurrent-student load test against one app process.
+
+Starts the app under a real Streamlit server with storage in memory and OpenAI/SMTP
+replaced by the fakes in fakes.py, then connects N simulated students over the same
+websocket protocol the browser uses. Each student logs in, searches for three
+diagnoses (committing a few characters at a time, sometimes with a typo that falls
+through to the AI suggestion), adds them, reorders and submits, with think times in
+between. N is stepped up level by level:
+
+    python loadtest.py --students 1,2,4,8,16 --flows 2 --llm-latency 0.5
+
+For every level the report has throughput, rerun latency percentiles (overall and per
+action), errors and the server's CPU use, and marks the first level whose p95 latency
+exceeds --slo or whose throughput stops growing as the saturation point.
+
+The simulated browsers need the extra packages in requirements-dev.txt:
+
+    pip install -r requirements-dev.txt
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(HERE, "clin_reason.py")
+
+# Throughput must grow by at least this much from one level to the next.
+MIN_SCALING_GAIN = 0.1
+
+
+def toml_dumps(sections):
+    lines = []
+    for section, values in sections.items():
+        lines.append(f"[{section}]")
+        for key, value in values.items():
+            if isinstance(value, bool):
+                value = "true" if value else "false"
+            else:
+                value = json.dumps(value)
+            lines.append(f"{json.dumps(key)} = {value}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def serve(port, secrets_file, llm_latency, llm_jitter, smtp_latency):
+    """Runs the app with fakes installed; blocks until the server is stopped."""
+    import fakes
+
+    os.chdir(HERE)
+    fakes.install(llm_latency=llm_latency, llm_jitter=llm_jitter, smtp_latency=smtp_latency)
+    from streamlit.web import cli
+
+    sys.argv = [
+        "streamlit", "run", APP,
+        "--server.port", str(port),
+        "--server.headless", "true",
+        "--server.fileWatcherType", "none",
+        "--browser.gatherUsageStats", "false",
+        "--secrets.files", secrets_file,
+    ]
+    cli.main()
+
+
+def wait_for_server(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("app server exited during startup")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError("app server did not become healthy")
+
+
+def cpu_seconds(pid):
+    """User + system CPU seconds used by pid so far, or None where /proc is unavailable."""
+    try:
+        with open(f"/proc/{pid}/stat") as fh:
+            fields = fh.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class AppError(Exception):
+    pass
+
+
+class Session:
+    """
+    One browser tab: sends rerun requests with the current widget values and keeps the
+    elements of the last rendered page, replacing only a fragment's elements after a
+    fragment run the way the frontend does.
+    """
+
+    def __init__(self, url, timeout):
+        self.url = url
+        self.timeout = timeout
+        self.ws = None
+        # delta path -> (fragment_id, element)
+        self.elements = {}
+        # widget id -> current string value
+        self.text_values = {}
+        # fragment_id -> interval of fragments asking to be rerun on a timer
+        self.auto_reruns = {}
+
+    async def __aenter__(self):
+        import websockets
+
+        self.ws = await websockets.connect(self.url, subprotocols=["streamlit"], max_size=None)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.ws.close()
+        return False
+
+    async def rerun(self, trigger=None, fragment_id="", auto=False):
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        msg = BackMsg()
+        state = msg.rerun_script
+        state.query_string = ""
+        state.page_script_hash = ""
+        state.fragment_id = fragment_id
+        state.is_auto_rerun = auto
+        for widget_id, value in self.text_values.items():
+            widget = state.widget_states.widgets.add()
+            widget.id = widget_id
+            widget.string_value = value
+        if trigger is not None:
+            widget = state.widget_states.widgets.add()
+            widget.id = trigger
+            widget.trigger_value = True
+        await self.ws.send(msg.SerializeToString())
+
+        received = {}
+        while True:
+            raw = await asyncio.wait_for(self.ws.recv(), self.timeout)
+            fmsg = ForwardMsg()
+            fmsg.ParseFromString(raw)
+            kind = fmsg.WhichOneof("type")
+            if kind == "new_session":
+                received = {}
+            elif kind == "delta" and fmsg.delta.WhichOneof("type") == "new_element":
+                path = tuple(fmsg.metadata.delta_path)
+                received[path] = (fmsg.delta.fragment_id, fmsg.delta.new_element)
+            elif kind == "auto_rerun":
+                self.auto_reruns[fmsg.auto_rerun.fragment_id] = fmsg.auto_rerun.interval
+            elif kind == "stop_auto_rerun":
+                self.auto_reruns.clear()
+            elif kind == "script_finished":
+                status = fmsg.script_finished
+                if status == ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    continue
+                if status == ForwardMsg.FINISHED_WITH_COMPILE_ERROR:
+                    raise AppError("script failed to compile")
+                if status == ForwardMsg.FINISHED_FRAGMENT_RUN_SUCCESSFULLY:
+                    fragments = {fid for fid, _ in received.values()} | {fragment_id}
+                    self.elements = {p: e for p, e in self.elements.items() if e[0] not in fragments}
+                    self.elements.update(received)
+                else:
+                    self.elements = received
+                self._sync_text_inputs()
+                return
+
+    def _sync_text_inputs(self):
+        for _, element in self.elements.values():
+            if element.WhichOneof("type") == "text_input":
+                text_input = element.text_input
+                if text_input.set_value or text_input.id not in self.text_values:
+                    self.text_values[text_input.id] = text_input.value if text_input.HasField("value") else text_input.default
+
+    def _of_type(self, kind):
+        return [getattr(e, kind) for _, (_, e) in sorted(self.elements.items()) if e.WhichOneof("type") == kind]
+
+    def text_input(self, label=None, key=None):
+        for text_input in self._of_type("text_input"):
+            if (label and text_input.label == label) or (key and text_input.id.endswith("-" + key)):
+                return text_input.id
+        raise AppError(f"no text input {label or key!r} on the page")
+
+    def button(self, label=None, key=None):
+        for button in self._of_type("button"):
+            if (label and button.label == label) or (key and button.id.endswith("-" + key)):
+                return button.id
+        return None
+
+    def markdown(self):
+        return [m.body for m in self._of_type("markdown")]
+
+    def errors(self):
+        return [a.body for a in self._of_type("alert") if a.format == a.ERROR]
+
+
+class Student:
+    def __init__(self, session, recorder, cases, rng, think_scale, typo_rate):
+        self.session = session
+        self.recorder = recorder
+        self.cases = cases
+        self.rng = rng
+        self.think_scale = think_scale
+        self.typo_rate = typo_rate
+
+    async def think(self, low=1.0, high=4.0):
+        await asyncio.sleep(self.rng.uniform(low, high) * self.think_scale)
+
+    async def type_text(self, text):
+        # About five characters per second, then Enter.
+        await asyncio.sleep(len(text) * self.rng.uniform(0.12, 0.3) * self.think_scale)
+
+    async def act(self, action, **rerun):
+        started = time.perf_counter()
+        await self.session.rerun(**rerun)
+        self.recorder.record(action, time.perf_counter() - started)
+
+    async def fill(self, action, widget_id, text):
+        await self.type_text(text)
+        self.session.text_values[widget_id] = text
+        await self.act(action)
+
+    def current_case(self):
+        for body in self.session.markdown():
+            case = self.cases.get(body.strip())
+            if case is not None:
+                return case
+        raise AppError("could not tell which case is on the page")
+
+    async def wait_for_ai_suggestion(self):
+        while any("Looking for a matching diagnosis" in m for m in self.session.markdown()):
+            if not self.session.auto_reruns:
+                await self.act("ai_poll")
+                continue
+            fragment_id, interval = next(iter(self.session.auto_reruns.items()))
+            await asyncio.sleep(interval)
+            await self.act("ai_poll", fragment_id=fragment_id, auto=True)
+
+    async def search_and_add(self, diagnosis):
+        search = self.session.text_input(key="diag_search_input")
+        if self.rng.random() < self.typo_rate:
+            # A garbled query the substring match misses; it goes to the matcher and the LLM.
+            typo = "".join(self.rng.sample(diagnosis.lower(), min(len(diagnosis), 6)))
+            await self.fill("search_typo", search, typo)
+            await self.wait_for_ai_suggestion()
+            await self.think(0.5, 2)
+        length = self.rng.randint(3, 6)
+        while True:
+            await self.fill("search", search, diagnosis[:length])
+            button = self.session.button(label="➕ " + diagnosis)
+            if button is not None:
+                break
+            if length >= len(diagnosis):
+                raise AppError(f"{diagnosis!r} never showed up in the matches")
+            length += self.rng.randint(2, 5)
+            await self.think(0.3, 1)
+        await self.think(0.3, 1.5)
+        await self.act("add_diagnosis", trigger=button)
+
+    async def run(self, passcode):
+        await self.act("page_load")
+        await self.think(2, 5)
+        await self.fill("login_field", self.session.text_input(label="Enter your assigned passcode"), passcode)
+        await self.fill("login_field", self.session.text_input(label="Enter your name"), "Load Student")
+        await self.think(0.5, 1.5)
+        await self.act("login", trigger=self.session.button(label="Login"))
+        if self.session.errors():
+            raise AppError("login failed: " + "; ".join(self.session.errors()))
+
+        case = self.current_case()
+        await self.think(10, 30)
+        picks = list(case.correct_order)
+        self.rng.shuffle(picks)
+        for diagnosis in picks:
+            await self.search_and_add(diagnosis)
+            await self.think(1, 4)
+        for _ in range(self.rng.randint(0, 2)):
+            button = self.session.button(key=f"up_{self.rng.randint(1, 2)}")
+            if button is not None:
+                await self.act("reorder", trigger=button)
+                await self.think(0.5, 2)
+        await self.think(2, 6)
+        await self.act("submit", trigger=self.session.button(label="Submit Answer"))
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.flows = 0
+        self.errors = []
+
+    def record(self, action, seconds):
+        self.latencies.setdefault(action, []).append(seconds)
+
+    def all_latencies(self):
+        return [s for values in self.latencies.values() for s in values]
+
+
+def percentiles(values):
+    ordered = sorted(values)
+    if not ordered:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {"p50": round(pick(0.5), 4), "p95": round(pick(0.95), 4), "p99": round(pick(0.99), 4),
+            "max": round(ordered[-1], 4)}
+
+
+async def run_level(url, n_students, flows, passcodes, cases, args, seed):
+    recorder = Recorder()
+
+    async def student(index):
+        rng = random.Random(seed * 1000 + index)
+        # Students arrive spread over the first few seconds rather than all at once.
+        await asyncio.sleep(rng.uniform(0, 3) * args.think_scale)
+        for flow in range(flows):
+            try:
+                async with Session(url, args.timeout) as session:
+                    await Student(session, recorder, cases, rng, args.think_scale, args.typo_rate).run(
+                        passcodes[(index, flow)]
+                    )
+                recorder.flows += 1
+            except Exception as e:
+                recorder.errors.append(f"{type(e).__name__}: {e}")
+
+    await asyncio.gather(*(student(i) for i in range(n_students)))
+    return recorder
+
+
+def summarize(n_students, recorder, seconds, cpu):
+    latencies = recorder.all_latencies()
+    return {
+        "students": n_students,
+        "seconds": round(seconds, 2),
+        "flows": recorder.flows,
+        "errors": len(recorder.errors),
+        "error_samples": recorder.errors[:3],
+        "flows_per_minute": round(recorder.flows / seconds * 60, 2) if seconds else 0.0,
+        "reruns_per_second": round(len(latencies) / seconds, 2) if seconds else 0.0,
+        "latency": percentiles(latencies),
+        "actions": {action: dict(percentiles(values), count=len(values))
+                    for action, values in sorted(recorder.latencies.items())},
+        "server_cpu": round(cpu / seconds, 3) if cpu is not None and seconds else None,
+    }
+
+
+def mark_saturation(levels, slo):
+    """Returns the student count of the first saturated level, or None."""
+    previous = None
+    for level in levels:
+        reasons = []
+        if level["latency"]["p95"] > slo:
+            reasons.append(f"p95 {level['latency']['p95']:.2f}s > slo {slo:.2f}s")
+        if level["errors"]:
+            reasons.append(f"{level['errors']} failed flows")
+        if previous and level["students"] > previous["students"]:
+            gain = level["reruns_per_second"] / previous["reruns_per_second"] - 1 if previous["reruns_per_second"] else 0
+            if gain < MIN_SCALING_GAIN:
+                reasons.append(f"throughput grew only {gain:.0%}")
+        level["saturated"] = reasons
+        previous = level
+    return next((level["students"] for level in levels if level["saturated"]), None)
+
+
+def load_cases():
+    """Maps the text of each case's sidebar sections to its Case, to tell which case a student got."""
+    from case_bank import CaseBank
+
+    bank = CaseBank(HERE)
+    cases = {}
+    for record_id in bank.record_ids():
+        case = bank.get(record_id)
+        for field in ("hpi", "cc"):
+            text = str(case.row.get(field, "")).strip()
+            if text:
+                cases.setdefault(text, case)
+    return cases
+
+
+def print_level(level):
+    latency = level["latency"]
+    cpu = f"{level['server_cpu'] * 100:.0f}%" if level["server_cpu"] is not None else "n/a"
+    print(f"{level['students']:>8}{level['flows']:>7}{level['errors']:>7}{level['flows_per_minute']:>10.1f}"
+          f"{level['reruns_per_second']:>10.2f}{latency['p50'] * 1000:>9.0f}{latency['p95'] * 1000:>9.0f}"
+          f"{latency['p99'] * 1000:>9.0f}{cpu:>8}  {'; '.join(level['saturated'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--students", default="1,2,4,8", help="comma-separated student counts, one level each")
+    parser.add_argument("--flows", type=int, default=2, help="exams each student takes per level")
+    parser.add_argument("--think-scale", type=float, default=0.1,
+                        help="multiplier on human think and typing times (1.0 = real time)")
+    parser.add_argument("--typo-rate", type=float, default=0.3, help="share of searches that need the AI")
+    parser.add_argument("--llm-latency", type=float, default=0.8)
+    parser.add_argument("--llm-jitter", type=float, default=0.3)
+    parser.add_argument("--smtp-latency", type=float, default=0.05)
+    parser.add_argument("--slo", type=float, default=1.0, help="p95 rerun latency budget in seconds")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for one rerun")
+    parser.add_argument("--port", type=int, default=8599)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--json", help="also write the report to this path")
+    parser.add_argument("--serve", metavar="SECRETS_FILE", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.port, args.serve, args.llm_latency, args.llm_jitter, args.smtp_latency)
+        return 0
+
+    levels = [int(n) for n in args.students.split(",")]
+    workdir = tempfile.mkdtemp(prefix="clin_reason_load_")
+    # Every flow gets its own passcode and designation, so flows never lock each other
+    # out and always have the whole case bank to draw from.
+    passcodes = {}
+    for n in levels:
+        for index in range(n):
+            for flow in range(args.flows):
+                code = f"load{n}x{index}x{flow}"
+                passcodes[(n, index, flow)] = f"{code}_{code}"
+    import fakes
+
+    secrets = fakes.app_secrets(
+        {code: f"{code}@example.com" for code in passcodes.values()},
+        os.path.join(workdir, "jobs.sqlite3"),
+    )
+    secrets_file = os.path.join(workdir, "secrets.toml")
+    with open(secrets_file, "w") as fh:
+        fh.write(toml_dumps(secrets))
+
+    cases = load_cases()
+    log = open(os.path.join(workdir, "server.log"), "w")
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", secrets_file, "--port", str(args.port),
+         "--llm-latency", str(args.llm_latency), "--llm-jitter", str(args.llm_jitter),
+         "--smtp-latency", str(args.smtp_latency)],
+        stdout=log, stderr=subprocess.STDOUT,
+    )
+    url = f"ws://127.0.0.1:{args.port}/_stcore/stream"
+    results = []
+    try:
+        wait_for_server(args.port, server)
+        print(f"server log: {log.name}")
+        print(f"{'students':>8}{'flows':>7}{'errors':>7}{'flows/min':>10}{'reruns/s':>10}"
+              f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'cpu':>8}  saturation")
+        for n in levels:
+            level_codes = {(i, f): passcodes[(n, i, f)] for i in range(n) for f in range(args.flows)}
+            cpu_before = cpu_seconds(server.pid)
+            started = time.perf_counter()
+            recorder = asyncio.run(run_level(url, n, args.flows, level_codes, cases, args, args.seed + n))
+            seconds = time.perf_counter() - started
+            cpu_after = cpu_seconds(server.pid)
+            cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+            results.append(summarize(n, recorder, seconds, cpu))
+            mark_saturation(results, args.slo)
+            print_level(results[-1])
+    finally:
+        server.terminate()
+        server.wait(10)
+        log.close()
+
+    saturation = mark_saturation(results, args.slo)
+    print(f"saturation point: {saturation} students" if saturation else "no saturation within the tested levels")
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump({"config": vars(args), "levels": results, "saturation_students": saturation},
+                      fh, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
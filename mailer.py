@@ -0,0 +1,97 @@
+"""
+Outgoing email over pooled, authenticated SMTP connections.
+
+Connections are logged in once and reused across messages. A connection that has
+been idle too long, or no longer answers NOOP, is replaced transparently.
+"""
+import smtplib
+import threading
+import time
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+
+def build_message(from_email, to_emails, subject, body, attachments=()):
+    """attachments is an iterable of (filename, bytes) pairs."""
+    msg = MIMEMultipart()
+    msg['From'] = from_email
+    msg['To'] = ', '.join(to_emails)
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'html'))
+    for filename, payload in attachments:
+        part = MIMEBase('application', 'octet-stream')
+        part.set_payload(payload)
+        encoders.encode_base64(part)
+        part.add_header('Content-Disposition', 'attachment', filename=filename)
+        msg.attach(part)
+    return msg
+
+
+class SMTPPool:
+    def __init__(self, username, password, host="smtp.gmail.com", port=465, size=2, idle_timeout=120):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # Idle connections as (server, last used)
+        self._idle = []
+
+    def _connect(self):
+        server = smtplib.SMTP_SSL(self.host, self.port, timeout=30)
+        server.login(self.username, self.password)
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            pass
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                server, last_used = self._idle.pop()
+            if time.monotonic() - last_used < self.idle_timeout:
+                try:
+                    if server.noop()[0] == 250:
+                        return server
+                except OSError:
+                    pass
+            self._close(server)
+        return self._connect()
+
+    def _release(self, server):
+        with self._lock:
+            self._idle.append((server, time.monotonic()))
+
+    def send(self, msg, to_emails):
+        """Sends msg, retrying once on a fresh connection if a pooled one was dropped."""
+        with self._slots:
+            for attempt in range(2):
+                server = self._acquire()
+                try:
+                    server.send_message(msg, from_addr=self.username, to_addrs=to_emails)
+                except smtplib.SMTPServerDisconnected:
+                    self._close(server)
+                    if attempt:
+                        raise
+                    continue
+                except Exception:
+                    self._close(server)
+                    raise
+                self._release(server)
+                return
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            self._close(server)
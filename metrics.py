@@ -0,0 +1,193 @@
+"""
+In-process timing spans, counters and per-rerun summaries.
+
+span(name) times a block into a histogram of recent samples, and count(name, n) bumps a
+counter. rerun(name) wraps one script run (or fragment run): spans and counts made on
+that thread while it is open are also totalled per rerun, so reads/writes per rerun get
+their own histograms. Calls made on background threads (write-behind, submission jobs,
+AI lookups) are only counted in the process totals.
+
+Everything can be exported as Prometheus text (summaries with p50/p95/p99) or logged as
+one JSON line per rerun.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = (0.5, 0.95, 0.99)
+# Percentiles are computed over the most recent samples of each histogram.
+MAX_SAMPLES = 2048
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_local = threading.local()
+_log_reruns = False
+_exporter = None
+
+
+class Histogram:
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self, quantiles=QUANTILES):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {q: 0.0 for q in quantiles}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in quantiles}
+
+
+def observe(name, value):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(value)
+
+
+def count(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+    current = getattr(_local, "rerun", None)
+    if current is not None:
+        current["counters"][name] = current["counters"].get(name, 0) + n
+
+
+class span:
+    """Context manager timing a block into the histogram `<name>_seconds`."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._started
+        observe(self.name + "_seconds", elapsed)
+        current = getattr(_local, "rerun", None)
+        if current is not None:
+            current["spans"][self.name] = round(current["spans"].get(self.name, 0.0) + elapsed, 6)
+        return False
+
+
+class rerun:
+    """
+    Context manager for one script or fragment run. Nested inside another rerun on the
+    same thread (a fragment called during a full run) it only acts as a span.
+    """
+
+    def __init__(self, name="page"):
+        self.name = name
+
+    def __enter__(self):
+        self._outer = getattr(_local, "rerun", None) is not None
+        if not self._outer:
+            _local.rerun = {"spans": {}, "counters": {}}
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        elapsed = time.perf_counter() - self._started
+        if self._outer:
+            observe(self.name + "_seconds", elapsed)
+            _local.rerun["spans"][self.name] = round(elapsed, 6)
+            return False
+        current = _local.rerun
+        _local.rerun = None
+        observe("rerun_seconds", elapsed)
+        observe(self.name + "_rerun_seconds", elapsed)
+        for name in ("storage_reads", "storage_writes"):
+            observe(name + "_per_rerun", current["counters"].get(name, 0))
+        count("reruns")
+        if _log_reruns:
+            record = {
+                "rerun": self.name,
+                "seconds": round(elapsed, 6),
+                "error": exc_type.__name__ if exc_type else None,
+                "spans": current["spans"],
+                "counters": current["counters"],
+            }
+            logger.info("rerun %s", json.dumps(record, sort_keys=True))
+        return False
+
+
+def snapshot():
+    """{"counters": {...}, "histograms": {name: {"count", "sum", "p50", "p95", "p99"}}}"""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {}
+        for name, histogram in _histograms.items():
+            summary = {"count": histogram.count, "sum": round(histogram.sum, 6)}
+            for q, value in histogram.quantiles().items():
+                summary[f"p{round(q * 100)}"] = round(value, 6)
+            histograms[name] = summary
+    return {"counters": counters, "histograms": histograms}
+
+
+def _metric_name(name, prefix):
+    return prefix + "".join(c if c.isalnum() or c == "_" else "_" for c in name)
+
+
+def prometheus_text(prefix="clin_reason_"):
+    data = snapshot()
+    lines = []
+    for name, value in sorted(data["counters"].items()):
+        metric = _metric_name(name, prefix) + "_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+    for name, summary in sorted(data["histograms"].items()):
+        metric = _metric_name(name, prefix)
+        lines.append(f"# TYPE {metric} summary")
+        for q in QUANTILES:
+            lines.append(f'{metric}{{quantile="{q}"}} {summary[f"p{round(q * 100)}"]}')
+        lines += [f"{metric}_sum {summary['sum']}", f"{metric}_count {summary['count']}"]
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, prefix="clin_reason_"):
+    """Writes prometheus_text() to path atomically, e.g. for node_exporter's textfile collector."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fh:
+        fh.write(prometheus_text(prefix))
+    os.replace(tmp, path)
+
+
+def configure(log_reruns=False, prometheus_path=None, export_interval=15.0):
+    """Turns on per-rerun JSON logs and/or a thread rewriting a Prometheus text file."""
+    global _log_reruns, _exporter
+    _log_reruns = bool(log_reruns)
+    with _lock:
+        if not prometheus_path or _exporter is not None:
+            return
+        _exporter = threading.Thread(
+            target=_export_forever, args=(prometheus_path, export_interval), name="metrics-exporter", daemon=True
+        )
+    _exporter.start()
+
+
+def _export_forever(path, interval):
+    while True:
+        try:
+            write_prometheus(path)
+        except Exception:
+            logger.exception("Writing metrics to %s failed", path)
+        time.sleep(interval)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
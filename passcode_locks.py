@@ -0,0 +1,84 @@
+"""
+Passcode claim/lock state kept in the shelf_records_prioritized collection.
+
+A passcode record is "claimed" when its timestamp is less than `window_hours` old
+and "locked" when it is also marked locked at submission. All checks share one
+timestamp rule, check-and-set claims run in a single storage transaction, and
+lock state is cached locally: locked results until the lock expires, everything
+else for `cache_ttl` seconds.
+"""
+import datetime
+import threading
+import time
+
+from storage import is_recent
+
+
+class PasscodeLockService:
+    def __init__(self, storage, window_hours=6, cache_ttl=30):
+        self.storage = storage
+        self.window = datetime.timedelta(hours=window_hours)
+        self.cache_ttl = cache_ttl
+        self._lock = threading.Lock()
+        # passcode -> (cache expiry, {"timestamp": datetime, "locked": bool} or None)
+        self._cache = {}
+
+    def _recent(self, state, now=None):
+        return is_recent(state, self.window, now)
+
+    def _remember(self, passcode, state):
+        ttl = time.monotonic() + self.cache_ttl
+        if state and state.get("locked") and self._recent(state):
+            # A lock can only expire, so it is safe to cache until then.
+            remaining = state["timestamp"] + self.window - datetime.datetime.now(datetime.timezone.utc)
+            ttl = max(ttl, time.monotonic() + remaining.total_seconds())
+        with self._lock:
+            self._cache[passcode] = (ttl, state)
+
+    def _cached(self, passcode):
+        with self._lock:
+            entry = self._cache.get(passcode)
+        if entry and entry[0] > time.monotonic():
+            return True, entry[1]
+        return False, None
+
+    def get_state(self, passcode):
+        hit, state = self._cached(passcode)
+        if not hit:
+            state = self.storage.get_lock(passcode)
+            self._remember(passcode, state)
+        return state
+
+    def get_states(self, passcodes):
+        """Batch lookup for admin tools: returns {passcode: state or None} in one round trip."""
+        passcodes = [str(p).strip() for p in passcodes if str(p).strip()]
+        states = {}
+        missing = []
+        for passcode in passcodes:
+            hit, state = self._cached(passcode)
+            if hit:
+                states[passcode] = state
+            else:
+                missing.append(passcode)
+        if missing:
+            for passcode, state in self.storage.get_locks(missing).items():
+                self._remember(passcode, state)
+                states[passcode] = state
+        return states
+
+    def is_locked(self, passcode):
+        state = self.get_state(passcode)
+        return bool(state and state.get("locked") and self._recent(state))
+
+    def claim(self, passcode):
+        """
+        Atomically claims passcode unless it was claimed within the window.
+        Returns (already_claimed, claim timestamp).
+        """
+        already_claimed, state = self.storage.claim_lock(passcode, self.window)
+        self._remember(passcode, state)
+        return already_claimed, state["timestamp"]
+
+    def lock(self, passcode):
+        """Marks passcode as locked for the next window_hours."""
+        self._remember(passcode, self.storage.set_lock(passcode))
@@ -0,0 +1,220 @@
+"""
+Offline precomputation of aliases for every diagnosis in the case bank.
+
+Instead of asking the LLM live, one query at a time, this job asks it once for the
+abbreviations, alternate names and lay terms of every distinct diagnosis in any
+case's choices. The answers are written to a versioned JSON artifact, which the app
+merges into the local matcher's synonyms at startup ([matching] aliases_path), so most
+abbreviations resolve without a live request:
+
+    python precompute_aliases.py --out diagnosis_aliases.json --concurrency 4 --rpm 60
+
+Diagnoses are sent in batches, on concurrent workers, with the request rate capped.
+Diagnoses already present in the previous artifact are not asked again unless
+--refresh is given. `--client fake` uses the FakeChatCompletion from fakes.py
+instead of OpenAI.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from diagnosis_matcher import ALIAS_FORMAT, diagnosis_name, normalize, read_alias_artifact
+
+logger = logging.getLogger(__name__)
+
+PROMPT = (
+    "You are an expert medical assistant. For each diagnosis below, list the abbreviations, "
+    "acronyms, alternate clinical names and lay terms a medical student might type when they "
+    "mean exactly that diagnosis. Do not list broader, narrower or related diagnoses. "
+    "Reply with only a JSON object mapping each diagnosis, exactly as given, to a list of strings. "
+    "Diagnoses: {diagnoses}"
+)
+
+
+class RateLimiter:
+    """Spaces calls at least 60 / rpm seconds apart across threads."""
+
+    def __init__(self, rpm):
+        self.interval = 60.0 / rpm if rpm else 0.0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def distinct_diagnoses(case_bank):
+    """Maps each diagnosis name, as the matcher normalizes it, to how it is written in the choices."""
+    names = {}
+    for record_id in case_bank.record_ids():
+        for choice in case_bank.get(record_id).choices:
+            name = diagnosis_name(choice)
+            if name:
+                names.setdefault(name, choice)
+    return names
+
+
+def clean_aliases(name, aliases, names):
+    """
+    Normalizes the aliases of name, dropping ones that are blank, single characters,
+    the name itself, or another diagnosis in the case bank.
+    """
+    cleaned = set()
+    for alias in aliases if isinstance(aliases, list) else []:
+        alias = normalize(alias)
+        if len(alias.replace(" ", "")) >= 2 and alias != name and alias not in names:
+            cleaned.add(alias)
+    return sorted(cleaned)
+
+
+def parse_reply(text):
+    """The JSON object in an LLM reply, tolerating a code fence or text around it."""
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        raise ValueError(f"No JSON object in reply: {text[:200]!r}")
+    return json.loads(text[start:end + 1])
+
+
+class AliasGenerator:
+    """
+    Asks client for aliases. client is anything with openai.ChatCompletion's create(),
+    such as the openai module's ChatCompletion or fakes.FakeChatCompletion.
+    """
+
+    def __init__(self, client, model="gpt-3.5-turbo", rpm=60, max_attempts=4, timeout=30):
+        self.client = client
+        self.model = model
+        self.limiter = RateLimiter(rpm)
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.tokens = 0
+
+    def _ask(self, written):
+        prompt = PROMPT.format(diagnoses=json.dumps(written))
+        for attempt in range(self.max_attempts):
+            self.limiter.wait()
+            try:
+                response = self.client.create(
+                    model=self.model,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=0.0,
+                    request_timeout=self.timeout,
+                )
+                with self._lock:
+                    self.calls += 1
+                    self.tokens += response.get("usage", {}).get("total_tokens", 0)
+                return parse_reply(response["choices"][0]["message"]["content"])
+            except Exception as e:
+                if attempt + 1 == self.max_attempts:
+                    raise
+                delay = min(60.0, 2.0 * 2 ** attempt) * random.uniform(0.5, 1.0)
+                logger.warning("Alias request failed (%s: %s), retrying in %.1fs", type(e).__name__, e, delay)
+                time.sleep(delay)
+
+    def batch(self, batch, names):
+        """Returns {name: aliases} for a list of (name, written) pairs."""
+        reply = self._ask([written for _, written in batch])
+        # Replies are keyed by the diagnosis as sent, but tolerate changed capitalization.
+        by_name = {diagnosis_name(key): value for key, value in reply.items()}
+        return {name: clean_aliases(name, by_name.get(name, []), names) for name, _ in batch}
+
+
+def source_hash(names):
+    return hashlib.sha1("\n".join(sorted(names)).encode("utf-8")).hexdigest()[:16]
+
+
+def precompute(case_bank, generator, previous=None, batch_size=10, concurrency=4, log=print):
+    """Returns the alias artifact for every diagnosis in case_bank."""
+    names = distinct_diagnoses(case_bank)
+    known = (previous or {}).get("aliases", {})
+    aliases = {name: known[name] for name in names if name in known}
+    todo = [(name, written) for name, written in sorted(names.items()) if name not in aliases]
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+    log(f"{len(names)} diagnoses, {len(aliases)} reused, {len(todo)} to ask in {len(batches)} requests")
+    failed = []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [(batch, pool.submit(generator.batch, batch, names)) for batch in batches]
+        for batch, future in futures:
+            try:
+                aliases.update(future.result())
+            except Exception as e:
+                failed += [name for name, _ in batch]
+                log(f"giving up on {len(batch)} diagnoses: {type(e).__name__}: {e}")
+    content = json.dumps(aliases, sort_keys=True)
+    return {
+        "format": ALIAS_FORMAT,
+        # Changes whenever the table does, so the app can log which one it loaded.
+        "version": hashlib.sha1(content.encode("utf-8")).hexdigest()[:12],
+        "generated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "model": generator.model,
+        "source": source_hash(names),
+        "failed": sorted(failed),
+        "aliases": dict(sorted(aliases.items())),
+    }
+
+
+def write_artifact(artifact, path):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fh:
+        json.dump(artifact, fh, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def make_client(kind, secrets_path, latency=0.0):
+    if kind == "fake":
+        from fakes import FakeChatCompletion
+
+        return FakeChatCompletion(latency=latency)
+    import openai
+
+    from storage import load_secrets
+
+    openai.api_key = load_secrets(secrets_path)["openai"]["api_key"]
+    return openai.ChatCompletion
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--out", default="diagnosis_aliases.json")
+    parser.add_argument("--cases-dir", default=".")
+    parser.add_argument("--client", choices=["openai", "fake"], default="openai")
+    parser.add_argument("--secrets", default=".streamlit/secrets.toml", help="app secrets with [openai] api_key")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rpm", type=float, default=60, help="maximum requests per minute")
+    parser.add_argument("--batch-size", type=int, default=10, help="diagnoses per request")
+    parser.add_argument("--fake-latency", type=float, default=0.0, help="seconds per fake request")
+    parser.add_argument("--refresh", action="store_true", help="ask again for diagnoses already in --out")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    from case_bank import CaseBank
+
+    previous = None if args.refresh else read_alias_artifact(args.out)
+    generator = AliasGenerator(make_client(args.client, args.secrets, args.fake_latency), args.model, args.rpm)
+    started = time.perf_counter()
+    artifact = precompute(CaseBank(args.cases_dir), generator, previous, args.batch_size, args.concurrency)
+    write_artifact(artifact, args.out)
+    count = sum(len(a) for a in artifact["aliases"].values())
+    print(f"{count} aliases for {len(artifact['aliases'])} diagnoses written to {args.out} "
+          f"(version {artifact['version']}, {generator.calls} requests, {generator.tokens} tokens, "
+          f"{time.perf_counter() - started:.1f}s)")
+    return 1 if artifact["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
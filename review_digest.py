@@ -0,0 +1,151 @@
+"""
+Review emails batched into one digest per recipient.
+
+With digest mode on, each incorrect answer's review document is rendered as before
+but kept in a SQLite file instead of being mailed. Once the oldest review for a
+recipient is `window` seconds old, every review pending for them goes out in one
+email, either as a zip of the documents or merged into a single document. All digests
+that are due are sent one after another over the same pooled SMTP connection.
+
+Reviews are keyed by a review id, so a retried job does not add the same review
+twice. A digest is deleted only after it was sent.
+"""
+import copy
+import datetime
+import html
+import io
+import sqlite3
+import threading
+import time
+import zipfile
+
+FORMATS = ("zip", "docx")
+
+
+def bundle_zip(reviews):
+    """reviews is a list of (filename, .docx bytes). Returns the zip's bytes."""
+    buffer = io.BytesIO()
+    seen = set()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for filename, document in reviews:
+            name, n = filename, 1
+            while name in seen:
+                n += 1
+                name = filename.replace(".docx", f"_{n}.docx")
+            seen.add(name)
+            archive.writestr(name, document)
+    return buffer.getvalue()
+
+
+def bundle_docx(reviews):
+    """Merges the review documents into one, each starting on a new page."""
+    from docx import Document
+    from docx.enum.text import WD_BREAK
+
+    merged = Document(io.BytesIO(reviews[0][1]))
+    body = merged.element.body
+    for _, document in reviews[1:]:
+        merged.add_paragraph().add_run().add_break(WD_BREAK.PAGE)
+        # Paragraphs are appended before the final section properties, like add_paragraph does.
+        for element in Document(io.BytesIO(document)).element.body:
+            if not element.tag.endswith("}sectPr"):
+                body.insert(len(body) - 1, copy.deepcopy(element))
+    buffer = io.BytesIO()
+    merged.save(buffer)
+    return buffer.getvalue()
+
+
+class ReviewDigest:
+    def __init__(self, path="review_digest.sqlite3", window=900, fmt="zip"):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown digest format {fmt!r}; expected one of {FORMATS}")
+        self.window = window
+        self.fmt = fmt
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS reviews (
+                       id TEXT PRIMARY KEY,
+                       recipient TEXT NOT NULL,
+                       student_name TEXT NOT NULL,
+                       record_id TEXT NOT NULL,
+                       filename TEXT NOT NULL,
+                       document BLOB NOT NULL,
+                       added_at REAL NOT NULL
+                   )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS reviews_recipient ON reviews (recipient, added_at)")
+
+    @staticmethod
+    def recipient_key(to_emails):
+        return ", ".join(sorted(to_emails))
+
+    def add(self, review_id, to_emails, student_name, record_id, filename, document):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO reviews (id, recipient, student_name, record_id, filename, document, added_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (review_id, self.recipient_key(to_emails), student_name, record_id, filename, document, time.time()),
+            )
+
+    def pending(self):
+        """Number of reviews not sent yet, per recipient."""
+        with self._lock:
+            return dict(self._conn.execute("SELECT recipient, COUNT(*) FROM reviews GROUP BY recipient").fetchall())
+
+    def due(self, now=None):
+        """Recipients whose oldest pending review has waited for the whole window."""
+        cutoff = (now or time.time()) - self.window
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT recipient FROM reviews GROUP BY recipient HAVING MIN(added_at) <= ?", (cutoff,)
+            ).fetchall()
+        return [recipient for recipient, in rows]
+
+    def _reviews(self, recipient):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, student_name, record_id, filename, document FROM reviews "
+                "WHERE recipient = ? ORDER BY added_at",
+                (recipient,),
+            ).fetchall()
+
+    def _delete(self, review_ids):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM reviews WHERE id = ?", [(i,) for i in review_ids])
+
+    def build(self, recipient, reviews, from_email):
+        from mailer import build_message
+
+        # Student names are typed by the students.
+        listed = "".join(f"<li>{html.escape(student_name)} &ndash; case {html.escape(record_id)}</li>"
+                         for _, student_name, record_id, _, _ in reviews)
+        documents = [(filename, document) for _, _, _, filename, document in reviews]
+        day = datetime.date.today().isoformat()
+        if self.fmt == "zip":
+            attachment = (f"reviews_{day}.zip", bundle_zip(documents))
+        else:
+            attachment = (f"reviews_{day}.docx", bundle_docx(documents))
+        return build_message(
+            from_email,
+            recipient.split(", "),
+            subject=f"Reviews of Incorrect Prioritized Diagnosis Answers ({len(reviews)})",
+            body=f"Please find attached reviews of the following responses:<ul>{listed}</ul>",
+            attachments=[attachment],
+        )
+
+    def flush(self, smtp_pool, now=None, everything=False):
+        """
+        Sends one digest to every recipient that is due (or has anything pending, with
+        everything=True). Returns the number of digests sent.
+        """
+        recipients = list(self.pending()) if everything else self.due(now)
+        for recipient in recipients:
+            reviews = self._reviews(recipient)
+            if not reviews:
+                continue
+            msg = self.build(recipient, reviews, smtp_pool.username)
+            smtp_pool.send(msg, recipient.split(", "))
+            self._delete([review[0] for review in reviews])
+        return len(recipients)
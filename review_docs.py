@@ -0,0 +1,138 @@
+"""
+Review documents sent to students after an incorrect prioritized diagnosis.
+
+Everything in a review except the student's name and order depends only on the case,
+so it is rendered once per record_id into a template with placeholders and cached
+(in memory, and optionally as .docx files on disk). Each review then only fills in
+the student-specific parts. Run this module with --prerender to build the templates
+for the whole case bank at deploy time.
+"""
+import argparse
+import io
+import os
+import threading
+
+import pandas as pd
+from docx import Document
+
+from case_bank import CaseBank, safe_text
+
+STUDENT_NAME_PLACEHOLDER = "{{student_name}}"
+STUDENT_ORDER_PLACEHOLDER = "{{student_order}}"
+
+
+def render_review_template(case):
+    """Renders the case-invariant review for a Case as .docx bytes with student placeholders."""
+    row = case.row
+    doc = Document()
+    doc.add_heading("Review of Incorrect Prioritized Diagnosis", level=1)
+    doc.add_heading(f"Student: {STUDENT_NAME_PLACEHOLDER}", level=2)
+    doc.add_heading(f"Case ({row['record_id']}):", level=2)
+    doc.add_paragraph(safe_text(row["anchorx"]))
+    sections = {
+         "Chief Complaint": row.get("cc", ""),
+         "History of Present Illness": row.get("hpi", ""),
+         "Past Medical History": row.get("pmhx", ""),
+         "Medications": row.get("meds", ""),
+         "Allergies": row.get("allergies", ""),
+         "Immunizations": row.get("immunizations", ""),
+         "Social History": row.get("shx", ""),
+         "Family History": row.get("fhx", ""),
+         "Vital Signs": row.get("vs", ""),
+         "Physical Exam": row.get("pe", "")
+    }
+    for title, content in sections.items():
+         if pd.notna(content) and str(content).strip():
+              doc.add_heading(title, level=2)
+              if title == "Physical Exam":
+                  for label, text in case.pe_lines:
+                      p = doc.add_paragraph()
+                      run1 = p.add_run(f"{label}: ")
+                      run1.bold = True
+                      p.add_run(text)
+              else:
+                  doc.add_paragraph(safe_text(content))
+    doc.add_heading("Student Prioritized Diagnosis:", level=2)
+    doc.add_paragraph(STUDENT_ORDER_PLACEHOLDER)
+    doc.add_heading("Correct Prioritized Diagnosis:", level=2)
+    for i, diag in enumerate(case.correct_order):
+         doc.add_paragraph(f"{i+1}. {diag}")
+    doc.add_heading("Explanation:", level=2)
+    doc.add_paragraph(safe_text(row.get("answer_explanationx", "")))
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def fill_review_template(template, user_order, student_name):
+    """Returns the .docx bytes of template with the student's name and order filled in."""
+    doc = Document(io.BytesIO(template))
+    for paragraph in list(doc.paragraphs):
+        if paragraph.text == STUDENT_ORDER_PLACEHOLDER:
+            for i, diag in enumerate(user_order):
+                paragraph.insert_paragraph_before(f"{i+1}. {diag}")
+            paragraph._element.getparent().remove(paragraph._element)
+            continue
+        for run in paragraph.runs:
+            if STUDENT_NAME_PLACEHOLDER in run.text:
+                run.text = run.text.replace(STUDENT_NAME_PLACEHOLDER, student_name)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+class ReviewTemplateCache:
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._lock = threading.Lock()
+        # record_id -> (fingerprint, template bytes)
+        self._templates = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, record_id, fingerprint):
+        return os.path.join(self.directory, f"{record_id}_{fingerprint}.docx")
+
+    def get(self, case):
+        record_id = case.record_id
+        fingerprint = case.fingerprint
+        with self._lock:
+            cached = self._templates.get(record_id)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        template = None
+        if self.directory and os.path.exists(self._path(record_id, fingerprint)):
+            with open(self._path(record_id, fingerprint), "rb") as fh:
+                template = fh.read()
+        if template is None:
+            template = render_review_template(case)
+            if self.directory:
+                with open(self._path(record_id, fingerprint), "wb") as fh:
+                    fh.write(template)
+        with self._lock:
+            self._templates[record_id] = (fingerprint, template)
+        return template
+
+    def prerender(self, case_bank):
+        """Renders (or loads) the template of every case in the bank. Returns the count."""
+        for record_id in case_bank.record_ids():
+            self.get(case_bank.get(record_id))
+        return len(case_bank)
+
+
+def generate_review_doc_prioritized(case, user_order, student_name, templates=None):
+    """Builds the review document for a Case in memory and returns it as .docx bytes."""
+    template = templates.get(case) if templates is not None else render_review_template(case)
+    return fill_review_template(template, user_order, student_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-render review templates for every case.")
+    parser.add_argument("--prerender", action="store_true", help="Render templates for the whole case bank.")
+    parser.add_argument("--cases-dir", default=".", help="Directory containing the case CSV files.")
+    parser.add_argument("--out", default="review_templates", help="Directory to write templates to.")
+    args = parser.parse_args()
+    if not args.prerender:
+        parser.error("nothing to do; pass --prerender")
+    count = ReviewTemplateCache(args.out).prerender(CaseBank(args.cases_dir))
+    print(f"Rendered {count} review templates into {args.out}")
@@ -0,0 +1,122 @@
+"""
+Write-behind persistence for in-progress exam sessions.
+
+save() only records which fields differ from what was last written. A background
+thread sends them as a single merge write once the document has been dirty for
+`window` seconds, so a burst of add/reorder/remove clicks becomes one small write.
+flush() writes a document immediately, and every pending write is flushed when the
+process exits. Writes of one document never overlap: flush() and discard() first wait
+for a write already in flight, so a stale merge cannot land after them.
+"""
+import atexit
+import copy
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SessionWriteBehind:
+    def __init__(self, storage, window=2.0):
+        self.storage = storage
+        self.window = window
+        self._cond = threading.Condition()
+        # doc_id -> (changed fields, time the document first became dirty)
+        self._pending = {}
+        # doc_id -> fields as last written to or read from storage
+        self._persisted = {}
+        # doc_ids with a write in progress
+        self._in_flight = set()
+        self._thread = threading.Thread(target=self._run, name="session-write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush_all)
+
+    def remember(self, doc_id, data):
+        """Records data as the stored state of doc_id, e.g. right after loading it."""
+        with self._cond:
+            self._persisted[doc_id] = copy.deepcopy(data)
+
+    def save(self, doc_id, data):
+        """Queues the fields of data that differ from the stored state of doc_id."""
+        with self._cond:
+            persisted = self._persisted.get(doc_id, {})
+            fields, dirty_since = self._pending.get(doc_id, ({}, time.monotonic()))
+            for key, value in data.items():
+                if key in fields or persisted.get(key, object()) != value:
+                    fields[key] = copy.deepcopy(value)
+            if fields:
+                self._pending[doc_id] = (fields, dirty_since)
+                self._cond.notify_all()
+
+    def _take(self, doc_id):
+        # Called with the lock held. The fields count as persisted from here on, so saves
+        # made while the write is in flight are diffed against what is being written.
+        entry = self._pending.pop(doc_id)
+        self._persisted.setdefault(doc_id, {}).update(copy.deepcopy(entry[0]))
+        self._in_flight.add(doc_id)
+        return entry
+
+    def _wait_idle(self, doc_id):
+        # Called with the lock held.
+        while doc_id in self._in_flight:
+            self._cond.wait()
+
+    def flush(self, doc_id):
+        """Writes any pending fields of doc_id now, after any write of it already in flight."""
+        with self._cond:
+            self._wait_idle(doc_id)
+            entry = self._take(doc_id) if doc_id in self._pending else None
+        if entry is not None:
+            self._commit(doc_id, entry)
+
+    def flush_all(self):
+        with self._cond:
+            while self._in_flight:
+                self._cond.wait()
+            entries = [(doc_id, self._take(doc_id)) for doc_id in list(self._pending)]
+        for doc_id, entry in entries:
+            self._commit(doc_id, entry)
+
+    def discard(self, doc_id):
+        """
+        Drops pending and remembered state, e.g. before the session document is deleted.
+        Waits for a write of doc_id already in flight, so it cannot land afterwards.
+        """
+        with self._cond:
+            self._wait_idle(doc_id)
+            self._pending.pop(doc_id, None)
+            self._persisted.pop(doc_id, None)
+
+    def _commit(self, doc_id, entry):
+        fields, dirty_since = entry
+        try:
+            self.storage.save_session(doc_id, fields)
+        except Exception:
+            logger.exception("Writing exam session %s failed; will retry", doc_id)
+            with self._cond:
+                # Keep newer edits made while the write was in flight.
+                newer, _ = self._pending.get(doc_id, ({}, dirty_since))
+                fields.update(newer)
+                # Restart the window so a failing backend is retried, not spun on.
+                self._pending[doc_id] = (fields, time.monotonic())
+        finally:
+            with self._cond:
+                self._in_flight.discard(doc_id)
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                # A document being flushed by another thread waits for that write to end.
+                idle = {doc_id: since for doc_id, (_, since) in self._pending.items() if doc_id not in self._in_flight}
+                due = [doc_id for doc_id, since in idle.items() if now - since >= self.window]
+                if not due:
+                    self._cond.wait(self.window - (now - min(idle.values())) if idle else None)
+                    continue
+                entries = [(doc_id, self._take(doc_id)) for doc_id in due]
+            for doc_id, entry in entries:
+                self._commit(doc_id, entry)
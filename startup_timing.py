@@ -0,0 +1,57 @@
+"""
+Process startup milestones for measuring time-to-first-paint.
+
+This module is imported first by the app script. Streamlit re-executes the script on
+every rerun, but this module is only imported once per process, so its clock starts
+with the first run. mark() records the first time each milestone is reached, and
+report() prints one JSON line with all of them once "first_paint" is marked.
+"""
+import json
+import sys
+import threading
+import time
+
+PROCESS_START = time.perf_counter()
+
+_lock = threading.Lock()
+_milestones = {}
+_reported = False
+
+
+def mark(name):
+    """Records seconds since process start for name, the first time it is reached."""
+    with _lock:
+        _milestones.setdefault(name, round(time.perf_counter() - PROCESS_START, 4))
+
+
+class timed:
+    """Context manager recording how long a one-time initialization step took."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        with _lock:
+            _milestones.setdefault(self.name + "_seconds", round(time.perf_counter() - self._started, 4))
+            _milestones.setdefault(self.name, round(time.perf_counter() - PROCESS_START, 4))
+        return False
+
+
+def milestones():
+    with _lock:
+        return dict(_milestones)
+
+
+def report():
+    """Prints the startup report once per process, after first paint."""
+    global _reported
+    with _lock:
+        if _reported or "first_paint" not in _milestones:
+            return
+        _reported = True
+        payload = dict(_milestones)
+    print("startup_timing " + json.dumps(payload, sort_keys=True), file=sys.stderr, flush=True)
@@ -0,0 +1,817 @@
+"""
+Storage backends for the app's persistent state.
+
+Storage is the interface the rest of the app uses for the records it keeps: recently
+used cases per designation, passcode locks, in-progress exam sessions, completed exams
+and the aggregate counters maintained alongside them (see aggregates.py).
+FirestoreStorage is the production backend (with batched gets and writes);
+MemoryStorage and SqliteStorage serve tests and single-node deployments at local
+latency. Pick one with [storage] backend = "firestore" | "sqlite" | "memory".
+MeteredStorage wraps any of them to time calls and count records read and written.
+
+Timestamps returned by every backend are timezone-aware UTC datetimes.
+"""
+import copy
+import datetime
+import json
+import random
+import sqlite3
+import threading
+
+import metrics
+
+# Firestore allows at most 500 writes per batch.
+BATCH_SIZE = 500
+
+USED_CASES_PREFIX = "global_used_cases"
+LOCKS_COLLECTION = "shelf_records_prioritized"
+SESSIONS_COLLECTION = "exam_sessions_prioritized"
+COMPLETED_COLLECTION = "completed_exam_sessions"
+COUNTERS_COLLECTION = "aggregate_counters"
+
+# Firestore sustains about one write per second per document, so each counter is
+# spread over this many shard documents and read back as their sum.
+COUNTER_SHARDS = 10
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def used_cases_collection(designation):
+    return USED_CASES_PREFIX + "_" + designation if designation else USED_CASES_PREFIX
+
+
+def to_utc(ts):
+    try:
+        return ts.to_datetime()
+    except AttributeError:
+        return ts.replace(tzinfo=datetime.timezone.utc) if ts.tzinfo is None else ts
+
+
+def lock_state(data):
+    """Normalizes a passcode lock record to {"timestamp": datetime or None, "locked": bool}."""
+    if data is None:
+        return None
+    ts = data.get("timestamp")
+    return {"timestamp": to_utc(ts) if ts is not None else None, "locked": bool(data.get("locked", False))}
+
+
+def is_recent(state, window, now=None):
+    if not state or state.get("timestamp") is None:
+        return False
+    return (now or utcnow()) - state["timestamp"] < window
+
+
+class Storage:
+    """Interface implemented by every backend."""
+
+    # Used cases, per preceptor designation.
+    def list_used_cases(self, designation, since):
+        """Returns the set of record_ids marked used at or after since."""
+        raise NotImplementedError
+
+    def delete_used_cases_before(self, designation, cutoff, limit=BATCH_SIZE):
+        """Deletes up to limit used-case records older than cutoff. Returns the count."""
+        raise NotImplementedError
+
+    def reserve_cases(self, designation, record_ids, since, expire_at, counters=None):
+        """
+        In one transaction, marks as used each of record_ids not already marked used at
+        or after since. Returns the record_ids this call reserved, in the given order.
+        counters maps a record_id to the counter deltas to apply if it is reserved.
+        At most reserve_limit(counters per case) record_ids can be passed in one call.
+        """
+        raise NotImplementedError
+
+    def reserve_limit(self, counters_per_case=0):
+        """Most record_ids one reserve_cases call accepts, or None if there is no limit."""
+        return None
+
+    # Passcode locks.
+    def get_locks(self, passcodes):
+        """Returns {passcode: lock state or None} for every passcode."""
+        raise NotImplementedError
+
+    def get_lock(self, passcode):
+        return self.get_locks([passcode])[passcode]
+
+    def claim_lock(self, passcode, window):
+        """
+        Atomically claims passcode unless it was claimed within window.
+        Returns (already_claimed, lock state).
+        """
+        raise NotImplementedError
+
+    def set_lock(self, passcode):
+        """Marks passcode as locked from now on. Returns the new lock state."""
+        raise NotImplementedError
+
+    # In-progress exam sessions.
+    def get_sessions(self, passcodes):
+        """Returns {passcode: session dict or None} for every passcode."""
+        raise NotImplementedError
+
+    def get_session(self, passcode):
+        return self.get_sessions([passcode])[passcode]
+
+    def save_session(self, passcode, fields, delete_fields=()):
+        """Merges fields into the session, removing delete_fields."""
+        raise NotImplementedError
+
+    def delete_session(self, passcode):
+        raise NotImplementedError
+
+    # Completed exams.
+    def add_completed_exam(self, submission_id, data, counters=None):
+        """
+        Stores a completed exam under submission_id; writing the same id twice is a no-op.
+        The counter deltas are applied with the first write only.
+        """
+        raise NotImplementedError
+
+    def list_completed_exams(self, after=None, limit=BATCH_SIZE):
+        """
+        One page of completed exams as (submission_id, data) ordered by (timestamp, id),
+        starting after the (timestamp, id) cursor `after`. data includes "timestamp".
+        """
+        raise NotImplementedError
+
+    # Aggregate counters, as {counter name: {field: delta or total}}.
+    def increment_counters(self, deltas):
+        raise NotImplementedError
+
+    def get_counters(self, names=None):
+        """Returns the totals of the named counters, or of every counter."""
+        raise NotImplementedError
+
+    def replace_counters(self, totals):
+        """Replaces every counter with totals, e.g. after rebuilding them from history."""
+        raise NotImplementedError
+
+
+class FirestoreStorage(Storage):
+    def __init__(self, db, counter_shards=COUNTER_SHARDS):
+        from firebase_admin import firestore
+
+        self.db = db
+        self.counter_shards = counter_shards
+        self._firestore = firestore
+
+    def list_used_cases(self, designation, since):
+        query = self.db.collection(used_cases_collection(designation)).where("timestamp", ">=", since)
+        return {doc.id for doc in query.stream()}
+
+    def delete_used_cases_before(self, designation, cutoff, limit=BATCH_SIZE):
+        collection = self.db.collection(used_cases_collection(designation))
+        docs = list(collection.where("timestamp", "<", cutoff).limit(min(limit, BATCH_SIZE)).stream())
+        if docs:
+            batch = self.db.batch()
+            for doc in docs:
+                batch.delete(doc.reference)
+            batch.commit()
+        return len(docs)
+
+    def reserve_cases(self, designation, record_ids, since, expire_at, counters=None):
+        collection = self.db.collection(used_cases_collection(designation))
+        counters = counters or {}
+        limit = self.reserve_limit(max(map(len, counters.values()), default=0))
+        if len(record_ids) > limit:
+            raise ValueError(f"Cannot reserve {len(record_ids)} cases in one transaction; the limit is {limit}")
+        refs = [collection.document(str(r)) for r in record_ids]
+
+        @self._firestore.transactional
+        def reserve(transaction):
+            taken = set()
+            for doc in self.db.get_all(refs, transaction=transaction):
+                ts = (doc.to_dict() or {}).get("timestamp") if doc.exists else None
+                if ts is not None and to_utc(ts) >= since:
+                    taken.add(doc.id)
+            reserved = [ref.id for ref in refs if ref.id not in taken]
+            for ref in refs:
+                if ref.id not in taken:
+                    transaction.set(ref, {
+                        "used": True,
+                        "timestamp": self._firestore.SERVER_TIMESTAMP,
+                        "expire_at": expire_at,
+                    })
+                    self._write_counters(transaction, counters.get(ref.id, {}))
+            return reserved
+
+        return reserve(self.db.transaction())
+
+    def reserve_limit(self, counters_per_case=0):
+        # Each reserved case also writes its counter shards; stay within one batch's writes.
+        return BATCH_SIZE // (1 + counters_per_case)
+
+    def _lock_ref(self, passcode):
+        return self.db.collection(LOCKS_COLLECTION).document(passcode)
+
+    def get_locks(self, passcodes):
+        states = {p: None for p in passcodes}
+        for doc in self.db.get_all([self._lock_ref(p) for p in passcodes]):
+            states[doc.id] = lock_state(doc.to_dict()) if doc.exists else None
+        return states
+
+    def get_lock(self, passcode):
+        doc = self._lock_ref(passcode).get()
+        return lock_state(doc.to_dict()) if doc.exists else None
+
+    def claim_lock(self, passcode, window):
+        ref = self._lock_ref(passcode)
+
+        @self._firestore.transactional
+        def check_and_set(transaction):
+            doc = ref.get(transaction=transaction)
+            state = lock_state(doc.to_dict()) if doc.exists else None
+            if is_recent(state, window):
+                return True, state
+            transaction.set(ref, {"processed": True, "timestamp": self._firestore.SERVER_TIMESTAMP})
+            return False, {"timestamp": utcnow(), "locked": False}
+
+        return check_and_set(self.db.transaction())
+
+    def set_lock(self, passcode):
+        self._lock_ref(passcode).set({
+            "processed": True,
+            "timestamp": self._firestore.SERVER_TIMESTAMP,
+            "locked": True,
+        })
+        return {"timestamp": utcnow(), "locked": True}
+
+    def _session_ref(self, passcode):
+        return self.db.collection(SESSIONS_COLLECTION).document(passcode)
+
+    def get_sessions(self, passcodes):
+        sessions = {p: None for p in passcodes}
+        for doc in self.db.get_all([self._session_ref(p) for p in passcodes]):
+            sessions[doc.id] = doc.to_dict() if doc.exists else None
+        return sessions
+
+    def get_session(self, passcode):
+        doc = self._session_ref(passcode).get()
+        return doc.to_dict() if doc.exists else None
+
+    def save_session(self, passcode, fields, delete_fields=()):
+        data = dict(fields)
+        for field in delete_fields:
+            data[field] = self._firestore.DELETE_FIELD
+        data["timestamp"] = self._firestore.SERVER_TIMESTAMP
+        self._session_ref(passcode).set(data, merge=True)
+
+    def delete_session(self, passcode):
+        self._session_ref(passcode).delete()
+
+    def add_completed_exam(self, submission_id, data, counters=None):
+        from google.api_core.exceptions import AlreadyExists
+
+        # create() fails if the exam exists, and the whole batch with it, so a retried
+        # write neither overwrites the exam nor counts it twice.
+        batch = self.db.batch()
+        batch.create(
+            self.db.collection(COMPLETED_COLLECTION).document(submission_id),
+            dict(data, timestamp=self._firestore.SERVER_TIMESTAMP),
+        )
+        self._write_counters(batch, counters or {})
+        try:
+            batch.commit()
+        except AlreadyExists:
+            pass
+
+    def list_completed_exams(self, after=None, limit=BATCH_SIZE):
+        query = self.db.collection(COMPLETED_COLLECTION).order_by("timestamp").order_by("__name__")
+        if after is not None:
+            query = query.start_after({"timestamp": after[0], "__name__": after[1]})
+        page = []
+        for doc in query.limit(limit).stream():
+            data = doc.to_dict()
+            data["timestamp"] = to_utc(data["timestamp"])
+            page.append((doc.id, data))
+        return page
+
+    def _counter_ref(self, name, shard):
+        # Document ids cannot contain slashes; the real name is kept in the document.
+        return self.db.collection(COUNTERS_COLLECTION).document(f"{name.replace('/', '%2F')}#{shard}")
+
+    def _write_counters(self, writer, deltas):
+        """Adds deltas to one random shard of each counter through a batch or transaction."""
+        for name, fields in deltas.items():
+            shard = random.randrange(self.counter_shards)
+            data = {field: self._firestore.Increment(n) for field, n in fields.items()}
+            writer.set(self._counter_ref(name, shard), dict(data, name=name, shard=shard), merge=True)
+
+    def increment_counters(self, deltas):
+        batch = self.db.batch()
+        self._write_counters(batch, deltas)
+        batch.commit()
+
+    def get_counters(self, names=None):
+        collection = self.db.collection(COUNTERS_COLLECTION)
+        if names is None:
+            queries = [collection]
+        else:
+            names = list(names)
+            # "in" takes at most 30 values.
+            queries = [collection.where("name", "in", names[i:i + 30]) for i in range(0, len(names), 30)]
+        totals = {}
+        for query in queries:
+            for doc in query.stream():
+                data = doc.to_dict()
+                counter = totals.setdefault(data.pop("name"), {})
+                data.pop("shard", None)
+                for field, n in data.items():
+                    counter[field] = counter.get(field, 0) + n
+        return totals
+
+    def replace_counters(self, totals):
+        collection = self.db.collection(COUNTERS_COLLECTION)
+        while True:
+            docs = list(collection.limit(BATCH_SIZE).stream())
+            if not docs:
+                break
+            batch = self.db.batch()
+            for doc in docs:
+                batch.delete(doc.reference)
+            batch.commit()
+        items = list(totals.items())
+        for start in range(0, len(items), BATCH_SIZE):
+            batch = self.db.batch()
+            for name, fields in items[start:start + BATCH_SIZE]:
+                batch.set(self._counter_ref(name, 0), dict(fields, name=name, shard=0))
+            batch.commit()
+
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self._lock = threading.RLock()
+        # designation -> {record_id: {"timestamp", "expire_at"}}
+        self.used_cases = {}
+        self.locks = {}
+        self.sessions = {}
+        self.completed = {}
+        self.counters = {}
+
+    def list_used_cases(self, designation, since):
+        with self._lock:
+            used = self.used_cases.get(designation, {})
+            return {rid for rid, data in used.items() if data["timestamp"] >= since}
+
+    def delete_used_cases_before(self, designation, cutoff, limit=BATCH_SIZE):
+        with self._lock:
+            used = self.used_cases.get(designation, {})
+            expired = [rid for rid, data in used.items() if data["timestamp"] < cutoff][:limit]
+            for rid in expired:
+                del used[rid]
+            return len(expired)
+
+    def reserve_cases(self, designation, record_ids, since, expire_at, counters=None):
+        now = utcnow()
+        with self._lock:
+            used = self.used_cases.setdefault(designation, {})
+            reserved = []
+            for record_id in map(str, record_ids):
+                if record_id in used and used[record_id]["timestamp"] >= since:
+                    continue
+                used[record_id] = {"used": True, "timestamp": now, "expire_at": expire_at}
+                reserved.append(record_id)
+                self.increment_counters((counters or {}).get(record_id, {}))
+            return reserved
+
+    def get_locks(self, passcodes):
+        with self._lock:
+            return {p: lock_state(self.locks.get(p)) for p in passcodes}
+
+    def claim_lock(self, passcode, window):
+        with self._lock:
+            state = lock_state(self.locks.get(passcode))
+            if is_recent(state, window):
+                return True, state
+            self.locks[passcode] = {"processed": True, "timestamp": utcnow()}
+            return False, lock_state(self.locks[passcode])
+
+    def set_lock(self, passcode):
+        with self._lock:
+            self.locks[passcode] = {"processed": True, "timestamp": utcnow(), "locked": True}
+            return lock_state(self.locks[passcode])
+
+    def get_sessions(self, passcodes):
+        with self._lock:
+            return {p: copy.deepcopy(self.sessions.get(p)) for p in passcodes}
+
+    def save_session(self, passcode, fields, delete_fields=()):
+        with self._lock:
+            session = self.sessions.setdefault(passcode, {})
+            session.update(copy.deepcopy(fields))
+            for field in delete_fields:
+                session.pop(field, None)
+            session["timestamp"] = utcnow()
+
+    def delete_session(self, passcode):
+        with self._lock:
+            self.sessions.pop(passcode, None)
+
+    def add_completed_exam(self, submission_id, data, counters=None):
+        with self._lock:
+            if submission_id not in self.completed:
+                self.completed[submission_id] = dict(copy.deepcopy(data), timestamp=utcnow())
+                self.increment_counters(counters or {})
+
+    def list_completed_exams(self, after=None, limit=BATCH_SIZE):
+        with self._lock:
+            rows = sorted((data["timestamp"], sid) for sid, data in self.completed.items())
+            if after is not None:
+                rows = [row for row in rows if row > tuple(after)]
+            return [(sid, copy.deepcopy(self.completed[sid])) for _, sid in rows[:limit]]
+
+    def increment_counters(self, deltas):
+        with self._lock:
+            for name, fields in deltas.items():
+                counter = self.counters.setdefault(name, {})
+                for field, n in fields.items():
+                    counter[field] = counter.get(field, 0) + n
+
+    def get_counters(self, names=None):
+        with self._lock:
+            names = self.counters if names is None else names
+            return {name: dict(self.counters[name]) for name in names if name in self.counters}
+
+    def replace_counters(self, totals):
+        with self._lock:
+            self.counters = {name: dict(fields) for name, fields in totals.items()}
+
+
+class MeteredStorage(Storage):
+    """
+    Wraps a backend, timing every call as a `storage.<method>` span and counting
+    records read and written (storage_reads / storage_writes), as Firestore bills them.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _call(self, method, *args, reads=0, writes=0, **kwargs):
+        with metrics.span("storage." + method):
+            result = getattr(self.backend, method)(*args, **kwargs)
+        if callable(reads):
+            reads = reads(result)
+        if reads:
+            metrics.count("storage_reads", reads)
+        if writes:
+            metrics.count("storage_writes", writes)
+        return result
+
+    @staticmethod
+    def _size(result):
+        # A query or lookup costs at least one read even when nothing matches.
+        return max(1, len(result))
+
+    def list_used_cases(self, designation, since):
+        return self._call("list_used_cases", designation, since, reads=self._size)
+
+    def delete_used_cases_before(self, designation, cutoff, limit=BATCH_SIZE):
+        deleted = self._call("delete_used_cases_before", designation, cutoff, limit, reads=lambda n: max(1, n))
+        metrics.count("storage_writes", deleted)
+        return deleted
+
+    def reserve_cases(self, designation, record_ids, since, expire_at, counters=None):
+        reserved = self._call(
+            "reserve_cases", designation, record_ids, since, expire_at, counters, reads=len(record_ids)
+        )
+        metrics.count("storage_writes", len(reserved) + sum(len((counters or {}).get(r, ())) for r in reserved))
+        return reserved
+
+    def reserve_limit(self, counters_per_case=0):
+        return self.backend.reserve_limit(counters_per_case)
+
+    def get_locks(self, passcodes):
+        return self._call("get_locks", passcodes, reads=self._size)
+
+    def get_lock(self, passcode):
+        return self._call("get_lock", passcode, reads=1)
+
+    def claim_lock(self, passcode, window):
+        return self._call("claim_lock", passcode, window, reads=1, writes=1)
+
+    def set_lock(self, passcode):
+        return self._call("set_lock", passcode, writes=1)
+
+    def get_sessions(self, passcodes):
+        return self._call("get_sessions", passcodes, reads=self._size)
+
+    def get_session(self, passcode):
+        return self._call("get_session", passcode, reads=1)
+
+    def save_session(self, passcode, fields, delete_fields=()):
+        return self._call("save_session", passcode, fields, delete_fields, writes=1)
+
+    def delete_session(self, passcode):
+        return self._call("delete_session", passcode, writes=1)
+
+    def add_completed_exam(self, submission_id, data, counters=None):
+        return self._call("add_completed_exam", submission_id, data, counters, writes=1 + len(counters or ()))
+
+    def list_completed_exams(self, after=None, limit=BATCH_SIZE):
+        return self._call("list_completed_exams", after, limit, reads=self._size)
+
+    def increment_counters(self, deltas):
+        return self._call("increment_counters", deltas, writes=len(deltas))
+
+    def get_counters(self, names=None):
+        # Every shard document of a counter is a read.
+        shards = getattr(self.backend, "counter_shards", 1)
+        return self._call("get_counters", names, reads=lambda totals: max(1, len(totals) * shards))
+
+    def replace_counters(self, totals):
+        return self._call("replace_counters", totals, writes=len(totals))
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {"$datetime": value.isoformat()}
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _decode(obj):
+    if set(obj) == {"$datetime"}:
+        return datetime.datetime.fromisoformat(obj["$datetime"])
+    return obj
+
+
+def _dumps(data):
+    return json.dumps(data, default=_encode)
+
+
+def _loads(text):
+    return json.loads(text, object_hook=_decode)
+
+
+def _from_epoch(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc)
+
+
+class SqliteStorage(Storage):
+    def __init__(self, path="clin_reason.sqlite3"):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS used_cases (
+                designation TEXT NOT NULL,
+                record_id TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                expire_at REAL,
+                PRIMARY KEY (designation, record_id)
+            );
+            CREATE INDEX IF NOT EXISTS used_cases_by_time ON used_cases (designation, timestamp);
+            CREATE TABLE IF NOT EXISTS passcode_locks (
+                passcode TEXT PRIMARY KEY,
+                timestamp REAL NOT NULL,
+                locked INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS exam_sessions (
+                passcode TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                timestamp REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS completed_exams (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                timestamp REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS completed_exams_by_time ON completed_exams (timestamp, id);
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT NOT NULL,
+                field TEXT NOT NULL,
+                value INTEGER NOT NULL,
+                PRIMARY KEY (name, field)
+            );
+            """
+        )
+
+    def _transaction(self):
+        return _SqliteTransaction(self)
+
+    def list_used_cases(self, designation, since):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT record_id FROM used_cases WHERE designation = ? AND timestamp >= ?",
+                (designation, since.timestamp()),
+            ).fetchall()
+        return {r[0] for r in rows}
+
+    def delete_used_cases_before(self, designation, cutoff, limit=BATCH_SIZE):
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "DELETE FROM used_cases WHERE rowid IN ("
+                "SELECT rowid FROM used_cases WHERE designation = ? AND timestamp < ? LIMIT ?)",
+                (designation, cutoff.timestamp(), limit),
+            )
+            return cursor.rowcount
+
+    def reserve_cases(self, designation, record_ids, since, expire_at, counters=None):
+        now = utcnow().timestamp()
+        expire = expire_at.timestamp() if expire_at else None
+        record_ids = [str(r) for r in record_ids]
+        with self._transaction() as conn:
+            taken = {
+                row[0] for row in conn.execute(
+                    f"SELECT record_id FROM used_cases WHERE designation = ? AND timestamp >= ? "
+                    f"AND record_id IN ({','.join('?' * len(record_ids))})",
+                    [designation, since.timestamp(), *record_ids],
+                )
+            }
+            reserved = [r for r in record_ids if r not in taken]
+            conn.executemany(
+                "INSERT OR REPLACE INTO used_cases (designation, record_id, timestamp, expire_at) VALUES (?, ?, ?, ?)",
+                [(designation, r, now, expire) for r in reserved],
+            )
+            for record_id in reserved:
+                self._increment(conn, (counters or {}).get(record_id, {}))
+        return reserved
+
+    @staticmethod
+    def _lock_row(row):
+        return {"timestamp": _from_epoch(row[0]), "locked": bool(row[1])} if row else None
+
+    def get_locks(self, passcodes):
+        passcodes = list(passcodes)
+        states = {p: None for p in passcodes}
+        with self._lock:
+            for start in range(0, len(passcodes), BATCH_SIZE):
+                chunk = passcodes[start:start + BATCH_SIZE]
+                rows = self._conn.execute(
+                    f"SELECT passcode, timestamp, locked FROM passcode_locks "
+                    f"WHERE passcode IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                for passcode, ts, locked in rows:
+                    states[passcode] = self._lock_row((ts, locked))
+        return states
+
+    def claim_lock(self, passcode, window):
+        with self._transaction() as conn:
+            state = self._lock_row(
+                conn.execute("SELECT timestamp, locked FROM passcode_locks WHERE passcode = ?", (passcode,)).fetchone()
+            )
+            if is_recent(state, window):
+                return True, state
+            now = utcnow()
+            conn.execute(
+                "INSERT OR REPLACE INTO passcode_locks (passcode, timestamp, locked) VALUES (?, ?, 0)",
+                (passcode, now.timestamp()),
+            )
+            return False, {"timestamp": now, "locked": False}
+
+    def set_lock(self, passcode):
+        now = utcnow()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO passcode_locks (passcode, timestamp, locked) VALUES (?, ?, 1)",
+                (passcode, now.timestamp()),
+            )
+        return {"timestamp": now, "locked": True}
+
+    def get_sessions(self, passcodes):
+        passcodes = list(passcodes)
+        sessions = {p: None for p in passcodes}
+        with self._lock:
+            for start in range(0, len(passcodes), BATCH_SIZE):
+                chunk = passcodes[start:start + BATCH_SIZE]
+                rows = self._conn.execute(
+                    f"SELECT passcode, data, timestamp FROM exam_sessions "
+                    f"WHERE passcode IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                for passcode, data, ts in rows:
+                    sessions[passcode] = dict(_loads(data), timestamp=_from_epoch(ts))
+        return sessions
+
+    def save_session(self, passcode, fields, delete_fields=()):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT data FROM exam_sessions WHERE passcode = ?", (passcode,)).fetchone()
+            session = _loads(row[0]) if row else {}
+            session.update(fields)
+            for field in delete_fields:
+                session.pop(field, None)
+            conn.execute(
+                "INSERT OR REPLACE INTO exam_sessions (passcode, data, timestamp) VALUES (?, ?, ?)",
+                (passcode, _dumps(session), utcnow().timestamp()),
+            )
+
+    def delete_session(self, passcode):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM exam_sessions WHERE passcode = ?", (passcode,))
+
+    def add_completed_exam(self, submission_id, data, counters=None):
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO completed_exams (id, data, timestamp) VALUES (?, ?, ?)",
+                (submission_id, _dumps(data), round(utcnow().timestamp(), 6)),
+            )
+            if cursor.rowcount:
+                self._increment(conn, counters or {})
+
+    def list_completed_exams(self, after=None, limit=BATCH_SIZE):
+        if after is None:
+            sql, params = "SELECT id, data, timestamp FROM completed_exams", []
+        else:
+            # Timestamps are whole microseconds; compare within half of one so a cursor
+            # that went through a datetime still matches its row exactly.
+            ts = after[0].timestamp()
+            sql = ("SELECT id, data, timestamp FROM completed_exams "
+                   "WHERE timestamp > ? OR (timestamp > ? AND id > ?)")
+            params = [ts + 5e-7, ts - 5e-7, after[1]]
+        with self._lock:
+            rows = self._conn.execute(sql + " ORDER BY timestamp, id LIMIT ?", params + [limit]).fetchall()
+        return [(sid, dict(_loads(data), timestamp=_from_epoch(ts))) for sid, data, ts in rows]
+
+    @staticmethod
+    def _increment(conn, deltas):
+        conn.executemany(
+            "INSERT INTO counters (name, field, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (name, field) DO UPDATE SET value = value + excluded.value",
+            [(name, field, n) for name, fields in deltas.items() for field, n in fields.items()],
+        )
+
+    def increment_counters(self, deltas):
+        with self._transaction() as conn:
+            self._increment(conn, deltas)
+
+    def get_counters(self, names=None):
+        sql, params = "SELECT name, field, value FROM counters", []
+        if names is not None:
+            names = list(names)
+            sql += f" WHERE name IN ({','.join('?' * len(names))})"
+            params = names
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        totals = {}
+        for name, field, value in rows:
+            totals.setdefault(name, {})[field] = value
+        return totals
+
+    def replace_counters(self, totals):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM counters")
+            self._increment(conn, totals)
+
+
+def open_storage(config, db=None):
+    """
+    Backend named by a [storage] config section, wrapped in MeteredStorage. db is the
+    Firestore client, or a function returning it, used when the backend is "firestore".
+    """
+    backend = config.get("backend", "firestore")
+    if backend == "memory":
+        storage = MemoryStorage()
+    elif backend == "sqlite":
+        storage = SqliteStorage(config.get("path", "clin_reason.sqlite3"))
+    else:
+        storage = FirestoreStorage(db() if callable(db) else db, int(config.get("counter_shards", COUNTER_SHARDS)))
+    return MeteredStorage(storage)
+
+
+def firestore_client(service_account):
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate(dict(service_account)))
+    return firestore.client()
+
+
+def load_secrets(path=".streamlit/secrets.toml"):
+    import tomllib
+
+    with open(path, "rb") as fh:
+        return tomllib.load(fh)
+
+
+def open_storage_from_secrets(path=".streamlit/secrets.toml"):
+    """The app's configured storage, for command-line tools run outside Streamlit."""
+    secrets = load_secrets(path)
+    return open_storage(secrets.get("storage", {}), lambda: firestore_client(secrets["firebase_service_account"]))
+
+
+class _SqliteTransaction:
+    """BEGIN IMMEDIATE ... COMMIT under the storage's thread lock, rolled back on error."""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __enter__(self):
+        self.storage._lock.acquire()
+        try:
+            self.storage._conn.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.storage._lock.release()
+            raise
+        return self.storage._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.storage._conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.storage._lock.release()
+        return False
@@ -0,0 +1,176 @@
+"""
+Durable background queue for the side effects of submitting an exam.
+
+Jobs are rows in a SQLite file, so they survive a restart of the app process, and are
+run by a worker thread that retries failures with exponential backoff. Handlers are
+plain functions taking the job payload, registered by job kind.
+
+Several app processes may share the queue file. A claimed job is leased to the queue
+that claimed it; another process takes it over only once the lease has run out,
+e.g. because the process that claimed it died.
+"""
+import datetime
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    def __init__(self, path="submission_jobs.sqlite3", lease=300.0):
+        self.lease = lease
+        # Marks the jobs this queue claimed, so a lease is only renewed by its holder.
+        self.owner = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                       id TEXT PRIMARY KEY,
+                       kind TEXT NOT NULL,
+                       payload TEXT NOT NULL,
+                       status TEXT NOT NULL DEFAULT 'pending',
+                       attempts INTEGER NOT NULL DEFAULT 0,
+                       next_run_at REAL NOT NULL,
+                       last_error TEXT,
+                       created_at TEXT NOT NULL,
+                       owner TEXT,
+                       lease_until REAL
+                   )"""
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            for column in ("owner TEXT", "lease_until REAL"):
+                if column.split()[0] not in columns:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, next_run_at)")
+
+    def enqueue(self, kind, payload, delay=0):
+        job_id = uuid.uuid4().hex
+        created_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, payload, next_run_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), time.time() + delay, created_at),
+            )
+        return job_id
+
+    def claim_due(self, limit=10):
+        """
+        Leases up to limit due jobs to this queue and returns them as (id, kind, payload, attempts).
+        Due jobs are pending ones whose time has come and running ones whose lease has expired.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            # One UPDATE, so two processes cannot claim the same job.
+            self._conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, lease_until = ? WHERE id IN ("
+                "SELECT id FROM jobs WHERE (status = 'pending' AND next_run_at <= ?) "
+                "OR (status = 'running' AND COALESCE(lease_until, 0) <= ?) ORDER BY next_run_at LIMIT ?)",
+                (self.owner, now + self.lease, now, now, limit),
+            )
+            rows = self._conn.execute(
+                "SELECT id, kind, payload, attempts FROM jobs WHERE status = 'running' AND owner = ? "
+                "AND lease_until = ? ORDER BY next_run_at",
+                (self.owner, now + self.lease),
+            ).fetchall()
+        return [(job_id, kind, json.loads(payload), attempts) for job_id, kind, payload, attempts in rows]
+
+    def renew(self, job_id):
+        """Extends the lease on a claimed job. False if the job is no longer leased to this queue."""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running' AND owner = ?",
+                (time.time() + self.lease, job_id, self.owner),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def retry(self, job_id, error, delay):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'pending', attempts = attempts + 1, next_run_at = ?, last_error = ?, "
+                "owner = NULL, lease_until = NULL WHERE id = ?",
+                (time.time() + delay, error, job_id),
+            )
+
+    def fail(self, job_id, error):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?",
+                (error, job_id),
+            )
+
+    def counts(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+class JobWorker:
+    """
+    Runs the queue's jobs with handlers[kind](payload). A failed job is retried up to
+    max_attempts times, or attempts_by_kind[kind] if given there, where None means it
+    is retried until it succeeds.
+    """
+
+    def __init__(self, queue, handlers, max_attempts=6, base_delay=2.0, max_delay=600.0, poll_interval=0.5,
+                 attempts_by_kind=None):
+        self.queue = queue
+        self.handlers = handlers
+        self.max_attempts = max_attempts
+        self.attempts_by_kind = attempts_by_kind or {}
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="submission-jobs", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, kind, payload):
+        job_id = self.queue.enqueue(kind, payload)
+        self._wake.set()
+        return job_id
+
+    def _backoff(self, attempts):
+        # The exponent is capped so a job retried forever does not overflow the float.
+        delay = min(self.max_delay, self.base_delay * 2 ** min(attempts, 32))
+        return delay * random.uniform(0.5, 1.0)
+
+    def run_pending(self):
+        """Runs every due job once. Returns the number of jobs attempted."""
+        jobs = self.queue.claim_due()
+        for job_id, kind, payload, attempts in jobs:
+            # Jobs of a batch run one after another; each starts with a fresh lease.
+            if not self.queue.renew(job_id):
+                continue
+            try:
+                self.handlers[kind](payload)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                max_attempts = self.attempts_by_kind.get(kind, self.max_attempts)
+                if max_attempts is not None and attempts + 1 >= max_attempts:
+                    logger.error("Job %s (%s) failed permanently: %s", job_id, kind, error)
+                    self.queue.fail(job_id, error)
+                else:
+                    logger.warning("Job %s (%s) failed, retrying: %s", job_id, kind, error)
+                    self.queue.retry(job_id, error, self._backoff(attempts))
+            else:
+                self.queue.complete(job_id)
+        return len(jobs)
+
+    def _run(self):
+        while True:
+            try:
+                if self.run_pending():
+                    continue
+            except Exception:
+                logger.exception("Submission job loop failed")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
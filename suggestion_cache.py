@@ -0,0 +1,109 @@
+"""
+Cross-session cache of AI diagnosis suggestions.
+
+Entries are keyed by (record_id, hash of the case's choices, normalized query) so every
+student on the same case shares one answer per query. The in-memory tier is an LRU; an
+optional second tier (SQLite on local disk, or a Firestore collection) survives restarts
+and is shared by every instance pointing at it. Hits, misses, and the LLM latency and
+tokens those hits avoided are counted in metrics (suggestion_cache_* counters), so
+they are exported with the other Prometheus counters.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import metrics
+from diagnosis_matcher import normalize
+
+
+def choices_hash(choices):
+    return hashlib.sha1("\n".join(choices).encode("utf-8")).hexdigest()[:16]
+
+
+def suggestion_key(record_id, choices, query):
+    return f"{record_id}:{choices_hash(choices)}:{normalize(query)}"
+
+
+class SqliteSuggestionStore:
+    def __init__(self, path="suggestion_cache.sqlite3"):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS suggestions (key TEXT PRIMARY KEY, entry TEXT NOT NULL)")
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT entry FROM suggestions WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, entry):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO suggestions (key, entry) VALUES (?, ?)", (key, json.dumps(entry))
+            )
+
+
+class FirestoreSuggestionStore:
+    def __init__(self, db, collection="ai_suggestion_cache"):
+        # Imported here so the memory and disk tiers do not load firebase_admin.
+        from firebase_admin import firestore
+
+        self._firestore = firestore
+        self.collection = db.collection(collection)
+
+    @staticmethod
+    def _doc_id(key):
+        # Queries can contain "/", which Firestore does not allow in document ids.
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        doc = self.collection.document(self._doc_id(key)).get()
+        return doc.to_dict().get("entry") if doc.exists else None
+
+    def set(self, key, entry):
+        self.collection.document(self._doc_id(key)).set(
+            {"key": key, "entry": entry, "timestamp": self._firestore.SERVER_TIMESTAMP}
+        )
+
+
+class SuggestionCache:
+    def __init__(self, max_entries=2048, store=None):
+        self.max_entries = max_entries
+        self.store = store
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Returns the cached suggestion for key, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None and self.store is not None:
+            entry = self.store.get(key)
+            if entry is not None:
+                metrics.count("suggestion_cache_store_hits")
+                with self._lock:
+                    self._remember(key, entry)
+        if entry is None:
+            metrics.count("suggestion_cache_misses")
+            return None
+        metrics.count("suggestion_cache_hits")
+        metrics.count("suggestion_cache_saved_seconds", entry.get("latency", 0.0))
+        metrics.count("suggestion_cache_saved_tokens", entry.get("tokens", 0))
+        return entry["suggestion"]
+
+    def set(self, key, suggestion, latency=0.0, tokens=0):
+        entry = {"suggestion": suggestion, "latency": latency, "tokens": tokens}
+        with self._lock:
+            self._remember(key, entry)
+        if self.store is not None:
+            self.store.set(key, entry)
@@ -0,0 +1,128 @@
+"""
+Background execution of AI suggestion lookups.
+
+Lookups run on a bounded, process-wide thread pool so a slow OpenAI response never
+blocks a Streamlit rerun. Each session only keeps its latest query: a query waits out
+the debounce delay on a timer before it is handed to the pool, and a newer query
+cancels it if it has not started, so superseded queries never occupy a worker or call
+the API. A circuit breaker fails lookups fast after repeated errors so a degraded API
+does not tie up every worker.
+"""
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the API while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_after=30):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    def allow(self):
+        """True if a call may go through; after reset_after one trial call is let through."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_running or time.monotonic() - self._opened_at < self.reset_after:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+
+class SuggestionService:
+    def __init__(self, max_workers=4, debounce=0.3, breaker=None):
+        self.debounce = debounce
+        self.breaker = breaker or CircuitBreaker()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ai-suggestion")
+        self._lock = threading.Lock()
+        # session key -> (future, debounce timer or None) of the latest query
+        self._latest = {}
+
+    def _is_latest(self, session_key, future):
+        with self._lock:
+            latest = self._latest.get(session_key)
+            return latest is not None and latest[0] is future
+
+    def _start(self, session_key, future, fn, args):
+        # Runs when the debounce delay is over; only a query still the latest gets a worker.
+        if self._is_latest(session_key, future):
+            self._pool.submit(self._run, session_key, future, fn, args)
+        else:
+            future.cancel()
+
+    def _run(self, session_key, future, fn, args):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            if not self._is_latest(session_key, future):
+                future.set_result(None)
+                return
+            if not self.breaker.allow():
+                raise CircuitOpenError("AI suggestions are temporarily unavailable.")
+            try:
+                result = fn(*args)
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def submit(self, session_key, fn, *args):
+        """Schedules fn(*args) as the latest lookup for session_key and returns its future."""
+        future = Future()
+        timer = None
+        with self._lock:
+            previous = self._latest.get(session_key)
+            if self.debounce:
+                timer = threading.Timer(self.debounce, self._start, (session_key, future, fn, args))
+                timer.daemon = True
+            self._latest[session_key] = (future, timer)
+        if previous is not None:
+            if previous[1] is not None:
+                previous[1].cancel()
+            previous[0].cancel()
+        if timer is not None:
+            timer.start()
+        else:
+            self._start(session_key, future, fn, args)
+        return future
+
+    def discard(self, session_key, future):
+        """Forgets the session's lookup if it is still the latest one, dropping it if it has not started."""
+        with self._lock:
+            latest = self._latest.get(session_key)
+            if latest is None or latest[0] is not future:
+                return
+            del self._latest[session_key]
+        if latest[1] is not None:
+            latest[1].cancel()
+        future.cancel()
@@ -0,0 +1,105 @@
+import random
+
+import pytest
+
+from case_availability import CaseAvailability, FreeList
+from storage import MemoryStorage
+from used_cases import UsedCaseTracker
+
+
+def check_invariants(free):
+    # The index maps every item to its slot, so membership, discard and draw are O(1).
+    assert len(free._items) == len(free._index) == len(free)
+    assert all(free._items[i] == item for item, i in free._index.items())
+
+
+def test_add_is_idempotent():
+    free = FreeList(["a", "b", "a"])
+    free.add("b")
+    free.add("c")
+    assert sorted(free._items) == ["a", "b", "c"]
+    check_invariants(free)
+
+
+def test_discard_keeps_index_consistent():
+    rng = random.Random(1)
+    items = list(range(200))
+    free = FreeList(items)
+    expected = set(items)
+    for _ in range(2000):
+        item = rng.randrange(250)
+        if rng.random() < 0.5:
+            free.discard(item)
+            expected.discard(item)
+        else:
+            free.add(item)
+            expected.add(item)
+        assert (item in free) == (item in expected)
+    assert set(free._items) == expected
+    check_invariants(free)
+
+
+def test_draw_removes_every_item_once():
+    free = FreeList(range(50))
+    drawn = [free.draw(random.Random(7)) for _ in range(50)]
+    assert sorted(drawn) == list(range(50))
+    assert len(free) == 0
+    check_invariants(free)
+    with pytest.raises(ValueError):
+        free.draw()
+
+
+def test_draw_is_uniform():
+    rng = random.Random(3)
+    counts = {item: 0 for item in "abcd"}
+    for _ in range(8000):
+        free = FreeList("abcd")
+        counts[free.draw(rng)] += 1
+    assert all(1800 < n < 2200 for n in counts.values())
+
+
+class CaseBank:
+    def __init__(self, record_ids):
+        self._record_ids = list(record_ids)
+
+    def record_ids(self):
+        return self._record_ids
+
+    def __contains__(self, record_id):
+        return record_id in self._record_ids
+
+
+class LimitedStorage(MemoryStorage):
+    def reserve_limit(self, counters_per_case=0):
+        return 5
+
+
+def test_batches_are_capped_at_the_reserve_limit():
+    storage = LimitedStorage()
+    calls = []
+    reserve_cases = storage.reserve_cases
+
+    def recording_reserve(designation, record_ids, *args, **kwargs):
+        calls.append(len(record_ids))
+        return reserve_cases(designation, record_ids, *args, **kwargs)
+
+    storage.reserve_cases = recording_reserve
+    bank = CaseBank(f"r{i}" for i in range(30))
+    availability = CaseAvailability(bank, UsedCaseTracker(storage), reserve_batch=12, rng=random.Random(5))
+    drawn = availability.draw_many("aaa", 12)
+    assert len(set(drawn)) == 12
+    assert max(calls) <= 5
+    # Every case is either handed out or still available, in the pool or held as an extra.
+    assert availability.available("aaa") + len(drawn) == 30
+
+
+def test_cases_taken_elsewhere_are_skipped():
+    storage = MemoryStorage()
+    tracker = UsedCaseTracker(storage)
+    bank = CaseBank(["a", "b", "c"])
+    availability = CaseAvailability(bank, tracker, rng=random.Random(0))
+    availability.available("aaa")
+    # Another process reserves two of them after the pool was built.
+    tracker.reserve("aaa", ["a", "b"])
+    assert availability.draw_many("aaa", 3) == ["c"]
+    assert availability.draw("aaa") is None
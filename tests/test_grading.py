@@ -0,0 +1,85 @@
+import itertools
+import math
+
+import pandas as pd
+import pytest
+
+from grading import aggregate, grade
+
+CORRECT = ["A", "B", "C"]
+
+
+def frame(rankings, correct=CORRECT):
+    return pd.DataFrame(
+        [dict(zip(["dx_1", "dx_2", "dx_3", "correct_1", "correct_2", "correct_3"], list(r) + list(correct)))
+         for r in rankings]
+    )
+
+
+def reference_ndcg(ranking, correct=CORRECT):
+    relevance = {dx: 3 - j for j, dx in enumerate(correct)}
+    dcg = sum(relevance.get(dx, 0) / math.log2(k + 2) for k, dx in enumerate(ranking))
+    return dcg / sum(r / math.log2(k + 2) for k, r in enumerate([3, 2, 1]))
+
+
+def reference_spearman(ranking, correct=CORRECT):
+    positions = [ranking.index(dx) + 1 if dx in ranking else 4 for dx in correct]
+    # Average ranks for ties, as scipy.stats.rankdata does.
+    ranks = [sum(q < p for q in positions) + (positions.count(p) + 1) / 2 for p in positions]
+    mean = sum(ranks) / 3
+    spread = math.sqrt(sum((r - mean) ** 2 for r in ranks) * 2)
+    if spread == 0:
+        return 0.0
+    return sum((r - mean) * (t - 2) for r, t in zip(ranks, [1, 2, 3])) / spread
+
+
+@pytest.mark.parametrize("ranking, credit, rho", [
+    (["A", "B", "C"], 1.0, 1.0),
+    (["C", "B", "A"], 0.790, -1.0),
+    (["B", "A", "C"], 0.922, 0.5),
+    (["A", "X", "Y"], 0.630, 0.866),
+    (["A", "B", "X"], 0.895, 1.0),
+    (["X", "Y", "Z"], 0.0, 0.0),
+])
+def test_known_scores(ranking, credit, rho):
+    graded = grade(frame([ranking])).iloc[0]
+    assert graded["position_credit"] == pytest.approx(credit, abs=1e-3)
+    assert graded["spearman"] == pytest.approx(rho, abs=1e-3)
+
+
+def test_matches_reference_for_every_ranking():
+    rankings = list(itertools.permutations(["A", "B", "C", "X", "Y"], 3))
+    graded = grade(frame(rankings))
+    for ranking, (_, row) in zip(rankings, graded.iterrows()):
+        assert row["position_credit"] == pytest.approx(reference_ndcg(ranking))
+        assert row["spearman"] == pytest.approx(reference_spearman(ranking))
+        assert row["overlap"] == pytest.approx(len(set(ranking) & set(CORRECT)) / 3)
+        assert row["exact_match"] == (list(ranking) == CORRECT)
+        assert row["top1_hit"] == (ranking[0] == "A")
+
+
+def test_scores_stay_in_range():
+    graded = grade(frame(itertools.permutations(["A", "B", "C", "X", "Y"], 3)))
+    assert graded["position_credit"].between(0, 1).all()
+    assert graded["spearman"].between(-1, 1).all()
+
+
+def test_comparison_ignores_case_and_whitespace():
+    graded = grade(frame([[" a", "B ", "c"]])).iloc[0]
+    assert graded["exact_match"] and graded["position_credit"] == pytest.approx(1.0)
+
+
+def test_missing_case_scores_zero():
+    graded = grade(frame([["A", "B", "C"]], correct=["", "", ""])).iloc[0]
+    assert not graded["exact_match"]
+    assert graded["position_credit"] == 0 and graded["spearman"] == 0 and graded["overlap"] == 0
+
+
+def test_aggregate_means_per_group():
+    df = frame([["A", "B", "C"], ["C", "B", "A"], ["A", "B", "C"]])
+    df["record_id"] = ["r1", "r1", "r2"]
+    summary = aggregate(grade(df), "record_id").set_index("record_id")
+    assert summary.loc["r1", "submissions"] == 2
+    assert summary.loc["r1", "exact_match"] == pytest.approx(0.5)
+    assert summary.loc["r1", "spearman"] == pytest.approx(0.0)
+    assert summary.loc["r2", "position_credit"] == pytest.approx(1.0)
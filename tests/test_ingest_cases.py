@@ -0,0 +1,35 @@
+import os
+import shutil
+
+from case_bank import CaseBank, CompiledCaseBank, open_case_bank
+from ingest_cases import ingest
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE = os.path.join(HERE, "clinical_case_kawasaki_renamed.csv")
+BAD_ROW = "record_id,anchorx,choices,answer,sec_dx,thir_dx\nX1,,a,a,b,c\n"
+
+
+def test_failed_first_build_leaves_no_bank(tmp_path):
+    shutil.copy(SOURCE, tmp_path)
+    (tmp_path / "bad.csv").write_text(BAD_ROW)
+    out = str(tmp_path / "case_bank.sqlite3")
+    assert ingest(str(tmp_path), out, log=lambda message: None)
+    assert not os.path.exists(out) and not os.path.exists(out + ".tmp")
+    assert isinstance(open_case_bank(str(tmp_path), out), CaseBank)
+
+
+def test_failed_rebuild_keeps_the_previous_bank(tmp_path):
+    shutil.copy(SOURCE, tmp_path)
+    out = str(tmp_path / "case_bank.sqlite3")
+    assert ingest(str(tmp_path), out, log=lambda message: None) == []
+    cases = len(CompiledCaseBank(out))
+    (tmp_path / "bad.csv").write_text(BAD_ROW)
+    assert ingest(str(tmp_path), out, log=lambda message: None)
+    assert len(CompiledCaseBank(out)) == cases > 0
+
+
+def test_empty_bank_falls_back_to_the_csv_files(tmp_path):
+    out = str(tmp_path / "case_bank.sqlite3")
+    assert ingest(str(tmp_path), out, log=lambda message: None) == []
+    shutil.copy(SOURCE, tmp_path)
+    assert isinstance(open_case_bank(str(tmp_path), out), CaseBank)
@@ -0,0 +1,153 @@
+"""
+The storage backends must behave the same. Memory and SQLite always run; Firestore
+runs against the emulator when FIRESTORE_EMULATOR_HOST is set, e.g.
+
+    gcloud emulators firestore start --host-port=localhost:8080
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python -m pytest tests
+"""
+import datetime
+import os
+import threading
+import uuid
+
+import pytest
+
+import aggregates
+from storage import open_storage, utcnow
+
+WINDOW = datetime.timedelta(hours=6)
+
+
+@pytest.fixture(params=["memory", "sqlite", "firestore"])
+def storage(request, tmp_path):
+    if request.param == "memory":
+        return open_storage({"backend": "memory"})
+    if request.param == "sqlite":
+        return open_storage({"backend": "sqlite", "path": str(tmp_path / "storage.sqlite3")})
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        pytest.skip("FIRESTORE_EMULATOR_HOST is not set")
+    from google.cloud import firestore
+
+    # The emulator keeps each project's data apart, so every test starts empty.
+    return open_storage({"backend": "firestore", "counter_shards": 3},
+                        firestore.Client(project=f"clin-reason-test-{uuid.uuid4().hex[:8]}"))
+
+
+def reserve(storage, record_ids, since=None, designation="aaa"):
+    since = since or utcnow() - datetime.timedelta(days=7)
+    expire_at = utcnow() + datetime.timedelta(days=7)
+    counters = {r: aggregates.served(designation, r) for r in record_ids}
+    return storage.reserve_cases(designation, record_ids, since, expire_at, counters)
+
+
+def test_reserve_cases_skips_cases_used_within_the_window(storage):
+    assert reserve(storage, ["a", "b"]) == ["a", "b"]
+    assert reserve(storage, ["b", "c", "a"]) == ["c"]
+    assert storage.list_used_cases("aaa", utcnow() - datetime.timedelta(days=7)) == {"a", "b", "c"}
+    # Designations are tracked separately.
+    assert reserve(storage, ["a"], designation="bbb") == ["a"]
+    # Used before since, e.g. outside the window: reserved again.
+    assert reserve(storage, ["a", "d"], since=utcnow() + datetime.timedelta(seconds=1)) == ["a", "d"]
+
+
+def test_reserve_cases_counts_only_reserved_cases(storage):
+    reserve(storage, ["a", "b"])
+    reserve(storage, ["b", "c"])
+    counters = storage.get_counters()
+    assert counters["designation:aaa"]["served"] == 3
+    assert {name: c["served"] for name, c in counters.items() if name.startswith("case:")} == {
+        "case:a": 1, "case:b": 1, "case:c": 1,
+    }
+
+
+def test_concurrent_reservations_never_share_a_case(storage):
+    record_ids = [f"r{i}" for i in range(20)]
+    results = []
+
+    def worker(offset):
+        results.append(reserve(storage, record_ids[offset:] + record_ids[:offset]))
+
+    threads = [threading.Thread(target=worker, args=(i * 5,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    reserved = [r for result in results for r in result]
+    assert sorted(reserved) == sorted(record_ids)
+    assert storage.get_counters(["designation:aaa"])["designation:aaa"]["served"] == 20
+
+
+def test_reserve_limit_is_enforced(storage):
+    limit = storage.reserve_limit(2)
+    if limit is None:
+        pytest.skip("backend has no reserve limit")
+    with pytest.raises(ValueError):
+        reserve(storage, [f"r{i}" for i in range(limit + 1)])
+
+
+def test_claim_lock_is_exclusive_within_the_window(storage):
+    claimed, state = storage.claim_lock("p1_aaa", WINDOW)
+    assert not claimed and not state["locked"]
+    claimed, state = storage.claim_lock("p1_aaa", WINDOW)
+    assert claimed and state["timestamp"] is not None
+    # Outside the window the passcode can be claimed again.
+    assert storage.claim_lock("p1_aaa", datetime.timedelta(0))[0] is False
+    assert storage.get_locks(["p1_aaa", "p2_aaa"])["p2_aaa"] is None
+
+
+def test_claim_lock_after_set_lock(storage):
+    assert storage.set_lock("p1_aaa")["locked"]
+    claimed, state = storage.claim_lock("p1_aaa", WINDOW)
+    assert claimed and state["locked"]
+    assert storage.get_lock("p1_aaa")["locked"]
+
+
+def test_concurrent_claims_have_one_winner(storage):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(storage.claim_lock("p1_aaa", WINDOW)[0]))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(False) == 1
+
+
+def completed_exam(passcode="p1_aaa", record_id="a"):
+    return {
+        "passcode": passcode,
+        "student_name": "Student",
+        "record_id": record_id,
+        "selected_diagnoses": ["x", "y", "z"],
+        "submitted_at": utcnow(),
+    }
+
+
+def test_list_completed_exams_pages_through_every_exam_once(storage):
+    ids = {f"s{i:02d}" for i in range(7)}
+    for submission_id in sorted(ids):
+        storage.add_completed_exam(submission_id, completed_exam())
+    seen, cursor = [], None
+    while True:
+        page = storage.list_completed_exams(after=cursor, limit=3)
+        seen += page
+        if len(page) < 3:
+            break
+        cursor = (page[-1][1]["timestamp"], page[-1][0])
+    assert sorted(sid for sid, _ in seen) == sorted(ids)
+    keys = [(data["timestamp"], sid) for sid, data in seen]
+    assert keys == sorted(keys)
+    assert storage.list_completed_exams(after=keys[-1], limit=3) == []
+
+
+def test_add_completed_exam_is_idempotent(storage):
+    counters = aggregates.completed("aaa", "a", correct=False)
+    storage.add_completed_exam("s1", completed_exam(), counters)
+    storage.add_completed_exam("s1", dict(completed_exam(), student_name="Retry"), counters)
+    page = storage.list_completed_exams()
+    assert [sid for sid, _ in page] == ["s1"]
+    assert page[0][1]["student_name"] == "Student"
+    assert storage.get_counters(["case:a", "designation:aaa"]) == {
+        "case:a": {"completed": 1, "incorrect": 1},
+        "designation:aaa": {"completed": 1, "incorrect": 1},
+    }
@@ -0,0 +1,101 @@
+"""
+Per-designation tracking of recently used cases.
+
+Reads are a time-windowed query on `timestamp` backed by a short-lived in-process
+cache, and expired records are removed in batches by a background sweeper instead
+of one delete per record inside the request path. Each record also carries an
+`expire_at` field so a Firestore TTL policy can be enabled on the collection.
+Reserving a case also counts it as served in the aggregate counters, in the same
+transaction.
+"""
+import datetime
+import logging
+import threading
+import time
+
+import aggregates
+from storage import BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class UsedCaseTracker:
+    def __init__(self, storage, window_days=7, cache_ttl=30, sweep_interval=3600):
+        self.storage = storage
+        self.window = datetime.timedelta(days=window_days)
+        self.cache_ttl = cache_ttl
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        # designation -> (expires_at, set of record_ids)
+        self._cache = {}
+        self._designations = set()
+        self._sweeper = None
+
+    def _cutoff(self):
+        return datetime.datetime.now(datetime.timezone.utc) - self.window
+
+    def get_used(self, designation):
+        """Returns the set of record_ids used within the window for a designation."""
+        now = time.monotonic()
+        with self._lock:
+            self._designations.add(designation)
+            cached = self._cache.get(designation)
+            if cached and cached[0] > now:
+                return set(cached[1])
+        used = self.storage.list_used_cases(designation, self._cutoff())
+        with self._lock:
+            self._cache[designation] = (now + self.cache_ttl, used)
+        return set(used)
+
+    def reserve(self, designation, record_ids):
+        """
+        Marks record_ids used in one transaction, skipping any already used within the
+        window. Returns the ones reserved by this call.
+        """
+        record_ids = [str(r) for r in record_ids]
+        expire_at = datetime.datetime.now(datetime.timezone.utc) + self.window
+        counters = {r: aggregates.served(designation, r) for r in record_ids}
+        reserved = self.storage.reserve_cases(designation, record_ids, self._cutoff(), expire_at, counters)
+        with self._lock:
+            self._designations.add(designation)
+            cached = self._cache.get(designation)
+            if cached:
+                # The rest were taken by someone else, so they are used either way.
+                cached[1].update(record_ids)
+        return reserved
+
+    def reserve_limit(self):
+        """Most record_ids one reserve() call accepts, or None if there is no limit."""
+        return self.storage.reserve_limit(len(aggregates.served("", "")))
+
+    def sweep(self, designations=None):
+        """Deletes expired used-case records in batches. Returns the number deleted."""
+        if designations is None:
+            with self._lock:
+                designations = list(self._designations)
+        deleted = 0
+        cutoff = self._cutoff()
+        for designation in designations:
+            while True:
+                count = self.storage.delete_used_cases_before(designation, cutoff, BATCH_SIZE)
+                deleted += count
+                if count < BATCH_SIZE:
+                    break
+        return deleted
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Used-case sweep failed")
+
+    def start_sweeper(self, designations=()):
+        """Starts the background sweeper once; designations seeds the set it visits."""
+        with self._lock:
+            self._designations.update(designations)
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(target=self._sweep_forever, name="used-case-sweeper", daemon=True)
+        self._sweeper.start()